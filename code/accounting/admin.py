@@ -2,11 +2,12 @@ from django.contrib import admin
 from django import forms
 from django.utils.html import format_html
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib import messages
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
 from django.contrib.admin import SimpleListFilter
-from .models import Order, ServiceFee
+from .models import EmailOutbox, Order, ServiceFee
 
 from events.models import is_admin_user, is_ticket_manager_user
 
@@ -42,13 +43,11 @@ class TimedOutFilter(SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == 'yes':
-            # Filter in Python for orders that have timed out
-            timed_out_orders = [order for order in queryset if order.has_timed_out]
-            return queryset.filter(id__in=[order.id for order in timed_out_orders])
+            # Orders whose expiry has passed
+            return queryset.filter(Order.timed_out_condition())
         elif self.value() == 'no':
-            # Filter in Python for orders that have NOT timed out
-            active_orders = [order for order in queryset if not order.has_timed_out]
-            return queryset.filter(id__in=[order.id for order in active_orders])
+            # Orders that have NOT timed out (yet)
+            return queryset.exclude(Order.timed_out_condition())
         return queryset
 
 @admin.register(Order)
@@ -185,3 +184,42 @@ class ServiceFeeAdmin(admin.ModelAdmin):
         return False
 
 
+
+
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'object_id', 'recipient', 'status', 'attempts', 'available_at', 'created_at', 'sent_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('object_id', 'recipient', 'last_error')
+    readonly_fields = ('kind', 'object_id', 'recipient', 'status', 'attempts', 'last_error', 'available_at', 'created_at', 'claimed_at', 'sent_at')
+    actions = ['retry_selected']
+
+    def has_view_permission(self, request, obj=None):
+        """Allow superusers and users in 'admin' group and accountants to view."""
+        if request.user.is_superuser:
+            return True
+        if is_admin_user(request.user) or is_accountant_user(request.user):
+            return True
+        return False
+
+    def has_add_permission(self, request):
+        # entries are only written by the application
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return self.has_view_permission(request, obj)
+
+    def has_delete_permission(self, request, obj=None):
+        """Allow superusers and users in 'admin' group to delete."""
+        if request.user.is_superuser:
+            return True
+        if is_admin_user(request.user):
+            return True
+        return False
+
+    def retry_selected(self, request, queryset):
+        count = queryset.exclude(status=EmailOutbox.STATUS_SENT).update(
+            status=EmailOutbox.STATUS_PENDING, attempts=0, available_at=timezone.now()
+        )
+        messages.success(request, _("{count} emails will be sent again.").format(count=count))
+    retry_selected.short_description = _("Retry sending selected emails")
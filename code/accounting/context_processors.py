@@ -9,11 +9,9 @@ def cart_count(request):
     ticket_count = 0
     
     if request.session.session_key:
-        try:
-            order = get_payment_model().objects.get(session_id=request.session.session_key)
-            ticket_count = order.tickets.count()
-        except get_payment_model().DoesNotExist:
-            ticket_count = 0
+        ticket_count = get_payment_model().objects.filter(
+            session_id=request.session.session_key,
+        ).values_list('ticket_count', flat=True).first() or 0
     
     session_remaining_seconds = None
     if request.user.is_authenticated:
@@ -0,0 +1,141 @@
+"""
+Stored invoice PDFs.
+
+An invoice is rendered once per state of its order (payment instructions,
+confirmed or refunded) and written to media storage as an ``OrderInvoice``, named
+after the hash of its content. Downloads and emails read the stored bytes, so
+resending an invoice does not render it again.
+
+Each invoice remembers a fingerprint of the order data it shows (billing address,
+payment method, tickets, service fees and branding) and is only rendered again when
+that fingerprint changes. There is one invoice per order state, so it is always
+rendered in the site language (``LANGUAGE_CODE``), whatever the language of the request.
+"""
+
+from collections import namedtuple
+import hashlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.utils import translation
+from payments.models import PaymentStatus
+
+from branding.models import get_active_branding
+from cinema_tickets.pdf_rendering import render_pdf
+
+from .models import OrderInvoice
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+InvoicePdf = namedtuple('InvoicePdf', ['content', 'content_hash', 'last_modified'])
+
+INVOICE_STATE_PAYMENT_INSTRUCTIONS = 'payment_instructions'
+INVOICE_STATE_CONFIRMED = 'confirmed'
+INVOICE_STATE_REFUNDED = 'refunded'
+
+ORDER_FINGERPRINT_FIELDS = [
+    'variant',
+    'currency',
+    'created',
+    'billing_first_name',
+    'billing_last_name',
+    'billing_address_1',
+    'billing_address_2',
+    'billing_city',
+    'billing_postcode',
+    'billing_country_code',
+    'billing_country_area',
+    'applied_service_fees_ticket_level',
+    'applied_service_fees_total',
+]
+
+
+def invoice_state(order):
+    """
+    Return the invoice state of the order.
+    """
+    if order.status == PaymentStatus.CONFIRMED:
+        return INVOICE_STATE_CONFIRMED
+    if order.status == PaymentStatus.REFUNDED:
+        return INVOICE_STATE_REFUNDED
+    return INVOICE_STATE_PAYMENT_INSTRUCTIONS
+
+
+def invoice_fingerprint(order):
+    """
+    Return a hash of everything printed on the invoice of the order.
+    """
+    branding = get_active_branding()
+    tickets = order.tickets.order_by('pk').values_list('pk', 'price_class__price', 'event__name', 'event__start_time')
+    key = (
+        order.pk,
+        invoice_state(order),
+        tuple(str(getattr(order, field)) for field in ORDER_FINGERPRINT_FIELDS),
+        tuple(tuple(str(value) for value in ticket) for ticket in tickets),
+        tuple(str(getattr(branding, field.attname)) for field in branding._meta.concrete_fields) if branding else None,
+    )
+    return hashlib.sha256(repr(key).encode()).hexdigest()
+
+
+def store_order_invoice(order, fingerprint=None):
+    """
+    Render the invoice of the order and store it for the current state of the order.
+    """
+    state = invoice_state(order)
+    fingerprint = fingerprint or invoice_fingerprint(order)
+    with translation.override(settings.LANGUAGE_CODE):
+        content = render_pdf(type(order).generate_pdf_invoice, order)
+    content_hash = hashlib.sha256(content).hexdigest()
+
+    invoice = OrderInvoice.objects.filter(order=order, state=state).first()
+    old_name = invoice.pdf.name if invoice is not None else None
+    if invoice is None:
+        invoice = OrderInvoice(order=order, state=state)
+    invoice.pdf.save(f"order_invoice_{order.pk}_{state}_{content_hash[:16]}.pdf", ContentFile(content), save=False)
+    invoice.content_hash = content_hash
+    invoice.fingerprint = fingerprint
+    try:
+        with transaction.atomic():
+            invoice.save()
+    except IntegrityError:
+        # stored concurrently by another worker
+        invoice.pdf.delete(save=False)
+        return OrderInvoice.objects.get(order=order, state=state)
+
+    if old_name and old_name != invoice.pdf.name:
+        invoice.pdf.storage.delete(old_name)
+    logger.debug(f"Stored {state} invoice for order {order.pk} ({content_hash[:12]})")
+    return invoice
+
+
+def get_order_invoice(order):
+    """
+    Return the stored invoice of the order for its current state, rendering it if it is missing or outdated.
+    """
+    # make sure the service fees shown on the invoice are stored before fingerprinting
+    order.get_service_fees()
+    fingerprint = invoice_fingerprint(order)
+    invoice = OrderInvoice.objects.filter(order=order, state=invoice_state(order)).first()
+    if invoice is not None and invoice.fingerprint == fingerprint:
+        return invoice
+    return store_order_invoice(order, fingerprint)
+
+
+def read_invoice_pdf(order):
+    """
+    Return the stored invoice of the order as ``InvoicePdf``.
+    """
+    invoice = get_order_invoice(order)
+    try:
+        with invoice.pdf.open('rb') as stored:
+            content = stored.read()
+    except OSError:
+        logger.warning(f"Stored invoice {invoice.pdf.name} is missing, rendering it again")
+        invoice = store_order_invoice(order)
+        with invoice.pdf.open('rb') as stored:
+            content = stored.read()
+    return InvoicePdf(content, invoice.content_hash, invoice.rendered_at)
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+from payments import get_payment_model
+
+class Command(BaseCommand):
+    help = _('Set the stored expiry of orders saved before it existed from their last modification and timeout')
+
+    def handle(self, *args, **kwargs):
+        count = get_payment_model().backfill_expires_at()
+        self.stdout.write(f"Set the expiry of {count} orders")
@@ -1,3 +1,4 @@
+import argparse
 import shlex
 import subprocess
 import os
@@ -7,19 +8,58 @@ from django.core.management.base import BaseCommand
 from django.utils import autoreload
 
 from cinema_tickets.settings import DEBUG
+from cinema_tickets.celery import WORKER_PROFILES
 
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Store the Celery process globally
-celery_process = None
+# Store the Celery processes globally
+celery_processes = []
 
-def restart_celery():
-    global celery_process
+def worker_commands(queues=None, concurrency=None, prefetch_multiplier=None, beat=None):
+    """
+    Build the celery worker commands: one worker for all queues, or one worker per given queue
+    using the concurrency and prefetch of its profile in cinema_tickets.celery.WORKER_PROFILES.
+    """
+    loglevel = 'debug' if DEBUG else 'info'
+    if not queues:
+        # single worker consuming all queues, running the periodic tasks unless disabled
+        cmd = f'celery -A cinema_tickets worker --loglevel={loglevel}'
+        if beat is not False:
+            cmd += ' --beat'
+        if concurrency:
+            cmd += f' --concurrency={concurrency}'
+        if prefetch_multiplier:
+            cmd += f' --prefetch-multiplier={prefetch_multiplier}'
+        return [cmd]
+
+    # only one process may run the scheduler: the worker whose profile runs it, or the first one with --beat
+    if beat is None:
+        beat_queue = next((queue for queue in queues if WORKER_PROFILES[queue].get('beat')), None)
+        if beat_queue is None:
+            logger.warning('No worker runs the periodic task scheduler, make sure celery beat runs elsewhere')
+    else:
+        beat_queue = queues[0] if beat else None
+
+    commands = []
+    for queue in queues:
+        profile = WORKER_PROFILES[queue]
+        cmd = (
+            f'celery -A cinema_tickets worker --loglevel={loglevel} --queues={",".join(profile["queues"])} --hostname={queue}@%h'
+            f' --concurrency={concurrency or profile["concurrency"]}'
+            f' --prefetch-multiplier={prefetch_multiplier or profile["prefetch_multiplier"]}'
+        )
+        if queue == beat_queue:
+            cmd += ' --beat'
+        commands.append(cmd)
+    return commands
+
+def restart_celery(queues=None, concurrency=None, prefetch_multiplier=None, beat=None):
+    global celery_processes
     
-    # Kill the previous Celery process if it exists
-    if celery_process is not None:
+    # Kill the previous Celery processes if they exist
+    for celery_process in celery_processes:
         try:
             logger.info(f'Terminating previous Celery process (PID: {celery_process.pid})')
             celery_process.terminate()
@@ -30,22 +70,43 @@ def restart_celery():
         except Exception as e:
             logger.error(f'Error terminating Celery process: {e}')
     
-    # Start new Celery process
-    if DEBUG:
-        cmd = 'celery -A cinema_tickets worker --beat --loglevel=debug'
-    else:
-        cmd = 'celery -A cinema_tickets worker --beat --loglevel=info'
-    
-    logger.info(f'Starting Celery with command: {cmd}')
-    celery_process = subprocess.Popen(shlex.split(cmd))
+    # Start new Celery processes
+    celery_processes = []
+    for cmd in worker_commands(queues, concurrency, prefetch_multiplier, beat):
+        logger.info(f'Starting Celery with command: {cmd}')
+        celery_processes.append(subprocess.Popen(shlex.split(cmd)))
 
 
 class Command(BaseCommand):
+    help = 'Start celery workers with autoreload, either one worker for all queues or one worker per queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--queue',
+            action='append',
+            dest='queues',
+            choices=list(WORKER_PROFILES),
+            help='Start a worker for this queue (repeatable). Without it one worker consumes all queues.',
+        )
+        parser.add_argument('--concurrency', type=int, help='Override the number of worker processes per worker.')
+        parser.add_argument('--prefetch-multiplier', type=int, help='Override the number of tasks a worker process reserves.')
+        parser.add_argument(
+            '--beat',
+            action=argparse.BooleanOptionalAction,
+            default=None,
+            help='Run the periodic task scheduler (default: in the worker consuming all queues or the maintenance worker).',
+        )
 
     def handle(self, *args, **options):
         self.stdout.write(self.style.SUCCESS('Starting celery worker with autoreload...'))
         try:
-            autoreload.run_with_reloader(restart_celery)
+            autoreload.run_with_reloader(
+                restart_celery,
+                queues=options['queues'],
+                concurrency=options['concurrency'],
+                prefetch_multiplier=options['prefetch_multiplier'],
+                beat=options['beat'],
+            )
         except Exception as error:
             self.stderr.write(self.style.ERROR(f'Celery command failed: {error}'))
             raise
\ No newline at end of file
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+from payments import get_payment_model
+
+class Command(BaseCommand):
+    help = _('Recount the stored ticket count and subtotal of orders from their tickets')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order', action='append', dest='order_ids', help=_('Only refresh the given order id (can be repeated)'))
+
+    def handle(self, *args, **kwargs):
+        orders = get_payment_model().objects.all()
+        if kwargs['order_ids']:
+            orders = orders.filter(pk__in=kwargs['order_ids'])
+        count = 0
+        for order in orders.iterator():
+            order.refresh_ticket_totals()
+            count += 1
+        self.stdout.write(f"Refreshed {count} orders")
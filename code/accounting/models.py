@@ -16,6 +16,8 @@ from fpdf import FPDF
 import os
 
 from branding.models import get_active_branding
+from cinema_tickets.mail import send_email, send_messages
+from cinema_tickets.pdf_rendering import render_pdf
 from events.models import Ticket, PriceClass, TicketMaster
 
 import logging
@@ -77,6 +79,25 @@ class ServiceFee(models.Model):
         super(ServiceFee, self).save(*args, **kwargs)
 
 
+class ServiceFeeRulesVersion(models.Model):
+    """
+    Single row whose version is bumped whenever a service fee changes, so every process
+    drops its compiled service fee rules, see accounting.service_fees.
+    """
+    version = models.IntegerField(_("version"), default=0)
+
+    def __str__(self):
+        return f"Service fee rules version {self.version}"
+
+
+def ticket_totals(tickets):
+    """
+    Return ``(count, price sum)`` of the ticket queryset in one query.
+    """
+    totals = tickets.aggregate(count=models.Count('pk'), amount=models.Sum('price_class__price'))
+    return totals['count'], totals['amount'] or Decimal("0")
+
+
 # class for holding one sessions order until payment is completed
 class Order(BasePayment):
     """
@@ -87,6 +108,8 @@ class Order(BasePayment):
     tickets = models.ManyToManyField(Ticket, related_name="Tickets")
 
     timeout = models.IntegerField(default=10)  # in minutes
+    # point in time the order times out, i.e. last modification + timeout; kept up to date in save()
+    expires_at = models.DateTimeField(_("expires at"), null=True, blank=True, editable=False, db_index=True)
 
     # user choices for payment, limit choices to settings.PAYMENT_VARIANTS
     variant = models.CharField(max_length=255, 
@@ -104,9 +127,19 @@ class Order(BasePayment):
     applied_service_fees_ticket_level = models.JSONField(default=dict, blank=True)
     applied_service_fees_total = models.JSONField(default=dict, blank=True)
 
+    # number and price sum of the tickets, kept up to date when tickets are added or removed (see accounting.signals)
+    ticket_count = models.PositiveIntegerField(_("ticket count"), default=0, editable=False)
+    subtotal = models.DecimalField(_("subtotal"), max_digits=9, decimal_places=2, default=Decimal("0"), editable=False)
+
     # boolean field to indicate if order is confirmed by the ticket master or not, default is false
     is_confirmed = models.BooleanField(default=False, verbose_name=_("Payment Is Confirmed"), help_text=_("Indicates whether the order has been confirmed by the ticket master."))
 
+    class Meta:
+        indexes = [
+            # timed-out order sweep: waiting orders by expiry
+            models.Index(fields=['status', 'expires_at'], name='order_status_expires_idx'),
+        ]
+
     def get_purchased_items(self) -> Iterable[PurchasedItem]:
         """Return an iterable of purchased items.
 
@@ -134,56 +167,7 @@ class Order(BasePayment):
             variant = self.variant
             store_fees = True
 
-        tickets = list(self.tickets.select_related("price_class").all())
-        
-        service_fees_ticket_level = {}
-        service_fees_total = {}
-    
-        # get all services fees applicable for the order's payment method and tickets
-        service_fees = ServiceFee.objects.filter(
-            is_active=True,
-            payment_method=variant,
-        ).prefetch_related("price_classes")
-        
-        # get service fees that are applied on ticket level (fixed amount or percentage per ticket)
-        service_fees_applied_to_tickets = [
-            fee for fee in service_fees if fee.fee_type in ["fixed_ticket", "percentage_ticket"]
-        ]
-        # iterate over all tickets in the order and apply service fees on ticket or price class level
-        for fee in service_fees_applied_to_tickets:
-            fee_amount = Decimal("0")
-            applicable_price_class_ids = {price_class.id for price_class in fee.price_classes.all()}
-            has_price_class_filter = bool(applicable_price_class_ids)
-
-            for ticket in tickets:
-                if has_price_class_filter and ticket.price_class_id not in applicable_price_class_ids:
-                    # if fee has price classes assigned and ticket price class is not in it, skip fee for this ticket
-                    # or fee is applied to all tickets if no price class is assigned
-                    continue
-                else:
-                    if fee.fee_type == "fixed_ticket":
-                        fee_amount += fee.fee_amount
-                    elif fee.fee_type == "percentage_ticket":
-                        percentage_fee = ticket.price_class.price * (fee.fee_amount / Decimal("100.0"))
-                        fee_amount += percentage_fee
-            
-            service_fees_ticket_level[fee.id] = fee_amount
-
-        subtotal = sum(ticket.price_class.price for ticket in tickets)
-        for fee, amount in service_fees_ticket_level.items():
-            subtotal += amount
-
-        # calculate service fees that are applied on total level (fixed amount or percentage on total)
-        service_fees_applied_to_total = [
-            fee for fee in service_fees if fee.fee_type in ["fixed_total", "percentage_total"]
-        ]
-        for fee in service_fees_applied_to_total:
-            if fee.fee_type == "fixed_total":
-                fee_amount = fee.fee_amount
-            elif fee.fee_type == "percentage_total":
-                fee_amount = subtotal * (fee.fee_amount / Decimal("100.0"))
-            
-            service_fees_total[fee.id] = fee_amount
+        service_fees_ticket_level, service_fees_total = self.compute_service_fees_for_variants([variant])[variant]
 
         if store_fees:
             self.applied_service_fees_ticket_level = self._serialize_service_fees(service_fees_ticket_level)
@@ -192,10 +176,22 @@ class Order(BasePayment):
 
         return service_fees_ticket_level, service_fees_total
 
+    def compute_service_fees_for_variants(self, variants):
+        """
+        Return ``{variant: (service_fees_ticket_level, service_fees_total)}`` for the given payment variants.
+
+        The fees are keyed by compiled fee rule (see accounting.service_fees), the tickets
+        of the order are read once for all variants.
+        """
+        from .service_fees import fees_for_variants
+
+        return fees_for_variants(self.tickets.all(), variants)
+
     def _serialize_service_fees(self, service_fees):
         serialized_service_fees = {}
         for fee, amount in service_fees.items():
-            if isinstance(fee, ServiceFee):
+            if isinstance(fee, ServiceFee) or hasattr(fee, "display_name"):
+                # service fee or compiled fee rule
                 fee_id = fee.id
                 display_name = fee.display_name
             else:
@@ -244,6 +240,16 @@ class Order(BasePayment):
                 self._deserialize_service_fees(self._serialize_service_fees(service_fees_total)),
             )
 
+    def get_total_service_fee_amounts(self, variants):
+        """
+        Return ``{variant: total service fee}`` for the given payment variants.
+        """
+        return {
+            variant: sum(service_fees_ticket_level.values()) + sum(service_fees_total.values())
+            for variant, (service_fees_ticket_level, service_fees_total)
+            in self.compute_service_fees_for_variants(variants).items()
+        }
+
     def get_total_service_fee_amount(self, variant=None):
         if variant is None:
             service_fees_ticket_level, service_fees_total = self.get_service_fees()
@@ -284,7 +290,38 @@ class Order(BasePayment):
 
     @property
     def has_timed_out(self) -> bool:
-        return (timezone.now() - self.modified) > timedelta(minutes=self.timeout)
+        if self.expires_at is None:
+            # order saved before expires_at existed, see the backfill_order_expiry command
+            return (timezone.now() - self.modified) > timedelta(minutes=self.timeout)
+        return timezone.now() > self.expires_at
+
+    @classmethod
+    def timed_out_condition(cls, now=None):
+        """
+        Return the condition of orders that have timed out at ``now``: an index range on expires_at,
+        plus orders saved before expires_at existed, checked by their last modification like has_timed_out.
+        """
+        now = now or timezone.now()
+        condition = models.Q(expires_at__lt=now)
+        # empty once the backfill_order_expiry command has run
+        legacy_timeouts = cls.objects.filter(expires_at__isnull=True).order_by().values_list('timeout', flat=True).distinct()
+        for timeout in legacy_timeouts:
+            condition |= models.Q(expires_at__isnull=True, timeout=timeout, modified__lt=now - timedelta(minutes=timeout))
+        return condition
+
+    @classmethod
+    def timed_out(cls, now=None):
+        """Return a queryset of all orders that have timed out at ``now``, see timed_out_condition()."""
+        return cls.objects.filter(cls.timed_out_condition(now))
+
+    @classmethod
+    def backfill_expires_at(cls):
+        """Set expires_at of orders saved before the field existed, one UPDATE per distinct timeout."""
+        missing = cls.objects.filter(expires_at__isnull=True)
+        updated = 0
+        for timeout in missing.order_by().values_list('timeout', flat=True).distinct():
+            updated += missing.filter(timeout=timeout).update(expires_at=models.F('modified') + timedelta(minutes=timeout))
+        return updated
 
     def is_valid(self) -> bool:
         # check if order is confirmed or not timed out yet
@@ -310,21 +347,83 @@ class Order(BasePayment):
         if not self.created:
             self.created = timezone.now()
             self.modified = timezone.now()
+
+        # modified is refreshed by auto_now on every save that writes it, move the expiry along with it
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'modified', 'timeout'} & set(update_fields):
+            self.expires_at = timezone.now() + timedelta(minutes=self.timeout)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'expires_at'}
         
         super().save(*args, **kwargs)
 
+    def apply_ticket_delta(self, count, amount):
+        """
+        Move the stored ticket count and subtotal by the given difference, in one UPDATE.
+        """
+        Order.objects.filter(pk=self.pk).update(
+            ticket_count=models.F('ticket_count') + count,
+            subtotal=models.F('subtotal') + amount,
+        )
+        self.ticket_count += count
+        self.subtotal += amount
+
+    @classmethod
+    def release_ticket_totals(cls, tickets):
+        """
+        Take the tickets of the given queryset off the ticket count and subtotal of their orders,
+        in one grouped UPDATE for all orders, e.g. before the tickets are deleted in bulk.
+        """
+        totals = list(
+            cls.tickets.through.objects.filter(ticket__in=tickets).order_by()
+            .values('order_id')
+            .annotate(count=models.Count('pk'), amount=models.Sum('ticket__price_class__price'))
+        )
+        if not totals:
+            return
+        cls.objects.filter(pk__in=[total['order_id'] for total in totals]).update(
+            ticket_count=models.F('ticket_count') - models.Case(
+                *[models.When(pk=total['order_id'], then=models.Value(total['count'])) for total in totals],
+                output_field=models.PositiveIntegerField(),
+            ),
+            subtotal=models.F('subtotal') - models.Case(
+                *[models.When(pk=total['order_id'], then=models.Value(total['amount'] or Decimal("0"))) for total in totals],
+                output_field=models.DecimalField(max_digits=9, decimal_places=2),
+            ),
+        )
+
+    @classmethod
+    def refresh_price_class_totals(cls, price_class):
+        """
+        Count the subtotal of the orders waiting for payment with tickets of the price class again,
+        in one UPDATE, e.g. after its price changed. Paid orders keep the subtotal they were paid with.
+        """
+        subtotals = (
+            Ticket.objects.filter(Tickets=models.OuterRef('pk')).order_by()
+            .values('Tickets').annotate(amount=models.Sum('price_class__price')).values('amount')
+        )
+        orders = cls.objects.filter(status=PaymentStatus.WAITING, tickets__price_class=price_class).values('pk')
+        cls.objects.filter(pk__in=orders).update(subtotal=models.Subquery(subtotals))
+
+    def refresh_ticket_totals(self):
+        """
+        Count the ticket count and subtotal again from the tickets of the order.
+        """
+        self.ticket_count, self.subtotal = ticket_totals(self.tickets.all())
+        Order.objects.filter(pk=self.pk).update(ticket_count=self.ticket_count, subtotal=self.subtotal)
+
     def update_tickets(self, new_tickets = None):
-        # add new tickets to order
+        # add new tickets to order, the ticket count and subtotal follow through the m2m signal
         if new_tickets is not None:
             self.tickets.add(*new_tickets)
         self._invalidate_applied_service_fees()
         # calculate new total amount
-        self.total = sum(ticket.price_class.price for ticket in self.tickets.all())  # Sum ticket prices
+        self.total = self.subtotal
         self.modified = timezone.now()
         self.save()
 
     def compute_total(self, with_service_fees = False):
-        self.total = sum(ticket.price_class.price for ticket in self.tickets.all())
+        self.total = self.subtotal
         if with_service_fees:
             service_fees_ticket_level, service_fees_total = self.compute_service_fees()
             self.total += sum(service_fees_ticket_level.values()) + sum(service_fees_total.values())
@@ -338,7 +437,7 @@ class Order(BasePayment):
         ticket.delete()
         self._invalidate_applied_service_fees()
         # calculate new total amount
-        self.total = sum(ticket.price_class.price for ticket in self.tickets.all())  # Sum ticket prices
+        self.total = self.subtotal
         self.modified = timezone.now()
         self.save()
     
@@ -464,7 +563,10 @@ class Order(BasePayment):
 
         # Calculate totals with tax and service fees
         service_fees_ticket_level, service_fees_total = self.get_service_fees()
-        items = [{"description": ticket.event.name, "qty": 1, "unit_price": ticket.price_class.price, "datetime": ticket.event.start_time} for ticket in self.tickets.all()]
+        items = [
+            {"description": ticket.event.name, "qty": 1, "unit_price": ticket.price_class.price, "datetime": ticket.event.start_time}
+            for ticket in self.tickets.select_related("event", "price_class")
+        ]
 
         fees = []
         for fee_name, amount in service_fees_ticket_level.items():
@@ -602,10 +704,10 @@ class Order(BasePayment):
                             order_link=order_link
                         )
             
-            # Generate PDF ticket
-            pdf = self.generate_pdf_invoice()
-            # Create a BytesIO stream to hold the PDF data
-            pdf_output = pdf.output(dest='S')  # Get PDF as a bytearray
+            from .invoices import read_invoice_pdf
+
+            # Stored invoice PDF of the order (rendered now if missing or outdated)
+            pdf_output = read_invoice_pdf(self).content
 
             email = EmailMessage(
                 subject,
@@ -615,20 +717,105 @@ class Order(BasePayment):
             )
             email.attach(f"order_invoice_{self.session_id}.pdf", pdf_output, 'application/pdf')
             try:
-                email.send()
+                send_email(email)
             except Exception as e:
                 logger.error(f"Error sending confirmation email: {e}")
                 raise e
 
     def queue_confirmation_email(self):
         if settings.EMAILS_ASYNC:
-            from .tasks import send_confirmation_email_task
+            from .outbox import enqueue_email
 
-            transaction.on_commit(lambda: send_confirmation_email_task.delay(self.pk))
+            enqueue_email(EmailOutbox.KIND_ORDER_CONFIRMATION, self)
             return
 
         self.send_confirmation_email()
 
+    def generate_pdf_tickets(self, tickets=None):
+        """
+        Generate one PDF containing all tickets of the order (or the given subset), one page per ticket.
+        """
+        from events.models import generate_pdf_tickets
+
+        if tickets is None:
+            tickets = self.tickets.select_related("event__location", "price_class").order_by("event__start_time", "seat")
+        return generate_pdf_tickets(tickets)
+
+    def ticket_recipients(self):
+        """Return the distinct email addresses of the tickets of the order."""
+        return list(
+            self.tickets.exclude(email__isnull=True).exclude(email='')
+            .order_by('email').values_list('email', flat=True).distinct()
+        )
+
+    def send_tickets_email(self, recipient=None):
+        """
+        Send the tickets of the order as one PDF bundle, one email per distinct ticket email address,
+        or only the email to ``recipient``. Tickets without an email address are skipped.
+        """
+        branding = get_active_branding()
+        if branding and branding.invoice_tax_rate:
+            site_name = branding.site_name
+        else:
+            site_name = "Cinema Ticketing"
+
+        tickets = self.tickets.select_related("event__location", "price_class").order_by("event__start_time", "seat")
+        if recipient is not None:
+            tickets = tickets.filter(email=recipient)
+
+        tickets_by_email = {}
+        for ticket in tickets:
+            if ticket.email:
+                tickets_by_email.setdefault(ticket.email, []).append(ticket)
+
+        emails = []
+        for recipient, tickets in tickets_by_email.items():
+            subject = _("Your Tickets for Order {order_id} - {site_name}").format(order_id=self.id, site_name=site_name)
+
+            ticket_lines = "\n".join(
+                f"{ticket.event.name} - {ticket.event.start_time_in_timezone.strftime('%H:%M %d.%m.%Y %Z')} - "
+                + (_("Seat {seat}").format(seat=ticket.seat) if ticket.event.display_seat_number else str(_("Free Seating")))
+                for ticket in tickets
+            )
+            message = _("Dear Customer,\n\nHere are your tickets for order {order_id}.\n\n"
+                        "{ticket_lines}\n\n"
+                        "Thank you for your purchase!\n\n"
+                        "Best regards,\nEvent Team").format(
+                            order_id=self.id,
+                            ticket_lines=ticket_lines
+                        )
+
+            # Generate all tickets of this recipient as one PDF
+            pdf_output = render_pdf(type(self).generate_pdf_tickets, self, tickets)
+
+            email = EmailMessage(
+                subject,
+                message,
+                settings.DEFAULT_FROM_EMAIL,
+                [recipient]
+            )
+            email.attach(f"tickets_{self.session_id}.pdf", pdf_output, 'application/pdf')
+            emails.append(email)
+
+        # send the emails of all recipients over one mail connection
+        try:
+            send_messages(emails)
+        except Exception as e:
+            logger.error(f"Error sending tickets email for order {self.id}: {e}")
+            raise e
+
+        return len(tickets_by_email)
+
+    def queue_send_tickets_email(self):
+        if settings.EMAILS_ASYNC:
+            from .outbox import enqueue_recipient_emails
+
+            # one entry per recipient, so a failure is only retried for that recipient
+            enqueue_recipient_emails(EmailOutbox.KIND_ORDER_TICKETS, self, self.ticket_recipients())
+            return
+
+        self.send_tickets_email()
+
     def send_payment_instructions_email(self):
         payment_instructions = self.get_payment_instructions(html=False)
 
@@ -665,11 +852,12 @@ class Order(BasePayment):
         )
         
         # attach invoice
-        pdf = self.generate_pdf_invoice()
-        pdf_output = pdf.output(dest='S')
+        from .invoices import read_invoice_pdf
+
+        pdf_output = read_invoice_pdf(self).content
         email.attach(f"order_invoice_{self.session_id}.pdf", pdf_output, 'application/pdf')
         try:
-            email.send()
+            send_email(email)
         except Exception as e:
             logger.error(f"Error sending confirmation email: {e}")
             raise e
@@ -735,16 +923,16 @@ class Order(BasePayment):
 
         email.attach(f"order_invoice_{self.session_id}.pdf", pdf_output, 'application/pdf')
         try:
-            email.send()
+            send_email(email)
         except Exception as e:
             logger.error(f"Error sending confirmation email: {e}")
             raise e
 
     def queue_payment_instructions_email(self):
         if settings.EMAILS_ASYNC:
-            from .tasks import send_payment_instructions_email_task
+            from .outbox import enqueue_email
 
-            transaction.on_commit(lambda: send_payment_instructions_email_task.delay(self.pk))
+            enqueue_email(EmailOutbox.KIND_PAYMENT_INSTRUCTIONS, self)
             return
 
         self.send_payment_instructions_email()
@@ -778,7 +966,7 @@ class Order(BasePayment):
             [self.billing_email]
         )
         try:
-            email.send()
+            send_email(email)
         except Exception as e:
             logger.error(f"Error sending refund notification email: {e}")
             raise e
@@ -838,16 +1026,16 @@ class Order(BasePayment):
             recipient_list
         )
         try:
-            email.send()
+            send_email(email)
         except Exception as e:
             logger.error(f"Error sending refund notification email: {e}")
             raise e
 
     def queue_refund_cancel_notification_email(self):
         if settings.EMAILS_ASYNC:
-            from .tasks import send_refund_cancel_notification_email_task
+            from .outbox import enqueue_email
 
-            transaction.on_commit(lambda: send_refund_cancel_notification_email_task.delay(self.pk))
+            enqueue_email(EmailOutbox.KIND_REFUND_CANCEL, self)
             return
 
         self.send_refund_cancel_notification_email()
@@ -882,12 +1070,78 @@ class Order(BasePayment):
     # delete order and associated tickets
     def delete(self, *args, **kwargs):
 
-        # Properly delete associated tickets
-        all_tickets = list(self.tickets.select_related("event").all())
-        for ticket in all_tickets:
-            ticket.delete()
-            logger.info(f"Deleted ticket {ticket.id} for event {ticket.event.name}")
+        from events.seating import release
+
+        # Properly delete associated tickets in bulk and give their seats back
+        deleted_tickets = release(Ticket.objects.filter(Tickets=self))
+        logger.info(f"Deleted {deleted_tickets} tickets of order {self.id}")
+
+        return super().delete(*args, **kwargs)
 
-        super().delete(*args, **kwargs)
 
+# invoice PDF of an order for one state of the order, see accounting.invoices
+class OrderInvoice(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="invoices", verbose_name=_("order"))
+    state = models.CharField(_("state"), max_length=32, help_text=_("State of the order the invoice was rendered for."))
+    pdf = models.FileField(_("PDF"), upload_to="invoices/")
+    content_hash = models.CharField(_("content hash"), max_length=64)
+    fingerprint = models.CharField(_("fingerprint"), max_length=64, help_text=_("Hash of the order data the invoice was rendered from."))
+    rendered_at = models.DateTimeField(_("rendered at"), auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'state'], name='unique_order_invoice_state'),
+        ]
+
+    def __str__(self):
+        return f"{self.order_id} - {self.state} - {self.content_hash[:12]}"
+
+
+# email waiting to be sent, written in the same transaction as the change it belongs to, see accounting.outbox
+class EmailOutbox(models.Model):
+    KIND_TICKET = 'ticket'
+    KIND_ORDER_TICKETS = 'order_tickets'
+    KIND_ORDER_CONFIRMATION = 'order_confirmation'
+    KIND_PAYMENT_INSTRUCTIONS = 'payment_instructions'
+    KIND_REFUND_CANCEL = 'refund_cancel'
+    KIND_CHOICES = [
+        (KIND_TICKET, _("Ticket")),
+        (KIND_ORDER_TICKETS, _("Order Tickets")),
+        (KIND_ORDER_CONFIRMATION, _("Order Confirmation")),
+        (KIND_PAYMENT_INSTRUCTIONS, _("Payment Instructions")),
+        (KIND_REFUND_CANCEL, _("Refund / Cancellation")),
+    ]
+
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_SENT, _("Sent")),
+        (STATUS_FAILED, _("Failed")),
+    ]
+
+    kind = models.CharField(_("kind"), max_length=32, choices=KIND_CHOICES)
+    # primary key of the ticket or order the email is rendered from when it is sent
+    object_id = models.CharField(_("object id"), max_length=64)
+    # for emails to several recipients (order tickets): the one recipient of this entry
+    recipient = models.EmailField(_("recipient"), blank=True, default='')
+    status = models.CharField(_("status"), max_length=16, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    last_error = models.TextField(_("last error"), blank=True, default='')
+    available_at = models.DateTimeField(_("available at"), default=timezone.now, help_text=_("The email is not sent before this time."))
+    created_at = models.DateTimeField(_("created at"), auto_now_add=True)
+    # when a dispatcher last claimed the entry, it holds it until available_at
+    claimed_at = models.DateTimeField(_("claimed at"), null=True, blank=True)
+    sent_at = models.DateTimeField(_("sent at"), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("email outbox entry")
+        verbose_name_plural = _("email outbox")
+        indexes = [
+            # dispatcher: pending emails that are due
+            models.Index(fields=['status', 'available_at'], name='email_outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.object_id} ({self.status})"
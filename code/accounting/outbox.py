@@ -0,0 +1,167 @@
+"""
+Transactional email outbox.
+
+Instead of handing an email to the broker after the commit, ``enqueue_email`` writes
+an ``EmailOutbox`` row in the same transaction as the order or ticket change, so an
+email is never lost when the broker is unavailable and never sent for a change that
+was rolled back.
+
+``dispatch_outbox`` claims due rows in batches with ``SELECT ... FOR UPDATE SKIP
+LOCKED`` (so several workers can dispatch at once) in a short transaction that
+leases them for ``EMAIL_OUTBOX_LEASE`` seconds and commits. Only then each email is
+rendered from its ticket or order, sent over the pooled mail connection and its
+attempt recorded on its own row, so a failure never undoes the status of emails that
+were already sent. Rows of a dispatcher that died are claimed again when their lease
+runs out. Failed emails are retried with a growing delay until
+``EMAIL_OUTBOX_MAX_ATTEMPTS`` is reached.
+
+The dispatcher is started after each commit that enqueued emails and periodically
+by celery beat, which picks up anything the first trigger missed.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from .models import EmailOutbox
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _senders():
+    from events.models import Ticket
+    from .models import Order
+
+    return {
+        EmailOutbox.KIND_TICKET: (Ticket.objects.select_related('event__location', 'price_class'), 'send_to_email'),
+        EmailOutbox.KIND_ORDER_TICKETS: (Order.objects.all(), 'send_tickets_email'),
+        EmailOutbox.KIND_ORDER_CONFIRMATION: (Order.objects.all(), 'send_confirmation_email'),
+        EmailOutbox.KIND_PAYMENT_INSTRUCTIONS: (Order.objects.all(), 'send_payment_instructions_email'),
+        EmailOutbox.KIND_REFUND_CANCEL: (Order.objects.all(), 'send_refund_cancel_notification_email'),
+    }
+
+
+def _trigger_dispatch():
+    from .tasks import dispatch_email_outbox_task
+
+    try:
+        dispatch_email_outbox_task.apply_async(retry=False)
+    except Exception as e:
+        # the periodic dispatch sends the emails once the broker is back
+        logger.warning(f"Could not trigger email outbox dispatch: {e}")
+
+
+def _enqueue(entries):
+    entries = EmailOutbox.objects.bulk_create(entries)
+    if entries:
+        transaction.on_commit(_trigger_dispatch)
+    return entries
+
+
+def enqueue_emails(kind, objects):
+    """
+    Add one email of the given kind per object (ticket or order) to the outbox, in the current transaction.
+    """
+    return _enqueue([EmailOutbox(kind=kind, object_id=str(obj.pk)) for obj in objects])
+
+
+def enqueue_recipient_emails(kind, obj, recipients):
+    """
+    Add one email of the given kind per recipient of the object to the outbox, so each is sent and retried on its own.
+    """
+    return _enqueue([EmailOutbox(kind=kind, object_id=str(obj.pk), recipient=recipient) for recipient in recipients])
+
+
+def enqueue_email(kind, obj):
+    return enqueue_emails(kind, [obj])[0]
+
+
+def _retry_delay(attempts):
+    return timedelta(minutes=2 ** min(attempts, 8))
+
+
+def _lease():
+    return timedelta(seconds=getattr(settings, 'EMAIL_OUTBOX_LEASE', 300))
+
+
+def claim(batch_size):
+    """
+    Claim up to ``batch_size`` due outbox entries for this dispatcher and count the attempt.
+    The claim is committed right away, the entries are due again when the lease runs out.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            EmailOutbox.objects.filter(status=EmailOutbox.STATUS_PENDING, available_at__lte=now)
+            .order_by('available_at', 'pk')
+            .select_for_update(skip_locked=True)[:batch_size]
+        )
+        EmailOutbox.objects.filter(pk__in=[entry.pk for entry in entries]).update(
+            claimed_at=now,
+            available_at=now + _lease(),
+            attempts=models.F('attempts') + 1,
+        )
+    for entry in entries:
+        entry.claimed_at = now
+        entry.available_at = now + _lease()
+        entry.attempts += 1
+    return entries
+
+
+def deliver(entry, senders=None):
+    """
+    Render and send the email of the claimed outbox entry and record the attempt. Returns whether it was sent.
+    """
+    queryset, method = (senders or _senders())[entry.kind]
+    now = timezone.now()
+    try:
+        obj = queryset.get(pk=entry.object_id)
+        with transaction.atomic():
+            getattr(obj, method)(**({'recipient': entry.recipient} if entry.recipient else {}))
+    except queryset.model.DoesNotExist:
+        entry.status = EmailOutbox.STATUS_FAILED
+        entry.last_error = f"{queryset.model.__name__} {entry.object_id} does not exist."
+    except Exception as e:
+        logger.error(f"Error sending {entry.kind} email for {entry.object_id} (attempt {entry.attempts}): {e}")
+        entry.last_error = str(e)
+        if entry.attempts >= getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 5):
+            entry.status = EmailOutbox.STATUS_FAILED
+        else:
+            entry.available_at = now + _retry_delay(entry.attempts)
+    else:
+        entry.status = EmailOutbox.STATUS_SENT
+        entry.sent_at = now
+        entry.last_error = ''
+    # only while the claim is ours, after the lease ran out another dispatcher may have claimed the entry
+    recorded = EmailOutbox.objects.filter(pk=entry.pk, claimed_at=entry.claimed_at).update(
+        status=entry.status,
+        last_error=entry.last_error,
+        available_at=entry.available_at,
+        sent_at=entry.sent_at,
+    )
+    if not recorded:
+        logger.warning(f"Outbox entry {entry.pk} was claimed again before its {entry.kind} email was recorded")
+    return entry.status == EmailOutbox.STATUS_SENT
+
+
+def dispatch_outbox(batch_size=None, max_batches=20):
+    """
+    Send due outbox emails, claiming up to ``batch_size`` rows at a time. Returns ``(sent, failed)``.
+    """
+    batch_size = batch_size or getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 50)
+    senders = _senders()
+    sent = failed = 0
+    for _batch in range(max_batches):
+        entries = claim(batch_size)
+        for entry in entries:
+            if deliver(entry, senders):
+                sent += 1
+            else:
+                failed += 1
+        if len(entries) < batch_size:
+            break
+    return sent, failed
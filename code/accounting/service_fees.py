@@ -0,0 +1,134 @@
+"""
+Compiled service fee rules.
+
+The active ``ServiceFee`` rows are compiled into a table of ``FeeRule`` tuples per
+payment variant and kept in the cache. The cache key holds the version stored in the
+``ServiceFeeRulesVersion`` row, which saving or deleting a service fee, or changing
+its price classes, bumps in the database (see accounting.signals). Every process,
+whatever its cache backend, compiles the rules again after the change.
+
+Fees are calculated from the tickets of an order grouped by price class (count and
+price), so the fees of all payment variants come from one ticket query.
+"""
+
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+RULES_CACHE_KEY = 'service_fee_rules'
+
+TICKET_FEE_TYPES = ('fixed_ticket', 'percentage_ticket')
+TOTAL_FEE_TYPES = ('fixed_total', 'percentage_total')
+
+# price_class_ids is None if the fee applies to all price classes
+FeeRule = namedtuple('FeeRule', ['id', 'display_name', 'fee_type', 'amount', 'price_class_ids'])
+
+# tickets of an order with the same price class
+TicketGroup = namedtuple('TicketGroup', ['price_class_id', 'price', 'count'])
+
+
+def compile_rules():
+    """
+    Return ``{variant: (ticket_rules, total_rules)}`` for all active service fees.
+    """
+    from .models import ServiceFee
+
+    rules = {}
+    for fee in ServiceFee.objects.filter(is_active=True).prefetch_related('price_classes').order_by('pk'):
+        price_class_ids = frozenset(price_class.pk for price_class in fee.price_classes.all())
+        rule = FeeRule(fee.pk, fee.display_name, fee.fee_type, fee.fee_amount, price_class_ids or None)
+        ticket_rules, total_rules = rules.setdefault(fee.payment_method, ([], []))
+        if fee.fee_type in TICKET_FEE_TYPES:
+            ticket_rules.append(rule)
+        elif fee.fee_type in TOTAL_FEE_TYPES:
+            total_rules.append(rule)
+    return rules
+
+
+def rules_version():
+    """
+    Return the current version of the service fee rules.
+    """
+    from .models import ServiceFeeRulesVersion
+
+    return ServiceFeeRulesVersion.objects.values_list('version', flat=True).first() or 0
+
+
+def get_rules():
+    """
+    Return the compiled service fee rules, compiling them on a cache miss.
+    """
+    key = f"{RULES_CACHE_KEY}:{rules_version()}"
+    rules = cache.get(key)
+    if rules is None:
+        rules = compile_rules()
+        cache.set(key, rules, getattr(settings, 'SERVICE_FEE_RULES_CACHE_TIMEOUT', 60 * 60))
+    return rules
+
+
+def clear_rules():
+    """
+    Invalidate the compiled service fee rules of all processes.
+    """
+    from .models import ServiceFeeRulesVersion
+
+    if not ServiceFeeRulesVersion.objects.update(version=models.F('version') + 1):
+        ServiceFeeRulesVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+
+
+def ticket_groups(tickets):
+    """
+    Group the ticket queryset by price class in one query.
+    """
+    return [
+        TicketGroup(row['price_class'], row['price_class__price'], row['count'])
+        for row in tickets.order_by().values('price_class', 'price_class__price').annotate(count=models.Count('pk'))
+    ]
+
+
+def calculate_fees(rules, groups):
+    """
+    Calculate ``(ticket_level_fees, total_fees)`` keyed by ``FeeRule`` for one variant's rules.
+    """
+    ticket_rules, total_rules = rules
+    service_fees_ticket_level = {}
+    service_fees_total = {}
+
+    for rule in ticket_rules:
+        fee_amount = Decimal("0")
+        for group in groups:
+            if rule.price_class_ids is not None and group.price_class_id not in rule.price_class_ids:
+                # fee is limited to other price classes
+                continue
+            if rule.fee_type == "fixed_ticket":
+                fee_amount += rule.amount * group.count
+            else:
+                fee_amount += group.price * (rule.amount / Decimal("100.0")) * group.count
+        service_fees_ticket_level[rule] = fee_amount
+
+    subtotal = sum(group.price * group.count for group in groups) + sum(service_fees_ticket_level.values())
+
+    for rule in total_rules:
+        if rule.fee_type == "fixed_total":
+            service_fees_total[rule] = rule.amount
+        else:
+            service_fees_total[rule] = subtotal * (rule.amount / Decimal("100.0"))
+
+    return service_fees_ticket_level, service_fees_total
+
+
+def fees_for_variants(tickets, variants):
+    """
+    Return ``{variant: (ticket_level_fees, total_fees)}`` for the ticket queryset with one ticket query.
+    """
+    rules = get_rules()
+    groups = ticket_groups(tickets)
+    return {variant: calculate_fees(rules.get(variant, ([], [])), groups) for variant in variants}
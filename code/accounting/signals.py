@@ -0,0 +1,72 @@
+from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from events.models import PriceClass, Ticket
+from events.seating import ticket_bookkeeping_suspended
+
+from .models import Order, OrderInvoice, ServiceFee, ticket_totals
+from .service_fees import clear_rules
+
+
+@receiver(post_delete, sender=OrderInvoice)
+def delete_order_invoice_file(sender, instance, **kwargs):
+    """
+    Remove the stored PDF together with its invoice, e.g. when the order is deleted.
+    """
+    if instance.pdf:
+        instance.pdf.delete(save=False)
+
+
+@receiver(post_save, sender=ServiceFee)
+@receiver(post_delete, sender=ServiceFee)
+@receiver(m2m_changed, sender=ServiceFee.price_classes.through)
+def clear_service_fee_rules(sender, **kwargs):
+    """
+    Compile the service fee rules again after a service fee or its price classes changed.
+    """
+    clear_rules()
+
+
+@receiver(m2m_changed, sender=Order.tickets.through)
+def update_order_ticket_totals(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Keep the ticket count and subtotal of orders in line with their tickets.
+    """
+    if reverse:
+        # orders added to or removed from a ticket, not used by the shop itself
+        if action == 'pre_clear':
+            instance._cleared_order_ids = list(instance.Tickets.values_list('pk', flat=True))
+        elif action in ('post_add', 'post_remove', 'post_clear'):
+            order_ids = pk_set if action != 'post_clear' else instance.__dict__.pop('_cleared_order_ids', [])
+            for order in Order.objects.filter(pk__in=order_ids):
+                order.refresh_ticket_totals()
+        return
+
+    if action == 'post_add' and pk_set:
+        instance.apply_ticket_delta(*ticket_totals(Ticket.objects.filter(pk__in=pk_set)))
+    elif action == 'pre_remove' and pk_set:
+        # only tickets that are actually part of the order are removed
+        instance._removed_ticket_totals = ticket_totals(instance.tickets.filter(pk__in=pk_set))
+    elif action == 'post_remove' and pk_set:
+        count, amount = instance.__dict__.pop('_removed_ticket_totals', (0, 0))
+        if count:
+            instance.apply_ticket_delta(-count, -amount)
+    elif action == 'post_clear':
+        Order.objects.filter(pk=instance.pk).update(ticket_count=0, subtotal=0)
+        instance.ticket_count, instance.subtotal = 0, 0
+
+
+@receiver(pre_delete, sender=Ticket)
+def remove_deleted_ticket_from_orders(sender, instance, **kwargs):
+    """
+    A deleted ticket drops out of its orders without m2m signals, take it off their totals.
+    Bulk deletes (``events.seating.release``) update the totals of all orders at once.
+    """
+    if ticket_bookkeeping_suspended():
+        return
+    price = PriceClass.objects.filter(pk=instance.price_class_id).values('price')
+    Order.objects.filter(tickets=instance).update(
+        ticket_count=models.F('ticket_count') - 1,
+        subtotal=models.F('subtotal') - models.Subquery(price),
+    )
@@ -1,5 +1,9 @@
 import logging
+import time
+
 from celery import shared_task
+from django.db import transaction
+from django.utils import timezone
 from payments.models import PaymentStatus
 
 logger = logging.getLogger(__name__)
@@ -8,32 +12,70 @@ logger = logging.getLogger(__name__)
 This module defines Celery tasks for the accounting app. 
 These tasks can be scheduled to run periodically or triggered asynchronously as needed.
 """
+def _timed_out_orders(now):
+    """
+    Return a queryset of all orders waiting for payment whose timeout has passed at ``now``,
+    as a range query on the (status, expires_at) index.
+    """
+    from .models import Order
+
+    return Order.timed_out(now).filter(status=PaymentStatus.WAITING)
+
+
+def _delete_timed_out_orders_chunk(order_ids, now):
+    """
+    Delete one chunk of timed-out orders with their tickets in a short transaction.
+    Orders are re-checked under lock, so an order that was renewed meanwhile is kept.
+    Returns the number of deleted orders and tickets.
+    """
+    from events.models import Ticket
+    from events.seating import release
+    from .models import Order
+
+    with transaction.atomic():
+        locked_ids = list(
+            _timed_out_orders(now)
+            .filter(pk__in=order_ids)
+            .select_for_update(skip_locked=True)
+            .values_list('pk', flat=True)
+        )
+        if not locked_ids:
+            return 0, 0
+
+        ticket_count = release(Ticket.objects.filter(Tickets__in=locked_ids))
+        order_count = Order.objects.filter(pk__in=locked_ids).delete()[1].get(Order._meta.label, 0)
+    return order_count, ticket_count
+
+
 @shared_task
-def delete_timed_out_orders_task():
+def delete_timed_out_orders_task(chunk_size=500):
     try:
-        from .models import Order
+        now = timezone.now()
+        started = time.monotonic()
+
+        # select the timed-out orders in the database instead of evaluating has_timed_out per order
+        order_ids = list(_timed_out_orders(now).order_by('pk').values_list('pk', flat=True))
 
-        # Get all orders waiting for payment
-        waiting_orders = Order.objects.filter(
-            status=PaymentStatus.WAITING
-        )
-        
-        # Filter in Python for those that have timed out
-        timed_out_orders_list = [order for order in waiting_orders if order.has_timed_out]
-        count = len(timed_out_orders_list)
-        
         # If no timed-out orders are found, log the information and return a message
-        if count == 0:
+        if not order_ids:
             message = "No timed-out orders found"
             logger.info(message)
             return message
-        
-        # Delete the timed-out orders and log the count
-        for order in timed_out_orders_list:
-            order.delete()
-        
-        # Log the successful deletion of timed-out orders
-        message = f"Successfully deleted {count} timed-out orders"
+
+        # Delete the timed-out orders chunk by chunk, each in its own short transaction
+        deleted_orders = deleted_tickets = chunks = 0
+        for start in range(0, len(order_ids), chunk_size):
+            order_count, ticket_count = _delete_timed_out_orders_chunk(order_ids[start:start + chunk_size], now)
+            deleted_orders += order_count
+            deleted_tickets += ticket_count
+            chunks += 1
+
+        # Log the successful deletion of timed-out orders with throughput metrics
+        elapsed = time.monotonic() - started
+        message = (
+            f"Successfully deleted {deleted_orders} timed-out orders and {deleted_tickets} tickets "
+            f"in {chunks} chunks and {elapsed:.2f}s ({deleted_orders / max(elapsed, 1e-6):.1f} orders/s)"
+        )
         logger.info(message)
         return message
     
@@ -42,44 +84,13 @@ def delete_timed_out_orders_task():
         raise
 
 
-@shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_jitter=True, max_retries=5)
-def send_confirmation_email_task(order_id):
-    from .models import Order
-
-    try:
-        order = Order.objects.get(pk=order_id)
-    except Order.DoesNotExist:
-        logger.warning(f"Skipping confirmation email task: order {order_id} does not exist.")
-        return f"Order {order_id} does not exist."
-
-    order.send_confirmation_email()
-
-    return f"Confirmation email sent for order {order_id} to {order.billing_email}."
-
-
-@shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_jitter=True, max_retries=5)
-def send_payment_instructions_email_task(order_id):
-    from .models import Order
-
-    try:
-        order = Order.objects.get(pk=order_id)
-    except Order.DoesNotExist:
-        logger.warning(f"Skipping payment instructions email task: order {order_id} does not exist.")
-        return f"Order {order_id} does not exist."
-
-    order.send_payment_instructions_email()
-    return f"Payment instructions email sent for order {order_id} to {order.billing_email}."
-
-@shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_jitter=True, max_retries=5)
-def send_refund_cancel_notification_email_task(order_id):
-    from .models import Order
-
-    try:
-        order = Order.objects.get(pk=order_id)
-    except Order.DoesNotExist:
-        logger.warning(f"Skipping refund notification email task: order {order_id} does not exist.")
-        return f"Order {order_id} does not exist."
+@shared_task
+def dispatch_email_outbox_task():
+    from .outbox import dispatch_outbox
 
-    order.send_refund_cancel_notification_email()
+    sent, failed = dispatch_outbox()
 
-    return f"Refund cancellation notification email sent for order {order_id} to {order.billing_email}."
+    message = f"Email outbox dispatched: {sent} sent, {failed} failed."
+    if sent or failed:
+        logger.info(message)
+    return message
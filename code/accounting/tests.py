@@ -1,3 +1,624 @@
-from django.test import TestCase
+import shutil
+import smtplib
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone, translation
+
+from payments import get_payment_model
+from payments.models import PaymentStatus
+
+from accounting.admin import OrderAdmin, TimedOutFilter
+from accounting.management.commands.celery import worker_commands
+from accounting.invoices import get_order_invoice, read_invoice_pdf
+from accounting.models import EmailOutbox, OrderInvoice, ServiceFee, ServiceFeeRulesVersion, get_order_create_defaults
+from accounting.outbox import claim, deliver, dispatch_outbox
+from accounting.tasks import delete_timed_out_orders_task
+from cinema_tickets import pdf_rendering
+from cinema_tickets.celery import app as celery_app
+from events.models import Event, Location, PriceClass, SoldAsStatus, Ticket
+from events.seating import allocate, release
+
+
+class DeleteTimedOutOrdersTaskTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Sweeper Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='Sweeper Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        self.event.price_classes.add(self.price_class)
+
+    def _create_order(self, session_id, ticket_count, minutes_ago, timeout=10):
+        order = get_payment_model().objects.create(
+            session_id=session_id,
+            status=PaymentStatus.WAITING,
+            **dict(get_order_create_defaults(), timeout=timeout),
+        )
+        order.update_tickets(allocate(self.event, self.price_class, ticket_count))
+        modified = timezone.now() - timedelta(minutes=minutes_ago)
+        get_payment_model().objects.filter(pk=order.pk).update(modified=modified, expires_at=modified + timedelta(minutes=timeout))
+        return order
+
+    def test_deletes_only_expired_orders_and_their_tickets(self):
+        expired = self._create_order('expired', 3, minutes_ago=15)
+        long_timeout = self._create_order('long-timeout', 2, minutes_ago=15, timeout=30)
+        fresh = self._create_order('fresh', 1, minutes_ago=1)
+
+        message = delete_timed_out_orders_task(chunk_size=1)
+
+        self.assertIn("deleted 1 timed-out orders and 3 tickets", message)
+        remaining_orders = set(get_payment_model().objects.values_list('pk', flat=True))
+        self.assertEqual(remaining_orders, {long_timeout.pk, fresh.pk})
+        self.assertFalse(Ticket.objects.filter(Tickets=expired.pk).exists())
+        self.assertEqual(Ticket.objects.filter(event=self.event).count(), 3)
+
+        self.event.refresh_from_db()
+        self.assertEqual(self.event.remaining_seats, 17)
+        total_stats, _ = self.event.calculate_statistics()
+        self.assertEqual(total_stats['waiting'], 3)
+
+    def test_reports_when_nothing_has_timed_out(self):
+        self._create_order('fresh', 1, minutes_ago=1)
+
+        self.assertEqual(delete_timed_out_orders_task(), "No timed-out orders found")
+
+
+class OrderExpiryTests(TestCase):
+
+    def setUp(self):
+        self.order = get_payment_model().objects.create(
+            session_id='expiry',
+            status=PaymentStatus.WAITING,
+            **dict(get_order_create_defaults(), timeout=10),
+        )
+
+    def test_save_and_reset_timeout_move_expires_at(self):
+        self.assertAlmostEqual(self.order.expires_at, timezone.now() + timedelta(minutes=10), delta=timedelta(seconds=5))
+
+        get_payment_model().objects.filter(pk=self.order.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.order.refresh_from_db()
+        self.assertTrue(self.order.has_timed_out)
+
+        self.order.reset_timeout()
+        self.order.refresh_from_db()
+        self.assertFalse(self.order.has_timed_out)
+
+    def test_timed_out_filter_uses_expires_at(self):
+        expired = get_payment_model().objects.create(
+            session_id='expired',
+            status=PaymentStatus.WAITING,
+            **get_order_create_defaults(),
+        )
+        get_payment_model().objects.filter(pk=expired.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        order_admin = OrderAdmin(get_payment_model(), admin.site)
+        queryset = get_payment_model().objects.all()
+
+        timed_out = TimedOutFilter(None, {'timed_out': ['yes']}, get_payment_model(), order_admin).queryset(None, queryset)
+        active = TimedOutFilter(None, {'timed_out': ['no']}, get_payment_model(), order_admin).queryset(None, queryset)
+
+        self.assertEqual(list(timed_out), [expired])
+        self.assertEqual(list(active), [self.order])
+
+    def test_timed_out_filter_and_sweeper_check_orders_without_expiry(self):
+        expired = get_payment_model().objects.create(
+            session_id='expired-legacy',
+            status=PaymentStatus.WAITING,
+            **get_order_create_defaults(),
+        )
+        get_payment_model().objects.filter(pk=expired.pk).update(expires_at=None, modified=timezone.now() - timedelta(minutes=11))
+        get_payment_model().objects.filter(pk=self.order.pk).update(expires_at=None)
+        order_admin = OrderAdmin(get_payment_model(), admin.site)
+        queryset = get_payment_model().objects.all()
+
+        timed_out = TimedOutFilter(None, {'timed_out': ['yes']}, get_payment_model(), order_admin).queryset(None, queryset)
+        active = TimedOutFilter(None, {'timed_out': ['no']}, get_payment_model(), order_admin).queryset(None, queryset)
+
+        self.assertEqual(list(timed_out), [expired])
+        self.assertEqual(list(active), [self.order])
+        delete_timed_out_orders_task()
+        self.assertEqual(list(get_payment_model().objects.all()), [self.order])
+
+    def test_backfill_sets_missing_expiry_from_modified(self):
+        get_payment_model().objects.filter(pk=self.order.pk).update(expires_at=None)
+
+        call_command('backfill_order_expiry', stdout=StringIO())
+
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.expires_at, self.order.modified + timedelta(minutes=10))
+
+
+class OrderTicketsEmailTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Bundle Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='Bundle Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        self.order = get_payment_model().objects.create(
+            session_id='bundle',
+            status=PaymentStatus.CONFIRMED,
+            **get_order_create_defaults(),
+        )
+        tickets = allocate(self.event, self.price_class, 3, email='family@example.com', sold_as=SoldAsStatus.PRESALE_ONLINE)
+        tickets += allocate(self.event, self.price_class, 1, email='friend@example.com', sold_as=SoldAsStatus.PRESALE_ONLINE)
+        self.order.tickets.add(*tickets)
+
+    def test_generate_pdf_tickets_has_one_page_per_ticket(self):
+        self.assertEqual(self.order.generate_pdf_tickets().pages_count, 4)
+
+    def test_send_tickets_email_sends_one_bundle_per_recipient(self):
+        self.assertEqual(self.order.send_tickets_email(), 2)
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['family@example.com', 'friend@example.com'])
+        self.assertTrue(all(len(message.attachments) == 1 for message in mail.outbox))
+
+    def test_ticket_bundles_are_rendered_through_the_pdf_queue(self):
+        self.addCleanup(pdf_rendering.shutdown)
+        with override_settings(PDF_RENDER_WORKERS=1, PDF_RENDER_MAX_PENDING=1):
+            _executor, pending = pdf_rendering._get_executor()
+            pending.acquire()
+            self.addCleanup(pending.release)
+
+            with self.assertRaises(pdf_rendering.PDFRenderBusy):
+                self.order.send_tickets_email()
+
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class OrderInvoiceTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.location = Location.objects.create(name='Invoice Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='Invoice Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        self.order = get_payment_model().objects.create(
+            session_id='invoice',
+            status=PaymentStatus.WAITING,
+            billing_email='buyer@example.com',
+            **get_order_create_defaults(),
+        )
+        self.order.tickets.add(*allocate(self.event, self.price_class, 2))
+
+    def test_invoice_is_rendered_once_per_order_state(self):
+        invoice = get_order_invoice(self.order)
+
+        with mock.patch.object(type(self.order), 'generate_pdf_invoice') as generate_pdf_invoice:
+            self.assertEqual(get_order_invoice(get_payment_model().objects.get(pk=self.order.pk)).pk, invoice.pk)
+        generate_pdf_invoice.assert_not_called()
+
+        self.order.status = PaymentStatus.CONFIRMED
+        self.order.save()
+        confirmed = get_order_invoice(self.order)
+
+        self.assertNotEqual(confirmed.pk, invoice.pk)
+        self.assertEqual(sorted(OrderInvoice.objects.values_list('state', flat=True)), ['confirmed', 'payment_instructions'])
+
+    def test_invoice_is_rendered_again_when_billing_data_changes(self):
+        invoice = get_order_invoice(self.order)
+        old_name = invoice.pdf.name
+
+        self.order.billing_last_name = 'Changed'
+        self.order.save()
+        updated = get_order_invoice(self.order)
+
+        self.assertEqual(updated.pk, invoice.pk)
+        self.assertNotEqual(updated.fingerprint, invoice.fingerprint)
+        self.assertFalse(updated.pdf.storage.exists(old_name))
+
+    def test_invoice_is_not_rendered_again_for_another_language(self):
+        with translation.override('de'):
+            invoice = get_order_invoice(self.order)
+
+        with translation.override('en'), mock.patch.object(type(self.order), 'generate_pdf_invoice') as generate_pdf_invoice:
+            self.assertEqual(get_order_invoice(self.order).fingerprint, invoice.fingerprint)
+        generate_pdf_invoice.assert_not_called()
+
+    def test_resending_payment_instructions_reuses_stored_invoice(self):
+        self.order.send_payment_instructions_email()
+        with mock.patch.object(type(self.order), 'generate_pdf_invoice') as generate_pdf_invoice:
+            self.order.send_payment_instructions_email()
+        generate_pdf_invoice.assert_not_called()
+
+        self.assertEqual(mail.outbox[0].attachments[0][1], mail.outbox[-1].attachments[0][1])
+        self.assertEqual(OrderInvoice.objects.count(), 1)
+
+    def test_download_supports_conditional_get(self):
+        url = reverse('show_generated_invoice', args=[self.order.session_id])
+
+        response = self.client.get(url)
+        content = b''.join(response.streaming_content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content, read_invoice_pdf(self.order).content)
+        self.assertEqual(response['ETag'], f'"{OrderInvoice.objects.get().content_hash}"')
+
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        not_modified = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+
+class CeleryQueueTests(TestCase):
+
+    def _queue(self, task_name):
+        return celery_app.amqp.router.route({}, task_name)['queue'].name
+
+    def test_tasks_are_routed_to_their_queues(self):
+        self.assertEqual(self._queue('accounting.tasks.dispatch_email_outbox_task'), 'mail')
+        self.assertEqual(self._queue('events.tasks.send_ticket_email_job_chunk_task'), 'mail')
+        self.assertEqual(self._queue('events.tasks.render_ticket_artifact_task'), 'pdf')
+        self.assertEqual(self._queue('events.tasks.send_global_statistics_report_task'), 'reports')
+        self.assertEqual(self._queue('accounting.tasks.delete_timed_out_orders_task'), 'maintenance')
+
+    def test_worker_commands_per_queue(self):
+        self.assertEqual(len(worker_commands()), 1)
+        self.assertIn('--beat', worker_commands()[0])
+
+        mail, reports = worker_commands(['mail', 'reports'], beat=True)
+        self.assertIn('--queues=mail ', mail)
+        self.assertIn('--concurrency=4', mail)
+        self.assertIn('--prefetch-multiplier=1', mail)
+        self.assertIn('--beat', mail)
+        self.assertNotIn('--beat', reports)
+        self.assertIn('--concurrency=2', worker_commands(['pdf'], concurrency=2)[0])
+
+    def test_maintenance_worker_consumes_default_queue_and_runs_beat(self):
+        mail, maintenance = worker_commands(['mail', 'maintenance'])
+
+        self.assertIn('--queues=maintenance,celery ', maintenance)
+        self.assertIn('--beat', maintenance)
+        self.assertNotIn('--beat', mail)
+        self.assertEqual(self._queue('unrouted.task'), 'celery')
+        self.assertNotIn('--beat', worker_commands(['maintenance'], beat=False)[0])
+
+
+class EmailOutboxTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        test_settings = override_settings(MEDIA_ROOT=self.media_root, EMAILS_ASYNC=True)
+        test_settings.enable()
+        self.addCleanup(test_settings.disable)
+        trigger = mock.patch('accounting.tasks.dispatch_email_outbox_task.apply_async')
+        self.trigger = trigger.start()
+        self.addCleanup(trigger.stop)
+
+        self.location = Location.objects.create(name='Outbox Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='Outbox Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        self.order = get_payment_model().objects.create(
+            session_id='outbox',
+            status=PaymentStatus.CONFIRMED,
+            billing_email='buyer@example.com',
+            **get_order_create_defaults(),
+        )
+        self.tickets = allocate(self.event, self.price_class, 2, email='buyer@example.com', sold_as=SoldAsStatus.PRESALE_ONLINE)
+        self.order.tickets.add(*self.tickets)
+
+    def test_emails_are_written_with_the_transaction(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.queue_confirmation_email()
+            self.tickets[0].queue_send_to_email()
+
+        self.assertEqual(EmailOutbox.objects.filter(status=EmailOutbox.STATUS_PENDING).count(), 2)
+        self.assertEqual(len(mail.outbox), 0)
+        self.trigger.assert_called()
+
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.order.queue_send_tickets_email()
+                raise RuntimeError('rolled back')
+        self.assertEqual(EmailOutbox.objects.count(), 2)
+
+    def test_dispatch_sends_due_emails_and_records_attempts(self):
+        self.order.queue_confirmation_email()
+        self.order.queue_send_tickets_email()
+        type(self.tickets[0]).queue_send_emails(self.tickets)
+        later = EmailOutbox.objects.create(
+            kind=EmailOutbox.KIND_ORDER_CONFIRMATION,
+            object_id=str(self.order.pk),
+            available_at=timezone.now() + timedelta(hours=1),
+        )
+
+        self.assertEqual(dispatch_outbox(batch_size=2), (4, 0))
+
+        self.assertEqual(len(mail.outbox), 4)
+        sent = EmailOutbox.objects.exclude(pk=later.pk)
+        self.assertTrue(all(entry.status == EmailOutbox.STATUS_SENT and entry.attempts == 1 for entry in sent))
+        later.refresh_from_db()
+        self.assertEqual(later.status, EmailOutbox.STATUS_PENDING)
+
+    def test_failed_emails_are_retried_later(self):
+        self.order.queue_confirmation_email()
+        missing = EmailOutbox.objects.create(kind=EmailOutbox.KIND_ORDER_TICKETS, object_id='0')
+
+        with mock.patch.object(type(self.order), 'send_confirmation_email', side_effect=OSError('relay down')):
+            self.assertEqual(dispatch_outbox(), (0, 2))
+
+        entry = EmailOutbox.objects.get(kind=EmailOutbox.KIND_ORDER_CONFIRMATION)
+        self.assertEqual(entry.status, EmailOutbox.STATUS_PENDING)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.last_error, 'relay down')
+        self.assertGreater(entry.available_at, timezone.now())
+        missing.refresh_from_db()
+        self.assertEqual(missing.status, EmailOutbox.STATUS_FAILED)
+
+    def test_claimed_emails_are_leased_and_recorded_one_by_one(self):
+        self.order.queue_confirmation_email()
+        self.order.queue_payment_instructions_email()
+        send_confirmation_email = type(self.order).send_confirmation_email
+
+        def send_while_claimed(order):
+            # the other claimed entry is leased, a second dispatcher does not send it again
+            self.assertEqual(dispatch_outbox(), (0, 0))
+            return send_confirmation_email(order)
+
+        with mock.patch.object(type(self.order), 'send_confirmation_email', autospec=True, side_effect=send_while_claimed), \
+                mock.patch.object(type(self.order), 'send_payment_instructions_email', side_effect=OSError('relay down')):
+            self.assertEqual(dispatch_outbox(), (1, 1))
+
+        sent = EmailOutbox.objects.get(kind=EmailOutbox.KIND_ORDER_CONFIRMATION)
+        self.assertEqual(sent.status, EmailOutbox.STATUS_SENT)
+        self.assertIsNotNone(sent.claimed_at)
+        failed = EmailOutbox.objects.get(kind=EmailOutbox.KIND_PAYMENT_INSTRUCTIONS)
+        self.assertEqual((failed.status, failed.attempts), (EmailOutbox.STATUS_PENDING, 1))
+
+    @override_settings(EMAIL_OUTBOX_LEASE=60)
+    def test_emails_of_a_dead_dispatcher_are_claimed_again(self):
+        self.order.queue_confirmation_email()
+        [claimed] = claim(10)
+        self.assertEqual(claim(10), [])
+
+        # the lease runs out without the first dispatcher recording the attempt
+        EmailOutbox.objects.filter(pk=claimed.pk).update(available_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(dispatch_outbox(), (1, 0))
+
+        # the first dispatcher comes back late, its result is not recorded
+        with mock.patch.object(type(self.order), 'send_confirmation_email', side_effect=OSError('relay down')):
+            self.assertFalse(deliver(claimed))
+
+        entry = EmailOutbox.objects.get(kind=EmailOutbox.KIND_ORDER_CONFIRMATION)
+        self.assertEqual((entry.status, entry.attempts, entry.last_error), (EmailOutbox.STATUS_SENT, 2, ''))
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_order_tickets_are_sent_and_retried_per_recipient(self):
+        friend = allocate(self.event, self.price_class, 1, email='friend@example.com', sold_as=SoldAsStatus.PRESALE_ONLINE)
+        self.order.tickets.add(*friend)
+        self.order.queue_send_tickets_email()
+
+        entries = EmailOutbox.objects.filter(kind=EmailOutbox.KIND_ORDER_TICKETS).order_by('recipient')
+        self.assertEqual([entry.recipient for entry in entries], ['buyer@example.com', 'friend@example.com'])
+
+        from accounting.models import send_messages
+
+        def refuse_friend(messages):
+            if any('friend@example.com' in message.to for message in messages):
+                raise smtplib.SMTPRecipientsRefused({'friend@example.com': (450, b'mailbox busy')})
+            return send_messages(messages)
+
+        with mock.patch('accounting.models.send_messages', side_effect=refuse_friend):
+            self.assertEqual(dispatch_outbox(), (1, 1))
+        EmailOutbox.objects.filter(status=EmailOutbox.STATUS_PENDING).update(available_at=timezone.now())
+        self.assertEqual(dispatch_outbox(), (1, 0))
+
+        self.assertEqual([message.to for message in mail.outbox], [['buyer@example.com'], ['friend@example.com']])
+
+
+class ServiceFeeRulesTests(TestCase):
+
+    def setUp(self):
+        # rule versions start over with every test, cached rules of earlier tests must not match
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.location = Location.objects.create(name='Fee Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='Fee Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.standard = PriceClass.objects.create(name='Standard', price='10.00')
+        self.reduced = PriceClass.objects.create(name='Reduced', price='6.00')
+        self.order = get_payment_model().objects.create(
+            session_id='fees',
+            variant='paypal',
+            **get_order_create_defaults(),
+        )
+        self.order.tickets.add(*allocate(self.event, self.standard, 2))
+        self.order.tickets.add(*allocate(self.event, self.reduced, 1))
+
+        self.booking_fee = ServiceFee.objects.create(
+            payment_method='paypal', display_name='Booking', fee_type='fixed_ticket', fee_amount='1.00', is_active=True,
+        )
+        self.booking_fee.price_classes.add(self.standard)
+        ServiceFee.objects.create(
+            payment_method='paypal', display_name='Handling', fee_type='percentage_ticket', fee_amount='10', is_active=True,
+        )
+        ServiceFee.objects.create(
+            payment_method='paypal', display_name='Provider', fee_type='percentage_total', fee_amount='5', is_active=True,
+        )
+        ServiceFee.objects.create(
+            payment_method='stripe', display_name='Card', fee_type='fixed_total', fee_amount='0.50', is_active=True,
+        )
+        ServiceFee.objects.create(
+            payment_method='stripe', display_name='Inactive', fee_type='fixed_total', fee_amount='9.00',
+        )
+
+    def test_fees_are_calculated_per_price_class(self):
+        ticket_level, total = self.order.get_service_fees()
+
+        # 2 x 1.00 booking for standard tickets, 10% of 26.00 handling, 5% of the 30.60 subtotal
+        self.assertEqual(ticket_level, {'Booking': Decimal('2.00'), 'Handling': Decimal('2.600')})
+        self.assertEqual(total, {'Provider': Decimal('1.53000')})
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='stripe'), Decimal('0.50'))
+
+    def test_fees_of_all_variants_take_one_query(self):
+        self.order.get_total_service_fee_amounts(['paypal'])
+
+        with CaptureQueriesContext(connection) as queries:
+            amounts = self.order.get_total_service_fee_amounts(['paypal', 'stripe', 'dummy'])
+
+        # rules version and ticket groups
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(amounts, {'paypal': Decimal('6.13000'), 'stripe': Decimal('0.50'), 'dummy': 0})
+
+    def test_rules_are_compiled_again_after_changes(self):
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='stripe'), Decimal('0.50'))
+
+        ServiceFee.objects.get(display_name='Card').delete()
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='stripe'), 0)
+
+        inactive = ServiceFee.objects.get(display_name='Inactive')
+        inactive.is_active = True
+        inactive.save()
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='stripe'), Decimal('9.00'))
+
+        # booking fee for all three tickets, 5% of the 31.60 subtotal
+        self.booking_fee.price_classes.add(self.reduced)
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='paypal'), Decimal('7.18000'))
+
+    def test_rules_follow_changes_of_other_processes(self):
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='stripe'), Decimal('0.50'))
+
+        # another process changes the fee and bumps the version, the cache of this one still holds the old rules
+        ServiceFee.objects.filter(display_name='Card').update(fee_amount='0.75')
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='stripe'), Decimal('0.50'))
+        ServiceFeeRulesVersion.objects.update(version=models.F('version') + 1)
+
+        self.assertEqual(self.order.get_total_service_fee_amount(variant='stripe'), Decimal('0.75'))
+
+
+class OrderTicketTotalsTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Cart Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='Cart Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.standard = PriceClass.objects.create(name='Standard', price='10.00')
+        self.reduced = PriceClass.objects.create(name='Reduced', price='6.50')
+
+        session = self.client.session
+        session['initialized'] = True
+        session.save()
+        self.order = get_payment_model().objects.create(
+            session_id=session.session_key,
+            **get_order_create_defaults(),
+        )
+
+    def assertTotals(self, ticket_count, subtotal):
+        self.assertEqual((self.order.ticket_count, self.order.subtotal), (ticket_count, Decimal(subtotal)))
+        stored = get_payment_model().objects.get(pk=self.order.pk)
+        self.assertEqual((stored.ticket_count, stored.subtotal), (ticket_count, Decimal(subtotal)))
+
+    def test_totals_follow_added_and_removed_tickets(self):
+        self.order.update_tickets(allocate(self.event, self.standard, 2))
+        reduced = allocate(self.event, self.reduced, 1)
+        self.order.update_tickets(reduced)
+        self.assertTotals(3, '26.50')
+        self.assertEqual(self.order.total, Decimal('26.50'))
+
+        self.order.delete_ticket(reduced[0])
+        self.assertTotals(2, '20.00')
+        self.assertEqual(self.order.total, Decimal('20.00'))
+
+        # removing a ticket that is not part of the order changes nothing
+        self.order.tickets.remove(reduced[0])
+        self.assertTotals(2, '20.00')
+
+        self.order.tickets.first().delete()
+        self.order.refresh_from_db()
+        self.assertTotals(1, '10.00')
+
+        self.order.tickets.clear()
+        self.assertTotals(0, '0')
+
+    def test_price_change_updates_open_orders(self):
+        self.order.update_tickets(allocate(self.event, self.standard, 2) + allocate(self.event, self.reduced, 1))
+        paid = get_payment_model().objects.create(session_id='paid', status=PaymentStatus.CONFIRMED, **get_order_create_defaults())
+        paid.update_tickets(allocate(self.event, self.standard, 1))
+
+        self.standard.price = Decimal('12.00')
+        self.standard.save()
+
+        self.order.refresh_from_db()
+        self.assertTotals(3, '30.50')
+        self.order.update_tickets()
+        self.assertEqual(self.order.total, Decimal('30.50'))
+        paid.refresh_from_db()
+        self.assertEqual(paid.subtotal, Decimal('10.00'))
+
+    def test_release_updates_order_totals_in_constant_queries(self):
+        other = get_payment_model().objects.create(session_id='other', **get_order_create_defaults())
+        other.update_tickets(allocate(self.event, self.reduced, 2))
+        self.order.update_tickets(allocate(self.event, self.standard, 3))
+
+        def release_queries(tickets):
+            with CaptureQueriesContext(connection) as queries:
+                release(tickets)
+            return len(queries)
+
+        # one ticket of each order and price class, then all the others
+        few = release_queries(Ticket.objects.filter(pk__in=[other.tickets.first().pk, self.order.tickets.first().pk]))
+        self.order.refresh_from_db()
+        self.order.update_tickets(allocate(self.event, self.standard, 12))
+        many = release_queries(Ticket.objects.filter(Tickets__in=[self.order.pk, other.pk]))
+
+        self.assertEqual(few, many)
+        for order in (self.order, other):
+            order.refresh_from_db()
+            self.assertEqual((order.ticket_count, order.subtotal), (0, Decimal('0')))
+
+    def test_cart_pages_do_not_write(self):
+        self.order.update_tickets(allocate(self.event, self.standard, 2))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('cart_view'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cart_ticket_count'], 2)
+        self.assertContains(response, '20.00')
+        writes = [query['sql'] for query in queries if not query['sql'].startswith('SELECT')]
+        self.assertFalse([sql for sql in writes if 'accounting_order' in sql], writes)
@@ -10,6 +10,8 @@ import logging
 
 from django.conf import settings
 from django.http import FileResponse, Http404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 # django-payments
 from payments import get_payment_model, RedirectNeeded
@@ -18,6 +20,7 @@ from payments.models import PaymentStatus
 from .forms import PaymentInfoForm
 from .forms import UpdateEmailsForm 
 from .models import get_order_create_defaults
+from .invoices import read_invoice_pdf
 
 from events.models import SoldAsStatus
 from accounting.admin import is_admin_or_accountant_user
@@ -64,8 +67,6 @@ def cart_view(request):
 
     time_remaining = order.get_remaining_time()
 
-    # recalculate total in case tickets were added or removed
-    order.compute_total(with_service_fees=False)
     return TemplateResponse(request, 'cart.html', {'form': form, 'order': order, 'time_remaining': time_remaining,
         'currency': settings.DEFAULT_CURRENCY})
 
@@ -85,9 +86,7 @@ def order_information_form(request):
         
     gateway_form = None  # Initialize gateway_form to None
 
-    service_fees = {}
-    for variant in settings.PAYMENT_VARIANTS.keys():
-        service_fees[variant] = order.get_total_service_fee_amount(variant=variant)
+    service_fees = order.get_total_service_fee_amounts(settings.PAYMENT_VARIANTS.keys())
 
     if request.method == 'POST':
         order.reset_timeout()
@@ -245,7 +244,8 @@ def user_confirm_order(request, order_id):
                     ticket.first_name = order.billing_first_name
                     ticket.last_name = order.billing_last_name
                     ticket.save()
-                    ticket.queue_send_to_email()
+                # send all tickets of the order in one email
+                order.queue_send_tickets_email()
                     
             else: 
                 # variant was advance payment therefore confirm the order
@@ -310,8 +310,9 @@ def ticket_list(request, order_id):
                 ticket.first_name = order.billing_first_name
                 ticket.last_name = order.billing_last_name
                 ticket.save()
-                if order.is_confirmed:
-                    ticket.queue_send_to_email()
+        if order.is_confirmed:
+            # send all tickets of the order in one email
+            order.queue_send_tickets_email()
 
         if not order.is_confirmed and order.variant == 'advance_payment':
             # Send payment instructions email (only for advance/bank-transfer payments)
@@ -351,13 +352,18 @@ def show_generated_invoice(request, order_id):
     # Fetch the ticket by ID
     order = get_object_or_404(get_payment_model(), session_id=order_id)
     
-    # Generate PDF for the selected ticket
-    pdf = order.generate_pdf_invoice()
-    # Create a BytesIO stream to hold the PDF data
-    file_stream = io.BytesIO(pdf.output())
-
-    # Create a FileResponse to send the PDF file
-    response = FileResponse(file_stream, content_type='application/pdf', filename=f"order_invoice_{order_id}.pdf")
+    # Stored invoice of the order for its current state (rendered now if missing or outdated)
+    invoice_pdf = read_invoice_pdf(order)
+    etag = quote_etag(invoice_pdf.content_hash)
+    last_modified = int(invoice_pdf.last_modified.timestamp())
+
+    # Answer with 304 Not Modified if the browser already has this invoice
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        # Create a FileResponse to send the PDF file
+        response = FileResponse(io.BytesIO(invoice_pdf.content), content_type='application/pdf', filename=f"order_invoice_{order_id}.pdf")
+    response.headers['ETag'] = etag
+    response.headers['Last-Modified'] = http_date(last_modified)
     
     return response
 
@@ -376,8 +382,9 @@ def admin_confirm_order(request, order_id):
         for ticket in order.tickets.all():
             ticket.sold_as = SoldAsStatus.PRESALE_ONLINE
             ticket.save()
-        
-            ticket.queue_send_to_email()
+
+        # send all tickets of the order in one email
+        order.queue_send_tickets_email()
             
         # Send confirmation and invoice email
         order.queue_confirmation_email()
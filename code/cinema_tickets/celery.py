@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from kombu import Exchange, Queue
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cinema_tickets.settings')
@@ -19,6 +20,61 @@ app.autodiscover_tasks()
 # Set the timezone for Celery
 app.conf.timezone = 'UTC'
 
+# Queues: transactional mails must not wait behind PDF renders, reports or sweeps.
+# Workers started without -Q consume all of them, see `manage.py celery --queue`.
+# The priorities only apply within a queue (RabbitMQ x-max-priority).
+# tasks without a route, e.g. from third-party apps
+DEFAULT_QUEUE = 'celery'
+MAIL_QUEUE = 'mail'
+PDF_QUEUE = 'pdf'
+REPORTS_QUEUE = 'reports'
+MAINTENANCE_QUEUE = 'maintenance'
+
+QUEUE_MAX_PRIORITY = 10
+
+app.conf.task_default_queue = DEFAULT_QUEUE
+app.conf.task_default_priority = 5
+app.conf.task_queues = [
+    Queue(DEFAULT_QUEUE, Exchange(DEFAULT_QUEUE), routing_key=DEFAULT_QUEUE),
+    *[
+        Queue(name, Exchange(name), routing_key=name, queue_arguments={'x-max-priority': QUEUE_MAX_PRIORITY})
+        for name in (MAIL_QUEUE, PDF_QUEUE, REPORTS_QUEUE, MAINTENANCE_QUEUE)
+    ],
+]
+app.conf.task_routes = {
+    # transactional mails to customers
+    'accounting.tasks.dispatch_email_outbox_task': {'queue': MAIL_QUEUE, 'priority': 9},
+    # bulk resends from the admin wait behind the emails of current sales
+    'events.tasks.send_ticket_email_job_chunk_task': {'queue': MAIL_QUEUE, 'priority': 4},
+    # PDF rendering
+    'events.tasks.render_ticket_artifact_task': {'queue': PDF_QUEUE, 'priority': 6},
+    # reporting
+    'events.tasks.send_global_statistics_report_task': {'queue': REPORTS_QUEUE, 'priority': 3},
+    # sweeping
+    'accounting.tasks.delete_timed_out_orders_task': {'queue': MAINTENANCE_QUEUE, 'priority': 1},
+}
+
+# The email outbox is dispatched after every commit that adds emails; the periodic run
+# sends emails whose trigger was lost (e.g. broker down) and retries failed ones.
+app.conf.beat_schedule = {
+    'dispatch-email-outbox': {
+        'task': 'accounting.tasks.dispatch_email_outbox_task',
+        'schedule': 60.0,
+    },
+}
+
+# Worker settings per queue for `manage.py celery --queue <name>`.
+# Mail workers mostly wait on SMTP, PDF and report workers are CPU bound.
+# A prefetch multiplier of 1 keeps long tasks from holding back queued ones.
+# The maintenance worker also takes the default queue and runs the periodic task
+# scheduler (beat), which the email outbox and the order sweep depend on.
+WORKER_PROFILES = {
+    MAIL_QUEUE: {'queues': [MAIL_QUEUE], 'concurrency': 4, 'prefetch_multiplier': 1},
+    PDF_QUEUE: {'queues': [PDF_QUEUE], 'concurrency': os.cpu_count() or 1, 'prefetch_multiplier': 1},
+    REPORTS_QUEUE: {'queues': [REPORTS_QUEUE], 'concurrency': 1, 'prefetch_multiplier': 1},
+    MAINTENANCE_QUEUE: {'queues': [MAINTENANCE_QUEUE, DEFAULT_QUEUE], 'concurrency': 1, 'prefetch_multiplier': 1, 'beat': True},
+}
+
 # Add a debug task for testing purposes
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
@@ -0,0 +1,174 @@
+"""
+Pooled mail sending.
+
+Every process (web or Celery worker) keeps one open mail connection per thread and
+reuses it for all emails instead of opening a new SMTP/TLS connection per message.
+A connection that was idle longer than ``MAIL_CONNECTION_KEEPALIVE`` seconds is
+checked with NOOP before it is used again, and a connection that fails while
+sending is reopened once and the remaining messages are sent over the new one.
+
+Inside ``batch()`` emails passed to ``send_email`` are only collected and are
+drained over the pooled connection when the block ends, e.g. by
+``events.models.send_ticket_emails`` so one connection carries the whole batch.
+
+A failure after some of the messages went out raises ``PartialSendError`` with the
+number of messages sent, so callers that retry can leave those out.
+"""
+
+from contextlib import contextmanager
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core import mail
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+_local = threading.local()
+
+
+def _is_connection_error(error):
+    # SMTP errors are OSErrors too, but only these two mean the connection is gone
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class PartialSendError(Exception):
+    """
+    Raised when sending fails after some of the messages were sent. ``sent`` is the number
+    of messages at the start of the list that were sent, the original error is the cause.
+    """
+
+    def __init__(self, sent, error):
+        super().__init__(f"{error} (after {sent} messages were sent)")
+        self.sent = sent
+
+
+def _keepalive():
+    return getattr(settings, 'MAIL_CONNECTION_KEEPALIVE', 30)
+
+
+def _is_alive(connection):
+    smtp = getattr(connection, 'connection', None)
+    if smtp is None:
+        # not opened yet, or a backend without a persistent connection
+        return True
+    try:
+        return smtp.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def get_connection():
+    """
+    Return the open mail connection of this thread, opening it on first use.
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.backend != settings.EMAIL_BACKEND:
+        # the configured backend changed (e.g. in tests)
+        close_connection()
+        connection = None
+    if connection is not None and time.monotonic() - _local.last_used > _keepalive() and not _is_alive(connection):
+        logger.info("Pooled mail connection went stale, reconnecting")
+        close_connection()
+        connection = None
+
+    if connection is None:
+        connection = mail.get_connection()
+        connection.open()
+        _local.connection = connection
+        _local.backend = settings.EMAIL_BACKEND
+    _local.last_used = time.monotonic()
+    return connection
+
+
+def close_connection():
+    """
+    Close the mail connection of this thread, the next email opens a new one.
+    """
+    connection = getattr(_local, 'connection', None)
+    _local.connection = None
+    if connection is not None:
+        try:
+            connection.close()
+        except Exception as e:
+            logger.warning(f"Error closing mail connection: {e}")
+
+
+def send_messages(messages):
+    """
+    Send the given email messages over the pooled connection. Returns the number of messages sent.
+
+    If the connection fails, it is reopened once and the unsent messages are sent again.
+    Any other error, or a second connection failure, is raised; as ``PartialSendError``
+    if messages were sent before.
+    """
+    messages = list(messages)
+    sent = 0
+    reconnected = False
+    while sent < len(messages):
+        connection = get_connection()
+        try:
+            for message in messages[sent:]:
+                # the backend keeps a connection open that it did not open itself
+                connection.send_messages([message])
+                sent += 1
+        except Exception as e:
+            if _is_connection_error(e):
+                close_connection()
+                if not reconnected:
+                    logger.warning(f"Mail connection failed after {sent} of {len(messages)} messages, reconnecting: {e}")
+                    reconnected = True
+                    continue
+            if sent:
+                raise PartialSendError(sent, e) from e
+            raise
+    _local.last_used = time.monotonic()
+    return sent
+
+
+def send_email(message):
+    """
+    Send one email message over the pooled connection, or collect it if called inside ``batch()``.
+    """
+    pending = getattr(_local, 'batch', None)
+    if pending is not None:
+        pending.append(message)
+        return
+    send_messages([message])
+
+
+@contextmanager
+def batch():
+    """
+    Collect the emails sent with ``send_email`` in this block and send them over one connection at the end.
+    Nothing is sent if the block raises. Nested blocks are drained by the outermost one.
+    """
+    if getattr(_local, 'batch', None) is not None:
+        yield
+        return
+
+    _local.batch = []
+    try:
+        yield
+        messages = _local.batch
+    finally:
+        _local.batch = None
+
+    batch_size = getattr(settings, 'MAIL_BATCH_SIZE', 100)
+    for start in range(0, len(messages), batch_size):
+        try:
+            send_messages(messages[start:start + batch_size])
+        except PartialSendError as e:
+            raise PartialSendError(start + e.sent, e.__cause__) from e.__cause__
+        except Exception as e:
+            if start:
+                raise PartialSendError(start, e) from e
+            raise
+    if messages:
+        logger.info(f"Sent {len(messages)} emails in one batch")
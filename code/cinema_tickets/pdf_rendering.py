@@ -0,0 +1,193 @@
+"""
+PDF rendering service.
+
+Tickets, invoices and statistics PDFs are rendered through ``render_pdf``. With
+``PDF_RENDER_WORKERS`` set, the rendering runs in a pool of worker processes so a
+request thread only waits for the finished bytes instead of holding the GIL while
+fpdf lays out pages. This is meant for synchronous deployments (``EMAILS_ASYNC``
+off) where no Celery worker takes the rendering off the request.
+
+Workers are started with ``spawn``, run ``django.setup()`` once and import fpdf and
+qrcode up front. At most ``PDF_RENDER_MAX_PENDING`` jobs are queued; beyond that
+``render_pdf`` raises ``PDFRenderBusy`` instead of rendering in the request thread,
+so the pool bounds the number of concurrent renderings. PDFs are only rendered
+inline when the pool is disabled or broken.
+
+Each job waits at most ``PDF_RENDER_TIMEOUT`` seconds. A job that runs longer cannot
+be cancelled, so its pool is shut down and its worker processes are terminated; the
+next job starts a new pool.
+
+``PDFRenderingUnavailableMiddleware`` answers requests that fail with either error
+with "503 Service Unavailable".
+
+Jobs are model instances plus the method that builds the FPDF document, e.g.
+``render_pdf(Ticket.generate_pdf_ticket, ticket)``. The worker reads related rows
+that are not already loaded on the instance from the database, so only committed
+data is visible there.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import atexit
+import multiprocessing
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import translation
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PDFRenderTimeout(Exception):
+    pass
+
+
+class PDFRenderBusy(Exception):
+    pass
+
+
+class PDFRenderingUnavailableMiddleware:
+    """
+    Answer requests whose PDF could not be rendered in time with 503 instead of an error page.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, (PDFRenderBusy, PDFRenderTimeout)):
+            response = HttpResponse(str(exception), status=503, content_type='text/plain')
+            response['Retry-After'] = '5'
+            return response
+        return None
+
+
+_executor = None
+_pending = None
+_lock = threading.Lock()
+
+
+def _init_worker():
+    import django
+
+    django.setup()
+
+    # warm up the PDF libraries so the first job does not pay for the imports
+    import fpdf  # noqa: F401
+    import qrcode  # noqa: F401
+
+
+def _warm_up():
+    return True
+
+
+def _render_in_worker(build, args, kwargs, language):
+    from django.db import close_old_connections
+
+    close_old_connections()
+    try:
+        with translation.override(language):
+            return bytes(build(*args, **kwargs).output())
+    finally:
+        close_old_connections()
+
+
+def _get_executor():
+    """
+    Return ``(executor, pending)`` of the worker pool, starting it on first use, or ``(None, None)`` if it is disabled.
+    """
+    global _executor, _pending
+
+    workers = getattr(settings, 'PDF_RENDER_WORKERS', 0)
+    if workers <= 0 or multiprocessing.parent_process() is not None:
+        # disabled, or already inside a worker process
+        return None, None
+
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            )
+            _pending = threading.BoundedSemaphore(getattr(settings, 'PDF_RENDER_MAX_PENDING', workers * 4))
+            for _worker in range(workers):
+                _executor.submit(_warm_up)
+            logger.info(f"Started PDF rendering pool with {workers} workers")
+        return _executor, _pending
+
+
+def shutdown(wait=True):
+    """
+    Stop the worker processes, they are started again on the next job.
+    """
+    global _executor
+
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def _terminate(executor):
+    """
+    Shut down the given pool without waiting for its running jobs and terminate its worker processes.
+    """
+    global _executor
+
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    # the pool has no public way to stop a running job
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    logger.warning(f"Terminated PDF rendering pool with {len(processes)} workers")
+
+
+atexit.register(shutdown, wait=False)
+
+
+def render_pdf(build, *args, **kwargs):
+    """
+    Return ``bytes(build(*args, **kwargs).output())``, rendered in the worker pool if it is enabled.
+
+    Raises ``PDFRenderBusy`` if ``PDF_RENDER_MAX_PENDING`` jobs are already queued and
+    ``PDFRenderTimeout`` if the worker takes longer than ``PDF_RENDER_TIMEOUT`` seconds.
+    """
+    executor, pending = _get_executor()
+    if executor is None:
+        return bytes(build(*args, **kwargs).output())
+    if not pending.acquire(blocking=False):
+        logger.warning(f"PDF rendering queue is full, rejected {getattr(build, '__qualname__', build)}")
+        raise PDFRenderBusy("Too many PDFs are being rendered, please try again in a moment.")
+
+    try:
+        future = executor.submit(_render_in_worker, build, args, kwargs, translation.get_language())
+    except (BrokenProcessPool, RuntimeError) as e:
+        pending.release()
+        logger.error(f"PDF rendering pool is not available, rendering inline: {e}")
+        shutdown(wait=False)
+        return bytes(build(*args, **kwargs).output())
+    future.add_done_callback(lambda _future: pending.release())
+
+    timeout = getattr(settings, 'PDF_RENDER_TIMEOUT', 30)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        logger.error(f"Rendering {getattr(build, '__qualname__', build)} timed out after {timeout} seconds")
+        if not future.cancel():
+            # already running, only stopping the worker frees it
+            _terminate(executor)
+        raise PDFRenderTimeout(f"PDF rendering timed out after {timeout} seconds")
+    except BrokenProcessPool as e:
+        logger.error(f"PDF rendering pool broke, rendering inline: {e}")
+        shutdown(wait=False)
+        return bytes(build(*args, **kwargs).output())
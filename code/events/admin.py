@@ -1,5 +1,5 @@
 from django.contrib import admin, messages
-from .models import Location, PriceClass, Event, Ticket, TicketMaster, TicketChecker
+from .models import Location, PriceClass, Event, Ticket, TicketEmailJob, TicketMaster, TicketChecker
 from .models import get_user_active_locations, is_ticket_manager_user, is_admin_user
 
 from django.urls import reverse
@@ -290,13 +290,54 @@ class TicketAdmin(admin.ModelAdmin):
     send_ticket_email_single.allow_tags = True
 
     def send_ticket_email_selected(self, request, queryset):
-        for ticket in queryset:
-            if ticket.email:
-                ticket.send_to_email()
-        self.message_user(request, "Emails sent successfully.")
+        # send in the background, the job page shows the progress
+        job = TicketEmailJob.start(queryset, user=request.user)
+        job_url = reverse('admin:events_ticketemailjob_change', args=[job.pk])
+        self.message_user(
+            request,
+            format_html('Sending {} ticket emails in the background. <a href="{}">Show progress</a>', job.total, job_url),
+        )
 
     send_ticket_email_selected.short_description = "Send Ticket Email"
 
+@admin.register(TicketEmailJob)
+class TicketEmailJobAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'created_by', 'status', 'show_progress', 'sent', 'failed', 'total', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('created_at', 'created_by', 'status', 'show_progress', 'sent', 'failed', 'total', 'finished_at')
+    fields = readonly_fields
+
+    def has_view_permission(self, request, obj=None):
+        """Allow superusers and users in 'admin' group and 'ticketmaster' group to view."""
+        if request.user.is_superuser:
+            return True
+        if is_admin_user(request.user) or is_ticket_manager_user(request.user):
+            return True
+        return False
+
+    def has_add_permission(self, request):
+        # jobs are started from the ticket list
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        """Allow superusers and users in 'admin' group to delete."""
+        if request.user.is_superuser:
+            return True
+        if is_admin_user(request.user):
+            return True
+        return False
+
+    def show_progress(self, obj):
+        return format_html(
+            '<progress value="{}" max="100"></progress> {}%',
+            obj.progress, obj.progress,
+        )
+
+    show_progress.short_description = 'Progress'
+
 @admin.register(Event)
 class EventAdmin(admin.ModelAdmin):
     list_display = ('name', 'start_time', 'location')
@@ -0,0 +1,116 @@
+"""
+Stored ticket PDFs.
+
+Once a ticket is sold for good (its ``sold_as`` is no longer pending) its PDF is
+rendered once and written to media storage as a ``TicketArtifact``, named after
+the hash of its content. Downloads and emails read the stored bytes instead of
+rendering the ticket again.
+
+Each artifact remembers a fingerprint of everything printed on the ticket (holder,
+seat, price class, event, location and branding). It is only rendered again when
+that fingerprint changes. A ticket has one stored PDF, so it is always rendered in
+the site language (``LANGUAGE_CODE``), whatever the language of the request.
+"""
+
+from collections import namedtuple
+import hashlib
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.utils import translation
+
+from .models import SoldAsStatus, TicketArtifact
+from .ticket_template import ticket_pdf_bytes, ticket_render_key
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+TicketPdf = namedtuple('TicketPdf', ['content', 'content_hash', 'last_modified'])
+
+
+def is_final(ticket):
+    """
+    Return whether the ticket PDF can be stored, i.e. the ticket is no longer waiting for a payment.
+    """
+    return ticket.sold_as not in SoldAsStatus.PENDING
+
+
+def ticket_fingerprint(ticket):
+    """
+    Return a hash of everything printed on the stored ticket PDF.
+    """
+    with translation.override(settings.LANGUAGE_CODE):
+        return hashlib.sha256(repr(ticket_render_key(ticket)).encode()).hexdigest()
+
+
+def store_ticket_artifact(ticket, fingerprint=None):
+    """
+    Render the ticket PDF and store it, replacing a previously stored PDF of the ticket.
+    """
+    fingerprint = fingerprint or ticket_fingerprint(ticket)
+    with translation.override(settings.LANGUAGE_CODE):
+        content = ticket_pdf_bytes(ticket)
+    content_hash = hashlib.sha256(content).hexdigest()
+
+    artifact = TicketArtifact.objects.filter(ticket=ticket).first()
+    if artifact is not None and artifact.content_hash == content_hash:
+        # same PDF as before, only remember the new fingerprint
+        artifact.fingerprint = fingerprint
+        artifact.save(update_fields=['fingerprint', 'rendered_at'])
+        return artifact
+
+    old_name = artifact.pdf.name if artifact is not None else None
+    if artifact is None:
+        artifact = TicketArtifact(ticket=ticket)
+    artifact.pdf.save(f"ticket_{ticket.pk}_{content_hash[:16]}.pdf", ContentFile(content), save=False)
+    artifact.content_hash = content_hash
+    artifact.fingerprint = fingerprint
+    try:
+        with transaction.atomic():
+            artifact.save()
+    except IntegrityError:
+        # stored concurrently by another worker
+        artifact.pdf.delete(save=False)
+        return TicketArtifact.objects.get(ticket=ticket)
+
+    if old_name and old_name != artifact.pdf.name:
+        artifact.pdf.storage.delete(old_name)
+    logger.debug(f"Stored ticket PDF for ticket {ticket.pk} ({content_hash[:12]})")
+    return artifact
+
+
+def get_ticket_artifact(ticket):
+    """
+    Return the stored PDF of the ticket, rendering it if it is missing or outdated.
+    """
+    fingerprint = ticket_fingerprint(ticket)
+    artifact = TicketArtifact.objects.filter(ticket=ticket).first()
+    if artifact is not None and artifact.fingerprint == fingerprint:
+        return artifact
+    return store_ticket_artifact(ticket, fingerprint)
+
+
+def read_ticket_pdf(ticket):
+    """
+    Return the PDF of the ticket as ``TicketPdf``.
+
+    Final tickets are read from their stored artifact; tickets still waiting for a
+    payment are rendered (through the in-process cache) and have no ``last_modified``.
+    """
+    if not is_final(ticket):
+        content = ticket_pdf_bytes(ticket)
+        return TicketPdf(content, hashlib.sha256(content).hexdigest(), None)
+
+    artifact = get_ticket_artifact(ticket)
+    try:
+        with artifact.pdf.open('rb') as stored:
+            content = stored.read()
+    except OSError:
+        logger.warning(f"Stored ticket PDF {artifact.pdf.name} is missing, rendering it again")
+        artifact = store_ticket_artifact(ticket)
+        with artifact.pdf.open('rb') as stored:
+            content = stored.read()
+    return TicketPdf(content, artifact.content_hash, artifact.rendered_at)
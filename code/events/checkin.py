@@ -0,0 +1,280 @@
+"""
+Ticket check-in at the door.
+
+A scanned ticket is activated with one conditional UPDATE that only matches a sold,
+not yet activated ticket of the event. Whichever gate's UPDATE changes the row wins;
+a second scan of the same ticket, even at the same moment, matches no row and is
+reported as already used. The ticket details shown at the gate are read with one
+narrow query afterwards; an activation then takes the next change number and moves
+the statistics counters with one UPDATE each.
+
+For gates without a reliable connection, ``event_manifest`` lists the sold tickets of
+an event in a compact form the scanner page caches to check scans locally. The
+scans collected offline are sent back in batches to ``sync_scans``, which applies
+them in one transaction. A scan only activates a ticket that is not activated and
+was not changed after the scan (last writer wins); everything else is reported back
+as a conflict.
+
+Every ticket whose sold status or activation changes gets the next number of the
+change sequence of its event (kept on ``EventInventory``). The manifest carries the
+current number as cursor and ``event_changes`` returns the tickets changed after a
+cursor, so the gates of an event keep each other's scans in sync by polling.
+
+The ticket table of the check-in page is loaded page by page from ``ticket_page``,
+ordered by seat and paged with a (seat, id) cursor instead of an offset.
+"""
+
+from collections import Counter, namedtuple
+import uuid
+
+from django.db import models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import EventInventory, SoldAsStatus, Ticket
+from .qr import InvalidQRCode, decode_ticket_qr
+from .seating import next_change_seq
+from .statistics import apply_ticket_deltas
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+CHECKIN_SUCCESS = 'success'
+CHECKIN_ALREADY_USED = 'already_used'
+CHECKIN_NOT_SOLD = 'not_sold'
+CHECKIN_NOT_FOUND = 'not_found'
+# an offline scan older than the last change of the ticket, e.g. a manual deactivation
+CHECKIN_STALE = 'stale'
+CHECKIN_INVALID = 'invalid'
+
+CHECKIN_CONFLICTS = [CHECKIN_ALREADY_USED, CHECKIN_STALE]
+
+# hex digits of the ticket id listed in the manifest
+MANIFEST_ID_PREFIX_LENGTH = 12
+MAX_SYNC_SCANS = 1000
+MAX_CHANGES = 500
+TICKET_PAGE_SIZE = 50
+MAX_TICKET_PAGE_SIZE = 200
+
+# tickets that are paid for and may enter
+CHECKIN_SOLD_AS = [SoldAsStatus.PRESALE_ONLINE, SoldAsStatus.PRESALE_DOOR, SoldAsStatus.DOOR]
+
+TICKET_DETAIL_FIELDS = ('id', 'first_name', 'last_name', 'seat', 'sold_as', 'activated', 'price_class_id', 'price_class__name')
+
+CheckIn = namedtuple('CheckIn', ['status', 'ticket'])
+SyncResult = namedtuple('SyncResult', ['code', 'status', 'ticket_id', 'activation_changed_at'])
+
+
+def check_in(event_id, ticket_id):
+    """
+    Activate the ticket for the event. Returns ``CheckIn(status, ticket)`` with the ticket
+    details as a dict of ``TICKET_DETAIL_FIELDS``; the ticket is ``None`` if it was not found.
+    """
+    try:
+        ticket_id = uuid.UUID(str(ticket_id))
+    except ValueError:
+        return CheckIn(CHECKIN_NOT_FOUND, None)
+
+    tickets = Ticket.objects.filter(pk=ticket_id, event_id=event_id)
+    with transaction.atomic():
+        activated = tickets.filter(activated=False, sold_as__in=CHECKIN_SOLD_AS).update(
+            activated=True,
+            activation_changed_at=timezone.now(),
+        )
+        ticket = tickets.values(*TICKET_DETAIL_FIELDS).first()
+        if activated:
+            # the update bypasses Ticket.save(), move the ticket in the change sequence and the statistics here
+            inventory = EventInventory.objects.filter(event_id=event_id)
+            if inventory.update(change_seq=models.F('change_seq') + 1, stats_version=models.F('stats_version') + 1):
+                tickets.update(change_seq=models.Subquery(inventory.values('change_seq')[:1]))
+                _move_to_activated(event_id, [ticket], bump_version=False)
+            else:
+                tickets.update(change_seq=next_change_seq(event_id))
+                _move_to_activated(event_id, [ticket])
+            return CheckIn(CHECKIN_SUCCESS, ticket)
+
+    if ticket is None:
+        return CheckIn(CHECKIN_NOT_FOUND, None)
+    if ticket['activated']:
+        return CheckIn(CHECKIN_ALREADY_USED, ticket)
+    logger.info(f"Rejected check-in of ticket {ticket_id} sold as {ticket['sold_as']}")
+    return CheckIn(CHECKIN_NOT_SOLD, ticket)
+
+
+def _move_to_activated(event_id, tickets, bump_version=True):
+    """
+    Move the given ticket rows from not activated to activated in the statistics, in one UPDATE.
+    """
+    deltas = {}
+    for (price_class_id, sold_as), count in Counter((ticket['price_class_id'], ticket['sold_as']) for ticket in tickets).items():
+        deltas[(price_class_id, sold_as, False)] = -count
+        deltas[(price_class_id, sold_as, True)] = count
+    apply_ticket_deltas(event_id, deltas, bump_version=bump_version)
+
+
+def event_manifest(event):
+    """
+    Return the check-in manifest of the event: its sold tickets as
+    ``[id prefix, seat, price class id, activated]`` rows, read in one query.
+    """
+    # read the cursor first, changes committed while the tickets are read come after it
+    cursor = EventInventory.objects.filter(event=event).values_list('change_seq', flat=True).first() or 0
+    rows = Ticket.objects.filter(event=event, sold_as__in=CHECKIN_SOLD_AS).order_by('seat').values_list(
+        'id', 'seat', 'price_class_id', 'price_class__name', 'activated',
+    )
+    price_classes = {}
+    tickets = []
+    for ticket_id, seat, price_class_id, price_class_name, activated in rows:
+        price_classes[str(price_class_id)] = price_class_name
+        tickets.append([ticket_id.hex[:MANIFEST_ID_PREFIX_LENGTH], seat, price_class_id, int(activated)])
+    return {
+        'event': str(event.pk),
+        'generated_at': timezone.now().isoformat(),
+        'cursor': cursor,
+        'id_prefix_length': MANIFEST_ID_PREFIX_LENGTH,
+        'fields': ['id', 'seat', 'price_class', 'activated'],
+        'price_classes': price_classes,
+        'tickets': tickets,
+    }
+
+
+def sync_scans(event_id, scans):
+    """
+    Apply a batch of offline scans, each a dict with the scanned ``code`` and its ``scanned_at`` time,
+    in one transaction. Returns a ``SyncResult`` per scan, in the order of the scans.
+    """
+    now = timezone.now()
+    results = [None] * len(scans)
+    decoded = []
+    for index, scan in enumerate(scans):
+        code = scan.get('code')
+        try:
+            ticket_id = decode_ticket_qr(code, event_id)
+        except InvalidQRCode:
+            results[index] = SyncResult(code, CHECKIN_INVALID, None, None)
+            continue
+        scanned_at = parse_datetime(str(scan.get('scanned_at') or '')) or now
+        if timezone.is_naive(scanned_at):
+            scanned_at = timezone.make_aware(scanned_at)
+        # a device clock running ahead must not win over later changes
+        decoded.append((min(scanned_at, now), index, code, ticket_id))
+
+    with transaction.atomic():
+        tickets = {
+            ticket['id']: ticket
+            for ticket in Ticket.objects.select_for_update().filter(
+                event_id=event_id, pk__in={ticket_id for *_scan, ticket_id in decoded},
+            ).values('id', 'activated', 'activation_changed_at', 'sold_as', 'price_class_id')
+        }
+
+        activated = {}
+        # oldest scan first, so the first entry of a ticket wins and later ones are conflicts
+        for scanned_at, index, code, ticket_id in sorted(decoded, key=lambda scan: scan[:2]):
+            ticket = tickets.get(ticket_id)
+            if ticket is None:
+                status = CHECKIN_NOT_FOUND
+            elif ticket['sold_as'] not in CHECKIN_SOLD_AS:
+                status = CHECKIN_NOT_SOLD
+            elif ticket['activated']:
+                status = CHECKIN_ALREADY_USED
+            elif ticket['activation_changed_at'] is not None and ticket['activation_changed_at'] >= scanned_at:
+                status = CHECKIN_STALE
+            else:
+                status = CHECKIN_SUCCESS
+                ticket['activated'] = True
+                ticket['activation_changed_at'] = scanned_at
+                activated[ticket_id] = ticket
+            changed_at = ticket['activation_changed_at'] if ticket is not None else None
+            results[index] = SyncResult(code, status, ticket_id if ticket is not None else None, changed_at)
+
+        if activated:
+            first_change_seq = next_change_seq(event_id, len(activated)) - len(activated) + 1
+            Ticket.objects.filter(pk__in=activated).update(
+                activated=True,
+                activation_changed_at=models.Case(
+                    *[models.When(pk=ticket_id, then=models.Value(ticket['activation_changed_at'])) for ticket_id, ticket in activated.items()],
+                    output_field=models.DateTimeField(),
+                ),
+                change_seq=models.Case(
+                    *[models.When(pk=ticket_id, then=models.Value(first_change_seq + offset)) for offset, ticket_id in enumerate(activated)],
+                    output_field=models.BigIntegerField(),
+                ),
+            )
+            _move_to_activated(event_id, activated.values())
+
+    logger.info(f"Synced {len(scans)} offline scans for event {event_id}, {len(activated)} tickets activated")
+    return results
+
+
+def event_changes(event_id, since, limit=MAX_CHANGES):
+    """
+    Return the tickets of the event changed after the cursor ``since``, oldest change first,
+    as manifest rows plus whether the ticket may still enter and its full id.
+    """
+    rows = list(
+        Ticket.objects.filter(event_id=event_id, change_seq__gt=since).order_by('change_seq').values_list(
+            'id', 'seat', 'price_class_id', 'price_class__name', 'activated', 'sold_as', 'change_seq',
+        )[:limit + 1]
+    )
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    price_classes = {}
+    changes = []
+    for ticket_id, seat, price_class_id, price_class_name, activated, sold_as, _change_seq in rows:
+        price_classes[str(price_class_id)] = price_class_name
+        changes.append([
+            ticket_id.hex[:MANIFEST_ID_PREFIX_LENGTH], seat, price_class_id, int(activated),
+            int(sold_as in CHECKIN_SOLD_AS), str(ticket_id),
+        ])
+    return {
+        'cursor': rows[-1][-1] if rows else since,
+        'more': more,
+        'fields': ['id', 'seat', 'price_class', 'activated', 'valid', 'ticket_id'],
+        'price_classes': price_classes,
+        'changes': changes,
+    }
+
+
+def filter_tickets(tickets, search=None, name=None, email=None, seat=None, price_class=None, activated=None):
+    """
+    Filter the ticket queryset by the check-in list filters, skipping empty ones.
+    ``search`` matches the name, email or seat of the ticket.
+    """
+    if search:
+        query = (models.Q(first_name__icontains=search) | models.Q(last_name__icontains=search)
+                 | models.Q(email__icontains=search))
+        if search.isdigit():
+            query |= models.Q(seat=int(search))
+        tickets = tickets.filter(query)
+    if name:
+        tickets = tickets.filter(models.Q(first_name__icontains=name) | models.Q(last_name__icontains=name))
+    if email:
+        tickets = tickets.filter(email__icontains=email)
+    if seat is not None:
+        tickets = tickets.filter(seat=seat)
+    if price_class is not None:
+        tickets = tickets.filter(price_class_id=price_class)
+    if activated is not None:
+        tickets = tickets.filter(activated=activated)
+    return tickets
+
+
+def ticket_page(tickets, after=None, limit=TICKET_PAGE_SIZE):
+    """
+    Return ``(tickets, next cursor)`` of the page of the ticket queryset after the cursor.
+    The cursor is ``"<seat>:<ticket id>"`` of the last ticket of the previous page, or ``None``.
+    Raises ``ValueError`` for a malformed cursor.
+    """
+    if after:
+        seat, ticket_id = after.split(':', 1)
+        seat, ticket_id = int(seat), uuid.UUID(ticket_id)
+        tickets = tickets.filter(models.Q(seat__gt=seat) | models.Q(seat=seat, pk__gt=ticket_id))
+
+    page = list(tickets.select_related('price_class').order_by('seat', 'pk')[:limit + 1])
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    return page, f"{page[-1].seat}:{page[-1].pk}"
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext_lazy as _
+from events.models import Event
+from events.statistics import rebuild_rollups
+
+class Command(BaseCommand):
+    help = _('Recount the ticket statistics rollups from the tickets')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', action='append', dest='event_ids', help=_('Only rebuild the given event id (can be repeated)'))
+
+    def handle(self, *args, **kwargs):
+        events = Event.objects.all()
+        if kwargs['event_ids']:
+            events = events.filter(pk__in=kwargs['event_ids'])
+        count = rebuild_rollups(events)
+        self.stdout.write(f"Rebuilt {count} statistics rollups")
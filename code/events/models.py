@@ -10,9 +10,6 @@ from django.utils import timezone as django_timezone
 from datetime import datetime, timedelta, timezone
 
 from fpdf import FPDF
-import qrcode
-import os
-import tempfile
 import uuid
 
 import logging
@@ -20,6 +17,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from branding.models import get_active_branding
+from cinema_tickets.mail import send_email
 
 BOOTSTRAP_COLORS = [
     ("#0d6efd", _("Blue")),
@@ -48,6 +46,9 @@ class SoldAsStatus:
         (DOOR, _("Door")),
     ]
 
+    # tickets in these states hold a seat but are not paid yet
+    PENDING = [WAITING, PRESALE_ONLINE_WAITING]
+
 class Location(models.Model):
     """
     Global location model for events.
@@ -111,9 +112,52 @@ class PriceClass(models.Model):
     # optional field to make secret price classes, only shown to staff/door selling
     secret = models.BooleanField(_("secret"), default=False)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # keep the revenue of the statistics in line with the current price
+        TicketStatsRollup.objects.filter(price_class=self).update(revenue=models.F('count') * self.price)
+        # and the subtotal of the orders that are not paid yet
+        from payments import get_payment_model
+
+        get_payment_model().refresh_price_class_totals(self)
+
     def __str__(self):
         return f"{self.name} - {self.price} {settings.DEFAULT_CURRENCY}"
 
+def new_ticket_pdf():
+    """
+    Create an empty ticket PDF; tickets are added as pages with Ticket.add_pdf_page().
+    """
+    pdf = FPDF(unit="cm", format=(21.0, 8.5))  # Standard event ticket size
+    pdf.set_margins(0.5, 0.5)  # Set margins 
+    pdf.set_auto_page_break(auto=True, margin=0.2)  # Enable auto page break with a margin of 0.2 cm
+    # Set font for the PDF
+    pdf.set_font("Helvetica")
+    return pdf
+
+def send_ticket_emails(ticket_ids):
+    """
+    Send the emails of the given tickets, collected into one batch. Returns the number of tickets sent.
+    """
+    from cinema_tickets.mail import batch
+
+    tickets = Ticket.objects.filter(pk__in=ticket_ids).select_related('event__location', 'price_class')
+    with batch():
+        for ticket in tickets:
+            ticket.send_to_email()
+    return len(tickets)
+
+
+def generate_pdf_tickets(tickets):
+    """
+    Generate one PDF with a page for each of the given tickets.
+    Backgrounds and fonts are embedded once and shared by all pages.
+    """
+    pdf = new_ticket_pdf()
+    for ticket in tickets:
+        ticket.add_pdf_page(pdf)
+    return pdf
+
 class Ticket(models.Model):
     """
     Global ticket model.
@@ -132,13 +176,81 @@ class Ticket(models.Model):
 
     # ticket activation
     activated = models.BooleanField(_("activated"), default=False)  # ticket is activated
-    
+    # last time the ticket was activated or deactivated, decides between offline scans and later changes
+    activation_changed_at = models.DateTimeField(_("activation changed at"), null=True, blank=True, editable=False)
+    # position in the check-in change sequence of the event, see events.checkin
+    change_seq = models.BigIntegerField(_("change sequence"), default=0, editable=False)
+
+    class Meta:
+        indexes = [
+            # check-in change feed: tickets of an event changed since a cursor
+            models.Index(fields=['event', 'change_seq'], name='ticket_event_change_seq_idx'),
+            # check-in list: sold tickets of an event
+            models.Index(fields=['event', 'sold_as'], name='ticket_event_sold_as_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored values so that save() can detect what changed
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
     def save(self, *args, **kwargs):
-        # Automatically assign the next available seat number for this event
-        if not self.seat:
-            last_ticket = Ticket.objects.filter(event=self.event).order_by('seat').last()
-            self.seat = last_ticket.seat + 1 if last_ticket else 1  # Start with seat 1 if no tickets exist
-        super().save(*args, **kwargs)  # Call the superclass save method
+        from .seating import adjust_inventory, next_change_seq, reserve_seats
+        from .statistics import apply_ticket_delta
+
+        adding = self._state.adding
+        with transaction.atomic():
+            # Automatically assign the next available seat number for this event
+            if not self.seat:
+                self.seat = reserve_seats(self.event, 1)
+            if self.activated != self.stored_stats_key()[3] or (adding and self.activated):
+                self.activation_changed_at = django_timezone.now()
+            if adding or self.stored_stats_key()[2:] != self.stats_key()[2:]:
+                # sold status or activation changed: tell the check-in devices
+                self.change_seq = next_change_seq(self.event_id)
+            super().save(*args, **kwargs)  # Call the superclass save method
+
+            stats_key = self.stats_key()
+            # the ticket is sold for good: its PDF can be rendered and stored
+            became_final = self.sold_as not in SoldAsStatus.PENDING and (
+                adding or self.stored_stats_key()[2] in SoldAsStatus.PENDING
+            )
+            if adding:
+                # keep the seat counter ahead of manually entered seat numbers
+                EventInventory.objects.filter(event_id=self.event_id, last_seat__lt=self.seat).update(last_seat=self.seat)
+                adjust_inventory(self.event_id, self.sold_as, 1)
+                apply_ticket_delta(*stats_key, 1)
+            elif hasattr(self, '_loaded_values') and self.stored_stats_key() != stats_key:
+                stored_key = self.stored_stats_key()
+                stored_event_id, stored_sold_as = stored_key[0], stored_key[2]
+                if (stored_event_id, stored_sold_as) != (self.event_id, self.sold_as):
+                    # move the seat between the held and sold counters (or between events)
+                    adjust_inventory(stored_event_id, stored_sold_as, -1)
+                    adjust_inventory(self.event_id, self.sold_as, 1)
+                apply_ticket_delta(*stored_key, -1)
+                apply_ticket_delta(*stats_key, 1)
+
+        self._remember_stored_values()
+        if became_final:
+            self.queue_render_artifact()
+
+    def _remember_stored_values(self):
+        """Remember the current values as the stored ones, e.g. after saving or bulk creating the ticket."""
+        self._loaded_values = {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields}
+
+    def stats_key(self):
+        """Return the (event, price class, sold_as, activated) key the ticket is counted under in the statistics."""
+        return (self.event_id, self.price_class_id, self.sold_as, self.activated)
+
+    def stored_stats_key(self):
+        """Return the statistics key of the ticket as it is stored in the database."""
+        stored_values = getattr(self, '_loaded_values', {})
+        return tuple(
+            stored_values.get(attname, current)
+            for attname, current in zip(('event_id', 'price_class_id', 'sold_as', 'activated'), self.stats_key())
+        )
         
     def __str__(self):
         return str(self.id) + " - " + str(self.event) + " - " + str(self.seat)
@@ -147,109 +259,18 @@ class Ticket(models.Model):
         """
         Generate a PDF ticket for the given Ticket instance.
         """
-        # Create a QR code from the ticket ID
-        qr = qrcode.QRCode(version=1, box_size=10, border=4)
-        qr.add_data(self.id)
-        qr.make(fit=True)
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_file:
-            qr_image_path = temp_file.name
-            qr_image = qr.make_image(fill_color="black", back_color="white")
-            qr_image.save(qr_image_path)
-
-        try:
-            # Create the PDF
-            pdf = FPDF(unit="cm", format=(21.0, 8.5))  # Standard event ticket size
-            pdf.set_margins(0.5, 0.5)  # Set margins 
-            pdf.set_auto_page_break(auto=True, margin=0.2)  # Enable auto page break with a margin of 0.2 cm
-            # Set font for the PDF
-            font = "Helvetica"  # Default font
-            pdf.set_font(font)
-
-            # If a template is provided, use it as the canvas
-            if self.event.ticket_background_path:
-                try:
-                    pdf.set_page_background(self.event.ticket_background_path)
-                except Exception as e:
-                    logger.error(f"Error loading template image: {e}")
-            
-            pdf.add_page()
-            borders = 0
-            
-            # Add Event Title
-            pdf.set_font(font, size=18, style='B')
-            pdf.cell(14, 0.65, text=f"{self.event.name}", border=borders, align='L')
-            
-            # Add Ticket Details in a Layout
-            pdf.set_font(font, size=15)
-            pdf.ln(1.25)  # Move to the next line
-
-            pdf.cell(4.0, 0.6, text=_("Start:"), border=borders, align='L')
-            pdf.cell(5.0, 0.6, text=f"{self.event.start_time_in_timezone.strftime('%H:%M %Z %d.%m.%Y')}", border=borders, align='L')
-
-            pdf.cell(3.0, 0.6, text=_("Duration:"), border=borders, align='R')
-            pdf.cell(2.5, 0.6, text=f"{self.event.duration_minutes} min", border=borders, align='L')
+        pdf = new_ticket_pdf()
+        self.add_pdf_page(pdf)
+        return pdf
 
-            pdf.ln(0.75)  # Move to the next line
-            pdf.cell(4.0, 0.6, text=_("Venue:"), border=borders, align='L')
-            pdf.cell(10.0, 0.6, text=f"{self.event.location.get_address()}", border=borders,  align='L')
-            
-            pdf.ln(0.75)  # Move to the next line
-            if self.event.display_seat_number:
-                pdf.cell(4.0, 0.6, text=_("Seat Number:"), border=borders, align='L')
-                pdf.cell(2.0, 0.6, text=f"{self.seat}", border=borders,  align='L')
-            else:
-                pdf.cell(4.0, 0.6, text=_("Free Seating"), border=borders, align='L')
-
-
-            pdf.ln(1.25)  # Move to the next line
-            pdf.cell(4.0, 0.6, text=_("Price Class:"), border=borders, align='L')
-            pdf.cell(4.0, 0.6, text=f"{self.price_class.name}", border=borders, align='L') 
-            if self.price_class.notification_message:
-                pdf.ln(0.55)
-                pdf.set_font(font, size=10)
-                pdf.cell(4.0, 0.35, text="", border=borders, align='L')
-                pdf.multi_cell(10.0, 0.35, text=f"{self.price_class.notification_message}", border=borders, align='L')
-                pdf.set_font(font, size=15)
-                pdf.ln(0.1) 
-            else:
-                pdf.ln(0.75)  # Move to the next line
-            pdf.cell(4.0, 0.6, text=_("Price:"), border=borders, align='L')
-            pdf.cell(4.0, 0.6, text=f"{self.price_class.price} {settings.DEFAULT_CURRENCY}", border=borders, align='L')
-
-            # render ticket footer
-            pdf.set_font(font, size=10)
-            pdf.set_y(-0.75)  # Set position 2.5 cm from the bottom
-            pdf.cell(7, 0.4, text=f"{self.id}", border=borders, align='L')
-            pdf.ln(-0.5)
-            pdf.cell(7.0, 0.4, text=f"{self.first_name} {self.last_name}", border=borders, align='L')
-            pdf.cell(7.0, 0.4, text=f"{self.email}", border=borders, align='L')
-
-
-            ## Ticket Check Side
-            # vertical line to divide ticket into two parts
-            pdf.line(14.75, 0.1, 14.75, 8.4)
-
-            # Add QR Code to the Bottom Right
-            pdf.image(qr_image_path, x=15.5, y=0.0, w=5, h=5)  # Adjust size and position of the QR code
-
-            pdf.set_font(font, size=8)
-            pdf.set_y(5.2)  # Set x position for ticket check side
-            pdf.set_x(15.2)  # Set x position for ticket check side
-            pdf.cell(5.5, 0.5, text=f"{self.event.name}", border=borders, align='C', new_y="NEXT", new_x="LEFT")
-            pdf.cell(5.5, 0.5, text=f"{self.event.start_time_in_timezone.strftime('%H:%M %d.%m.%Y %Z')} {self.event.duration_minutes} min", border=borders, align='C', new_y="NEXT", new_x="LEFT")
-            if self.event.display_seat_number:
-                pdf.cell(5.5, 0.5, text=f"{self.seat}", border=borders, align='C', new_y="NEXT", new_x="LEFT")
-            else:
-                pdf.cell(5.5, 0.5, text=_("Free Seating"), border=borders, align='C', new_y="NEXT", new_x="LEFT")
-            pdf.cell(5.5, 0.5, text=f"{self.event.location.get_address()}", border=borders, align='C', new_y="NEXT", new_x="LEFT")
-            
-        finally:
-            # Clean up the temporary QR code image
-            if os.path.exists(qr_image_path):
-                os.remove(qr_image_path)
+    def add_pdf_page(self, pdf):
+        """
+        Render this ticket as a new page of the given ticket PDF, see new_ticket_pdf().
+        The static part of the page comes from the compiled template of the event.
+        """
+        from .ticket_template import get_ticket_template
 
-        return pdf
+        get_ticket_template(self.event).render(pdf, self)
 
     def send_to_email(self):
         """
@@ -282,10 +303,10 @@ class Ticket(models.Model):
                             seat=seat
                         )
             
-            # Generate PDF ticket
-            pdf = self.generate_pdf_ticket()
-            # Create a BytesIO stream to hold the PDF data
-            pdf_output = pdf.output(dest='S')  # Get PDF as a bytearray
+            from .artifacts import read_ticket_pdf
+
+            # Stored PDF of the ticket (rendered now if missing or outdated)
+            pdf_output = read_ticket_pdf(self).content
 
             email = EmailMessage(
                 subject,
@@ -296,7 +317,7 @@ class Ticket(models.Model):
             email.attach(f"ticket_{self.id}.pdf", pdf_output, 'application/pdf')
             
             try:
-                email.send()
+                send_email(email)
             except Exception as e:
                 # Log the error or handle it as needed
                 logger.error(f"Error sending email: {e}")
@@ -304,15 +325,45 @@ class Ticket(models.Model):
         else:
             raise ValueError(_("No email address associated with this ticket."))
 
+    def queue_render_artifact(self):
+        """
+        Render and store the ticket PDF in the background. Without Celery it is rendered on first use instead.
+        """
+        if settings.EMAILS_ASYNC:
+            from .tasks import render_ticket_artifact_task
+
+            transaction.on_commit(lambda: render_ticket_artifact_task.delay(str(self.pk)))
+
     def queue_send_to_email(self):
         if settings.EMAILS_ASYNC:
-            from .tasks import send_ticket_email_task
+            from accounting.models import EmailOutbox
+            from accounting.outbox import enqueue_email
 
-            transaction.on_commit(lambda: send_ticket_email_task.delay(str(self.pk)))
+            enqueue_email(EmailOutbox.KIND_TICKET, self)
             return
 
         self.send_to_email()
 
+    @classmethod
+    def queue_send_emails(cls, tickets):
+        """
+        Send the emails of many tickets in one batch over one mail connection.
+        Tickets without an email address are skipped.
+        """
+        tickets = [ticket for ticket in tickets if ticket.email]
+        if not tickets:
+            return
+
+        if settings.EMAILS_ASYNC:
+            from accounting.models import EmailOutbox
+            from accounting.outbox import enqueue_emails
+
+            # the outbox dispatcher sends them together
+            enqueue_emails(EmailOutbox.KIND_TICKET, tickets)
+            return
+
+        send_ticket_emails([ticket.pk for ticket in tickets])
+
 class Event(models.Model):
     """
     Global event model.
@@ -691,77 +742,19 @@ class Event(models.Model):
     def calculate_statistics(self):
         """
         Calculate statistics for the event.
+        The counts are read from the statistics rollup of the event, see events.statistics.
         """
-        tickets = Ticket.objects.filter(event=self)
-        price_classes = self.price_classes.all()
+        from .statistics import fold_ticket_groups, rollup_groups
 
-        total_stats = {
-            'waiting': tickets.filter(sold_as=SoldAsStatus.WAITING).count(),
-            'presale_online_waiting': tickets.filter(sold_as=SoldAsStatus.PRESALE_ONLINE_WAITING).count(),
-            'presale_online': tickets.filter(sold_as=SoldAsStatus.PRESALE_ONLINE).count(),
-            'presale_door': tickets.filter(sold_as=SoldAsStatus.PRESALE_DOOR).count(),
-            'door': tickets.filter(sold_as=SoldAsStatus.DOOR).count(),
-            'total_sold': tickets.exclude(sold_as__in=[SoldAsStatus.WAITING, SoldAsStatus.PRESALE_ONLINE_WAITING]).count(),
-            'total_count': tickets.all().count(),
-            'activated_presale_online': tickets.filter(sold_as=SoldAsStatus.PRESALE_ONLINE, activated=True).count(),
-            'activated_presale_door': tickets.filter(sold_as=SoldAsStatus.PRESALE_DOOR, activated=True).count(),
-            'activated_door': tickets.filter(sold_as=SoldAsStatus.DOOR, activated=True).count(),
-            'total_activated': tickets.filter(activated=True).count(),
-            'earned_presale_online': 0,
-            'earned_presale_door': 0,
-            'earned_door': 0,
-            'total_earned': 0
-        }
-        price_class_stats = {}
-
-        for price_class in price_classes:
-            waiting_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.WAITING).count()
-            presale_online_waiting_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.PRESALE_ONLINE_WAITING).count()
-            presale_online_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.PRESALE_ONLINE).count()
-            presale_door_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.PRESALE_DOOR).count()
-            door_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.DOOR).count()
-            
-            activated_waiting_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.WAITING, activated=True).count()
-            activated_presale_online_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.PRESALE_ONLINE, activated=True).count()
-            activated_presale_door_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.PRESALE_DOOR, activated=True).count()
-            activated_door_count = tickets.filter(price_class=price_class, sold_as=SoldAsStatus.DOOR, activated=True).count()
-            
-            earned_presale_online = presale_online_count * price_class.price
-            earned_presale_door = presale_door_count * price_class.price
-            earned_door = door_count * price_class.price
-            
-            total_stats['earned_presale_online'] += earned_presale_online
-            total_stats['earned_presale_door'] += earned_presale_door
-            total_stats['earned_door'] += earned_door
-            
-            earned = (presale_online_count + presale_door_count + door_count) * price_class.price
-            total_stats['total_earned'] += earned
-
-
-            price_class_stats[price_class] = {
-                'waiting': waiting_count,
-                'presale_online_waiting': presale_online_waiting_count,
-                'presale_online': presale_online_count,
-                'presale_door': presale_door_count,
-                'door': door_count,
-                'total_sold': presale_online_count + presale_door_count + door_count,
-                'total_count': waiting_count + presale_online_waiting_count + presale_online_count + presale_door_count + door_count,
-                'activated_presale_online': activated_presale_online_count,
-                'activated_presale_door': activated_presale_door_count,
-                'activated_door': activated_door_count,
-                'total_activated': activated_waiting_count + activated_presale_online_count + activated_presale_door_count + activated_door_count,
-                'earned_presale_online': earned_presale_online,
-                'earned_presale_door': earned_presale_door,
-                'earned_door': earned_door,
-                'total_earned': earned,
-            }
-
-        return total_stats, price_class_stats
+        price_classes = self.price_classes.all()
+        return fold_ticket_groups(rollup_groups(TicketStatsRollup.objects.filter(event=self)), price_classes)
     
     def generate_statistics_pdf(self):
         """
         Generate a PDF with statistics for the event.
         """
+        from .stats_cache import event_statistics
+
         compact_row_specs = [
             (_('Waiting'), 'single', 'waiting'),
             (_('Presale Online Waiting'), 'single', 'presale_online_waiting'),
@@ -808,7 +801,7 @@ class Event(models.Model):
         pdf.ln(0.6)
 
         # Fetch statistics
-        total_stats, price_class_stats = self.calculate_statistics()
+        total_stats, price_class_stats = event_statistics(self)
 
         statistic_column_width = 6.5
         value_column_width = (19.0 - statistic_column_width) / max(len(price_class_stats.keys()) + 1, 1)
@@ -861,10 +854,12 @@ class Event(models.Model):
         """
         Return the number of seats still available for this event.
         If custom_seats is set, use that; otherwise, fallback to the location's total_seats.
+        Held and sold seats are read from the event inventory row instead of counting tickets.
         """
-        total_seats = self.total_seats
-        sold_tickets = Ticket.objects.filter(event=self).all().count()  # Count sold tickets for the event
-        return total_seats - sold_tickets  # Subtract sold tickets from total seats
+        from .seating import get_inventory
+
+        inventory = get_inventory(self)
+        return self.total_seats - inventory.held - inventory.sold  # Subtract held and sold seats from total seats
     
     @property
     def is_sold_out(self):
@@ -873,6 +868,149 @@ class Event(models.Model):
         """
         return self.remaining_seats <= 0
 
+class EventInventory(models.Model):
+    """
+    Per-event bookkeeping row. It is locked while seats are handed out, see events.seating.
+    The held and sold counters are kept in step with the tickets of the event so that the
+    remaining capacity can be read without counting tickets.
+    """
+    event = models.OneToOneField(Event, verbose_name=_("event"), on_delete=models.CASCADE, related_name="inventory")
+    last_seat = models.IntegerField(_("last assigned seat"), default=0)
+    held = models.IntegerField(_("held seats"), default=0, help_text=_("Seats of tickets that are not paid yet."))
+    sold = models.IntegerField(_("sold seats"), default=0, help_text=_("Seats of tickets that are sold."))
+    stats_version = models.IntegerField(_("statistics version"), default=0, help_text=_("Increased on every change that affects the statistics of the event, see events.stats_cache."))
+    change_seq = models.BigIntegerField(_("check-in change sequence"), default=0, help_text=_("Last number handed out to a ticket whose sold status or activation changed, see events.checkin."))
+
+    def __str__(self):
+        return f"{self.event} - {self.held} held / {self.sold} sold"
+
+class TicketArtifact(models.Model):
+    """
+    Rendered PDF of a sold ticket kept in media storage, see events.artifacts.
+    """
+    ticket = models.OneToOneField(Ticket, verbose_name=_("ticket"), on_delete=models.CASCADE, related_name="artifact")
+    pdf = models.FileField(_("PDF"), upload_to="ticket_artifacts/")
+    content_hash = models.CharField(_("content hash"), max_length=64)
+    fingerprint = models.CharField(_("fingerprint"), max_length=64, help_text=_("Hash of the ticket and event data the PDF was rendered from."))
+    rendered_at = models.DateTimeField(_("rendered at"), auto_now=True)
+
+    def __str__(self):
+        return f"{self.ticket_id} - {self.content_hash[:12]}"
+
+class TicketStatsRollup(models.Model):
+    """
+    Number and revenue of the tickets of an event per price class, sold_as state and activation.
+    Kept up to date by ticket changes, see events.statistics; rebuild with `manage.py rebuild_stats`.
+    """
+    event = models.ForeignKey(Event, verbose_name=_("event"), on_delete=models.CASCADE, related_name="stats_rollups")
+    price_class = models.ForeignKey(PriceClass, verbose_name=_("price class"), on_delete=models.CASCADE)
+    sold_as = models.CharField(_("sold as"), max_length=24, choices=SoldAsStatus.CHOICES)
+    activated = models.BooleanField(_("activated"))
+    count = models.IntegerField(_("count"), default=0)
+    revenue = models.DecimalField(_("revenue"), max_digits=12, decimal_places=2, default="0.0")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['event', 'price_class', 'sold_as', 'activated'], name='unique_ticket_stats_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.event} - {self.price_class} - {self.sold_as} - {self.count}"
+
+class TicketEmailJob(models.Model):
+    """
+    Background resend of the emails of many tickets, e.g. after a venue change.
+    The tickets are sent in chunks by a Celery group; every chunk adds to the counters.
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_CHOICES = [
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_DONE, _("Done")),
+    ]
+
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, verbose_name=_("created by"), on_delete=models.SET_NULL, null=True, blank=True)
+    status = models.CharField(_("status"), max_length=16, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    total = models.PositiveIntegerField(_("total"), default=0)
+    sent = models.PositiveIntegerField(_("sent"), default=0)
+    failed = models.PositiveIntegerField(_("failed"), default=0)
+    created_at = models.DateTimeField(_("created at"), auto_now_add=True)
+    finished_at = models.DateTimeField(_("finished at"), null=True, blank=True)
+
+    class Meta:
+        verbose_name = _("ticket email job")
+        verbose_name_plural = _("ticket email jobs")
+
+    def __str__(self):
+        return f"{self.created_at:%Y-%m-%d %H:%M} - {self.sent + self.failed}/{self.total}"
+
+    @property
+    def progress(self):
+        """Share of the tickets that were processed, in percent."""
+        if not self.total:
+            return 100
+        return int(100 * (self.sent + self.failed) / self.total)
+
+    @classmethod
+    def start(cls, tickets, user=None, chunk_size=None):
+        """
+        Create a job for the given tickets (those with an email address) and dispatch its chunks.
+        Without Celery (EMAILS_ASYNC off) the chunks are sent right away.
+        """
+        ticket_ids = [str(pk) for pk in tickets.exclude(email__isnull=True).exclude(email='').values_list('pk', flat=True)]
+        chunk_size = chunk_size or getattr(settings, 'TICKET_EMAIL_JOB_CHUNK_SIZE', 50)
+        chunks = [ticket_ids[start:start + chunk_size] for start in range(0, len(ticket_ids), chunk_size)]
+
+        job = cls.objects.create(created_by=user, total=len(ticket_ids))
+        if not chunks:
+            job.finish()
+            return job
+
+        if settings.EMAILS_ASYNC:
+            from celery import group
+            from .tasks import send_ticket_email_job_chunk_task
+
+            chunk_group = group(send_ticket_email_job_chunk_task.s(job.pk, chunk) for chunk in chunks)
+            transaction.on_commit(chunk_group.apply_async)
+            return job
+
+        for chunk in chunks:
+            job.send_chunk(chunk)
+        job.refresh_from_db()
+        return job
+
+    def send_chunk(self, ticket_ids):
+        """
+        Send the emails of one chunk of tickets over the pooled mail connection and add the result to the counters.
+        Returns ``(sent, failed)``.
+        """
+        sent = failed = 0
+        for ticket in Ticket.objects.filter(pk__in=ticket_ids).select_related('event__location', 'price_class'):
+            try:
+                ticket.send_to_email()
+                sent += 1
+            except Exception as e:
+                logger.error(f"Ticket email job {self.pk}: sending ticket {ticket.pk} failed: {e}")
+                failed += 1
+        # tickets deleted since the job was started count as failed
+        failed += len(ticket_ids) - sent - failed
+
+        TicketEmailJob.objects.filter(pk=self.pk).update(
+            sent=models.F('sent') + sent,
+            failed=models.F('failed') + failed,
+        )
+        # the chunk that completes the job marks it as done
+        if TicketEmailJob.objects.filter(
+            pk=self.pk, status=self.STATUS_RUNNING, total__lte=models.F('sent') + models.F('failed')
+        ).update(status=self.STATUS_DONE, finished_at=django_timezone.now()):
+            logger.info(f"Ticket email job {self.pk} finished")
+        return sent, failed
+
+    def finish(self):
+        self.status = self.STATUS_DONE
+        self.finished_at = django_timezone.now()
+        self.save(update_fields=['status', 'finished_at'])
+
 class TicketMaster(models.Model):
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL,
@@ -0,0 +1,81 @@
+"""
+Signed ticket QR codes.
+
+A ticket QR code carries the event id, ticket id and seat together with an HMAC
+keyed by ``TICKET_QR_SECRET`` (or ``SECRET_KEY`` if that is not set), packed into
+``CT1:<base64url>``. A scan can be rejected as forged, malformed or for another
+event from the code alone, before any database query.
+
+Tickets issued before signed codes carry the bare ticket UUID; those are still
+accepted and only checked against the database.
+"""
+
+import base64
+import binascii
+import struct
+import uuid
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+QR_PREFIX = 'CT1:'
+QR_SALT = 'events.qr.ticket'
+# event id, ticket id, seat
+QR_STRUCT = struct.Struct('>16s16sI')
+QR_SIGNATURE_LENGTH = 10
+
+
+class InvalidQRCode(Exception):
+    pass
+
+
+def _signature(payload):
+    secret = getattr(settings, 'TICKET_QR_SECRET', '') or None
+    return salted_hmac(QR_SALT, payload, secret=secret, algorithm='sha256').digest()[:QR_SIGNATURE_LENGTH]
+
+
+def encode_ticket_qr(ticket):
+    """
+    Return the signed QR code data of the ticket.
+    """
+    payload = QR_STRUCT.pack(uuid.UUID(str(ticket.event_id)).bytes, uuid.UUID(str(ticket.pk)).bytes, ticket.seat or 0)
+    encoded = base64.urlsafe_b64encode(payload + _signature(payload)).rstrip(b'=').decode('ascii')
+    return f"{QR_PREFIX}{encoded}"
+
+
+def decode_ticket_qr(data, event_id):
+    """
+    Return the ticket id of scanned QR code data for the event.
+
+    Raises ``InvalidQRCode`` if the code is malformed, not signed by us or for another event.
+    """
+    data = (data or '').strip()
+    if not data.startswith(QR_PREFIX):
+        # bare ticket UUID of a ticket issued before signed codes
+        try:
+            return uuid.UUID(data)
+        except ValueError:
+            raise InvalidQRCode("Malformed QR code.")
+
+    encoded = data[len(QR_PREFIX):]
+    try:
+        raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except (binascii.Error, ValueError):
+        raise InvalidQRCode("Malformed QR code.")
+    if len(raw) != QR_STRUCT.size + QR_SIGNATURE_LENGTH:
+        raise InvalidQRCode("Malformed QR code.")
+
+    payload, signature = raw[:QR_STRUCT.size], raw[QR_STRUCT.size:]
+    if not constant_time_compare(signature, _signature(payload)):
+        logger.warning("Rejected QR code with an invalid signature")
+        raise InvalidQRCode("Invalid QR code signature.")
+
+    event_bytes, ticket_bytes, _seat = QR_STRUCT.unpack(payload)
+    if uuid.UUID(bytes=event_bytes) != uuid.UUID(str(event_id)):
+        raise InvalidQRCode("QR code is for another event.")
+    return uuid.UUID(bytes=ticket_bytes)
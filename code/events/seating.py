@@ -0,0 +1,234 @@
+"""
+Seat allocation for events.
+
+Seat numbers are handed out from a per-event ``EventInventory`` row that is
+locked with ``SELECT ... FOR UPDATE`` while a contiguous block is reserved,
+so concurrent orders for the same event never receive the same seat.
+
+The same row keeps the number of held (not yet paid) and sold seats, which lets
+``allocate`` reject orders atomically once the capacity of the event is used up.
+"""
+
+from contextlib import contextmanager
+import threading
+
+from django.db import models, transaction
+from django.utils import timezone
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+_bookkeeping = threading.local()
+
+
+class SoldOutError(Exception):
+    """
+    Raised when an event has not enough seats left for the requested tickets.
+    """
+    pass
+
+
+def _counter_field(sold_as):
+    """
+    Return the inventory counter a ticket with the given sold_as status is counted in.
+    """
+    from .models import SoldAsStatus
+
+    return 'held' if sold_as in SoldAsStatus.PENDING else 'sold'
+
+
+def _get_locked_inventory(event):
+    """
+    Return the inventory row of the event locked for update, creating it on first use.
+    Must be called inside a transaction.
+    """
+    from .models import EventInventory, SoldAsStatus, Ticket
+
+    inventory = EventInventory.objects.select_for_update().filter(event=event).first()
+    if inventory is None:
+        # first use for this event: continue after any seats that already exist and count their tickets
+        counts = Ticket.objects.filter(event=event).aggregate(
+            last_seat=models.Max('seat'),
+            held=models.Count('pk', filter=models.Q(sold_as__in=SoldAsStatus.PENDING)),
+            sold=models.Count('pk', filter=~models.Q(sold_as__in=SoldAsStatus.PENDING)),
+        )
+        EventInventory.objects.get_or_create(event=event, defaults={
+            'last_seat': counts['last_seat'] or 0,
+            'held': counts['held'],
+            'sold': counts['sold'],
+        })
+        inventory = EventInventory.objects.select_for_update().get(event=event)
+    return inventory
+
+
+def get_inventory(event):
+    """
+    Return the inventory row of the event without locking it, creating it on first use.
+    """
+    from .models import EventInventory
+
+    try:
+        return event.inventory
+    except EventInventory.DoesNotExist:
+        with transaction.atomic():
+            event.inventory = _get_locked_inventory(event)
+        return event.inventory
+
+
+def adjust_inventory(event_id, sold_as, delta):
+    """
+    Add ``delta`` to the held or sold counter of the event, depending on ``sold_as``.
+    Events without an inventory row are skipped, their tickets are counted once the row is created.
+    """
+    from .models import EventInventory
+
+    field = _counter_field(sold_as)
+    EventInventory.objects.filter(event_id=event_id).update(**{field: models.F(field) + delta})
+
+
+def _check_capacity(event, inventory, count):
+    """
+    Raise ``SoldOutError`` if the locked inventory has fewer than ``count`` seats left.
+    """
+    remaining = event.total_seats - inventory.held - inventory.sold
+    if count > remaining:
+        logger.info(f"Rejected {count} tickets for event {event.pk}, only {remaining} seats left")
+        raise SoldOutError(f"Only {max(remaining, 0)} seats left for event {event.pk}")
+
+
+def reserve_seats(event, count):
+    """
+    Reserve a contiguous block of ``count`` seat numbers for the event and return the first one.
+    The tickets for the seats are not counted yet, the caller adds them to the held or sold counter.
+
+    Raises ``SoldOutError`` if the event has fewer than ``count`` seats left.
+    """
+    from .models import EventInventory
+
+    if count <= 0:
+        raise ValueError("count must be a positive integer")
+
+    with transaction.atomic():
+        inventory = _get_locked_inventory(event)
+        _check_capacity(event, inventory, count)
+        first_seat = inventory.last_seat + 1
+        EventInventory.objects.filter(pk=inventory.pk).update(last_seat=models.F('last_seat') + count)
+    return first_seat
+
+
+def next_change_seq(event_id, count=1):
+    """
+    Reserve ``count`` numbers of the check-in change sequence of the event and return the last one.
+    Must be called inside a transaction: the inventory row stays locked until it ends, so
+    changes become visible in the order of their numbers.
+    """
+    from .models import Event, EventInventory
+
+    changes = {'change_seq': models.F('change_seq') + count}
+    if not EventInventory.objects.filter(event_id=event_id).update(**changes):
+        _get_locked_inventory(Event.objects.get(pk=event_id))
+        EventInventory.objects.filter(event_id=event_id).update(**changes)
+    return EventInventory.objects.filter(event_id=event_id).values_list('change_seq', flat=True).get()
+
+
+def allocate(event, price_class, count, **ticket_fields):
+    """
+    Create ``count`` tickets of the given price class for the event in one go.
+
+    Seat numbers are reserved as one contiguous block and the tickets are written with a
+    single ``bulk_create``. Additional keyword arguments are set on every created ticket
+    (e.g. ``sold_as``, ``activated``, ``email``). Returns the list of created tickets.
+
+    Raises ``SoldOutError`` if the event has fewer than ``count`` seats left.
+    """
+    from .models import EventInventory, SoldAsStatus, Ticket
+    from .statistics import apply_ticket_delta
+
+    if count <= 0:
+        return []
+
+    sold_as = ticket_fields.get('sold_as', SoldAsStatus.WAITING)
+    field = _counter_field(sold_as)
+
+    with transaction.atomic():
+        inventory = _get_locked_inventory(event)
+        _check_capacity(event, inventory, count)
+
+        first_seat = inventory.last_seat + 1
+        if ticket_fields.get('activated'):
+            ticket_fields.setdefault('activation_changed_at', timezone.now())
+        first_change_seq = inventory.change_seq + 1
+        EventInventory.objects.filter(pk=inventory.pk).update(
+            last_seat=models.F('last_seat') + count,
+            change_seq=models.F('change_seq') + count,
+            **{field: models.F(field) + count}
+        )
+        tickets = [
+            Ticket(event=event, price_class=price_class, seat=first_seat + offset, change_seq=first_change_seq + offset, **ticket_fields)
+            for offset in range(count)
+        ]
+        Ticket.objects.bulk_create(tickets)
+        for ticket in tickets:
+            ticket._remember_stored_values()
+        apply_ticket_delta(event.pk, price_class.pk, sold_as, ticket_fields.get('activated', False), count)
+
+        # keep the inventory cached on the event in step for later reads of remaining_seats
+        inventory.last_seat += count
+        inventory.change_seq += count
+        setattr(inventory, field, getattr(inventory, field) + count)
+        event.inventory = inventory
+
+    logger.info(f"Allocated seats {first_seat}-{first_seat + count - 1} for event {event.pk}")
+    return tickets
+
+
+@contextmanager
+def suspend_ticket_bookkeeping():
+    """
+    Skip the per-ticket inventory and statistics updates of the ticket signals,
+    for bulk operations that apply the changes in aggregate themselves.
+    """
+    previous = getattr(_bookkeeping, 'suspended', False)
+    _bookkeeping.suspended = True
+    try:
+        yield
+    finally:
+        _bookkeeping.suspended = previous
+
+
+def ticket_bookkeeping_suspended():
+    return getattr(_bookkeeping, 'suspended', False)
+
+
+def release(tickets):
+    """
+    Delete the tickets of the given queryset in bulk and give their seats back.
+
+    The inventory and statistics counters are updated once per (event, price class,
+    sold_as, activated) group and the totals of the orders of the tickets in one UPDATE,
+    instead of once per ticket. Returns the number of deleted tickets.
+    """
+    from payments import get_payment_model
+
+    from .statistics import apply_ticket_delta
+
+    with transaction.atomic():
+        groups = list(
+            tickets.order_by()
+            .values('event', 'price_class', 'sold_as', 'activated')
+            .annotate(count=models.Count('pk'))
+        )
+        if not groups:
+            return 0
+
+        get_payment_model().release_ticket_totals(tickets)
+        with suspend_ticket_bookkeeping():
+            tickets.delete()
+
+        for group in groups:
+            adjust_inventory(group['event'], group['sold_as'], -group['count'])
+            apply_ticket_delta(group['event'], group['price_class'], group['sold_as'], group['activated'], -group['count'])
+
+    return sum(group['count'] for group in groups)
@@ -0,0 +1,62 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Event, Location, PriceClass, Ticket, TicketArtifact
+from .seating import adjust_inventory, ticket_bookkeeping_suspended
+from .statistics import apply_ticket_delta
+from .stats_cache import bump_stats_version
+
+
+@receiver(post_delete, sender=Ticket)
+def release_ticket_seat(sender, instance, **kwargs):
+    """
+    Give the seat of a deleted ticket back to the event inventory and remove it from the statistics.
+    """
+    if ticket_bookkeeping_suspended():
+        return
+    stored_key = instance.stored_stats_key()
+    adjust_inventory(stored_key[0], stored_key[2], -1)
+    apply_ticket_delta(*stored_key, -1)
+
+
+@receiver(post_save, sender=Event)
+def invalidate_event_statistics(sender, instance, **kwargs):
+    """
+    Event details are part of the statistics PDFs.
+    """
+    bump_stats_version(pk=instance.pk)
+
+
+@receiver(post_save, sender=Location)
+def invalidate_location_statistics(sender, instance, **kwargs):
+    bump_stats_version(location=instance)
+
+
+@receiver(post_save, sender=PriceClass)
+def invalidate_price_class_statistics(sender, instance, **kwargs):
+    bump_stats_version(price_classes=instance)
+
+
+@receiver(m2m_changed, sender=Event.price_classes.through)
+def invalidate_price_class_assignment(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    The price classes of an event decide which rows its statistics show.
+    """
+    if not action.startswith('post_'):
+        return
+    if reverse and pk_set:
+        bump_stats_version(pk__in=pk_set)
+    elif reverse:
+        # price_class.events.clear() does not tell which events were affected
+        bump_stats_version()
+    else:
+        bump_stats_version(pk=instance.pk)
+
+
+@receiver(post_delete, sender=TicketArtifact)
+def delete_ticket_artifact_file(sender, instance, **kwargs):
+    """
+    Remove the stored PDF together with its artifact, e.g. when the ticket is deleted.
+    """
+    if instance.pdf:
+        instance.pdf.delete(save=False)
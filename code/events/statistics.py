@@ -0,0 +1,246 @@
+"""
+Ticket statistics.
+
+Tickets are counted per ``price_class`` x ``sold_as`` x ``activated`` and the
+rows are folded into the ``total_stats`` / ``price_class_stats`` dictionaries
+used by the statistics pages and PDFs.
+
+The counts are kept in ``TicketStatsRollup`` rows that every ticket change
+updates through ``apply_ticket_deltas``, so reading the statistics does not
+depend on the number of tickets. ``rebuild_rollups`` recounts them from the
+tickets (``manage.py rebuild_stats``).
+"""
+
+from decimal import Decimal
+from functools import reduce
+import operator
+
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+
+from .models import PriceClass, SoldAsStatus, TicketStatsRollup
+from .stats_cache import bump_stats_version, cache_key, cache_timeout
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+STAT_KEYS = [
+    'waiting',
+    'presale_online_waiting',
+    'presale_online',
+    'presale_door',
+    'door',
+    'total_sold',
+    'total_count',
+    'activated_presale_online',
+    'activated_presale_door',
+    'activated_door',
+    'total_activated',
+    'earned_presale_online',
+    'earned_presale_door',
+    'earned_door',
+    'total_earned',
+]
+
+# sold_as states that are paid and therefore count as sold and earned
+SOLD_STATES = [SoldAsStatus.PRESALE_ONLINE, SoldAsStatus.PRESALE_DOOR, SoldAsStatus.DOOR]
+
+
+def empty_stats():
+    """
+    Return a statistics dictionary with all counters set to zero.
+    """
+    return {key: Decimal('0.00') if 'earned' in key else 0 for key in STAT_KEYS}
+
+
+def ticket_groups(tickets, *group_by):
+    """
+    Group the given ticket queryset by price class, sold_as and activated in a single query,
+    optionally by further ``group_by`` fields. Each row holds the number of tickets and their
+    revenue at the current price.
+    """
+    return (
+        tickets.order_by()
+        .values(*group_by, 'price_class', 'sold_as', 'activated')
+        .annotate(count=models.Count('pk'), revenue=models.Sum('price_class__price'))
+    )
+
+
+def rollup_groups(rollups, *group_by):
+    """
+    Return the rows of the given rollup queryset in the shape of ``ticket_groups``.
+    """
+    return rollups.order_by().values(*group_by, 'price_class', 'sold_as', 'activated', 'count', 'revenue')
+
+
+def apply_ticket_delta(event_id, price_class_id, sold_as, activated, delta):
+    """
+    Add ``delta`` tickets to the rollup row of the given key and update its revenue.
+    """
+    apply_ticket_deltas(event_id, {(price_class_id, sold_as, activated): delta})
+
+
+def apply_ticket_deltas(event_id, deltas, bump_version=True):
+    """
+    Add the ``{(price_class_id, sold_as, activated): delta}`` ticket counts to the rollup rows
+    of the event in one UPDATE and update their revenue. ``bump_version=False`` is for callers
+    that bump the statistics version of the event themselves.
+    """
+    if bump_version:
+        bump_stats_version(pk=event_id)
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    keys = [
+        (models.Q(price_class_id=price_class_id, sold_as=sold_as, activated=activated), delta)
+        for (price_class_id, sold_as, activated), delta in deltas.items()
+    ]
+    rollups = TicketStatsRollup.objects.filter(event_id=event_id).filter(reduce(operator.or_, [key for key, _delta in keys]))
+    delta = models.Case(*[models.When(key, then=models.Value(delta)) for key, delta in keys], output_field=models.IntegerField())
+    price = models.Subquery(PriceClass.objects.filter(pk=models.OuterRef('price_class_id')).values('price')[:1])
+    changes = {
+        'count': models.F('count') + delta,
+        'revenue': models.ExpressionWrapper(
+            (models.F('count') + delta) * price,
+            output_field=models.DecimalField(max_digits=12, decimal_places=2),
+        ),
+    }
+    if rollups.update(**changes) == len(deltas):
+        return
+
+    existing = set(rollups.values_list('price_class_id', 'sold_as', 'activated'))
+    for (price_class_id, sold_as, activated), delta in deltas.items():
+        if delta > 0 and (price_class_id, sold_as, activated) not in existing:
+            _create_rollup(event_id, price_class_id, sold_as, activated, delta, changes)
+
+
+def _create_rollup(event_id, price_class_id, sold_as, activated, delta, changes):
+    try:
+        with transaction.atomic():
+            price = PriceClass.objects.values_list('price', flat=True).get(pk=price_class_id)
+            TicketStatsRollup.objects.create(
+                event_id=event_id,
+                price_class_id=price_class_id,
+                sold_as=sold_as,
+                activated=activated,
+                count=delta,
+                revenue=delta * price,
+            )
+    except IntegrityError:
+        # the row was created concurrently
+        TicketStatsRollup.objects.filter(
+            event_id=event_id, price_class_id=price_class_id, sold_as=sold_as, activated=activated
+        ).update(**changes)
+
+
+def rebuild_rollups(events):
+    """
+    Recount the rollup rows of the given events from their tickets. Returns the number of rows written.
+    """
+    from .models import Ticket
+
+    with transaction.atomic():
+        event_ids = list(events.values_list('pk', flat=True))
+        TicketStatsRollup.objects.filter(event_id__in=event_ids).delete()
+        rollups = TicketStatsRollup.objects.bulk_create([
+            TicketStatsRollup(
+                event_id=row['event'],
+                price_class_id=row['price_class'],
+                sold_as=row['sold_as'],
+                activated=row['activated'],
+                count=row['count'],
+                revenue=row['revenue'],
+            )
+            for row in ticket_groups(Ticket.objects.filter(event_id__in=event_ids), 'event')
+        ])
+        # the cached statistics and PDFs were built from the old rows
+        bump_stats_version(pk__in=event_ids)
+
+    logger.info(f"Rebuilt {len(rollups)} statistics rollups for {len(event_ids)} events")
+    return len(rollups)
+
+
+def fold_ticket_groups(rows, price_classes):
+    """
+    Fold grouped ticket rows into ``(total_stats, price_class_stats)``.
+
+    ``price_class_stats`` is keyed by the given price classes. The totals count all tickets,
+    but only earnings of the given price classes are added up.
+    """
+    total_stats = empty_stats()
+    price_class_stats = {price_class: empty_stats() for price_class in price_classes}
+    stats_by_id = {price_class.pk: stats for price_class, stats in price_class_stats.items()}
+
+    for row in rows:
+        sold_as, count = row['sold_as'], row['count']
+        stats = stats_by_id.get(row['price_class'])
+
+        total_stats[sold_as] += count
+        total_stats['total_count'] += count
+        if row['activated']:
+            total_stats['total_activated'] += count
+
+        if stats is not None:
+            stats[sold_as] += count
+            stats['total_count'] += count
+            # activated tickets still waiting for the online payment are left out per price class
+            if row['activated'] and sold_as != SoldAsStatus.PRESALE_ONLINE_WAITING:
+                stats['total_activated'] += count
+
+        if sold_as in SOLD_STATES:
+            total_stats['total_sold'] += count
+            if row['activated']:
+                total_stats[f'activated_{sold_as}'] += count
+            if stats is not None:
+                revenue = row['revenue'] or 0
+                stats['total_sold'] += count
+                stats[f'earned_{sold_as}'] += revenue
+                stats['total_earned'] += revenue
+                total_stats[f'earned_{sold_as}'] += revenue
+                total_stats['total_earned'] += revenue
+                if row['activated']:
+                    stats[f'activated_{sold_as}'] += count
+
+    return total_stats, price_class_stats
+
+
+def collect_event_statistics(events):
+    """
+    Calculate the statistics of many events at once.
+
+    Returns a list of ``(event, total_stats, price_class_stats)`` in the order of ``events``.
+    Statistics of unchanged events come from the cache; the rollup rows of the remaining
+    events are read with one query. Price classes, locations and inventories are loaded
+    alongside the events.
+    """
+    from .seating import get_inventory
+
+    events = list(events.select_related('location', 'inventory').prefetch_related('price_classes'))
+
+    keys = {event.pk: cache_key('stats', event.pk, get_inventory(event).stats_version) for event in events}
+    stats_by_key = cache.get_many(keys.values())
+
+    rows_by_event = {event.pk: [] for event in events if keys[event.pk] not in stats_by_key}
+    if rows_by_event:
+        for row in rollup_groups(TicketStatsRollup.objects.filter(event_id__in=rows_by_event), 'event'):
+            rows_by_event[row['event']].append(row)
+
+        computed = {
+            keys[event.pk]: fold_ticket_groups(rows_by_event[event.pk], event.price_classes.all())
+            for event in events if event.pk in rows_by_event
+        }
+        cache.set_many(computed, cache_timeout())
+        stats_by_key.update(computed)
+
+    return [(event, *stats_by_key[keys[event.pk]]) for event in events]
+
+
+def add_stats(target, stats):
+    """
+    Add the counters of ``stats`` to ``target`` in place.
+    """
+    for key in STAT_KEYS:
+        target[key] += stats.get(key, 0)
@@ -6,7 +6,8 @@ from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from branding.models import get_active_branding
-from events.views import generate_global_statistics_pdf
+from cinema_tickets.mail import send_email
+from events.views import get_global_statistics_pdf_bytes
 
 
 logger = logging.getLogger(__name__)
@@ -17,7 +18,7 @@ def send_global_statistics_report():
 
     This scheduled report is intentionally global (all locations).
     If location-scoped mailing is introduced later, pass the appropriate
-    queryset/list to ``generate_global_statistics_pdf(locations=...)``.
+    queryset/list to ``get_global_statistics_pdf_bytes(locations=...)``.
     """
     try:
         branding = get_active_branding()
@@ -38,8 +39,7 @@ def send_global_statistics_report():
 
         # Intentionally global: no location filter is configured for the
         # branding-level scheduled statistics email.
-        pdf = generate_global_statistics_pdf(locations=None)
-        pdf_output = pdf.output(dest='S')
+        pdf_output = get_global_statistics_pdf_bytes(locations=None)
 
         subject = _('All Events Statistics - {site_name}').format(site_name=site_name)
         message = _('Attached you will find the all event statistics for the last {interval} hours.').format(
@@ -55,7 +55,7 @@ def send_global_statistics_report():
 
         now = timezone.now().strftime('%Y-%m-%d_%H-%M-%S')
         email.attach(f'all_event_statistics_{site_name}_{now}.pdf', pdf_output, 'application/pdf')
-        email.send()
+        send_email(email)
 
         success_message = f"Global statistics report sent successfully to {branding.ticket_statistics_email}."
         logger.info(success_message)
@@ -0,0 +1,101 @@
+"""
+Cache for computed statistics and rendered statistics PDFs.
+
+Entries are keyed by the ``stats_version`` of the events they cover. The version
+lives on the ``EventInventory`` row and is bumped in the database whenever tickets,
+price classes, the event or its location change, so stale entries are simply never
+read again, no matter which process (web or worker) made the change.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+
+from cinema_tickets.pdf_rendering import render_pdf
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def cache_timeout():
+    """
+    Return how long statistics entries are kept, in seconds.
+    """
+    return getattr(settings, 'STATISTICS_CACHE_TIMEOUT', 60 * 60)
+
+
+def cache_key(kind, *parts):
+    """
+    Build a cache key for the given kind of entry from the given parts.
+    """
+    return ":".join(["event_stats", kind, *[str(part) for part in parts]])
+
+
+def stats_version(event):
+    """
+    Return the current statistics version of the event.
+    """
+    from .seating import get_inventory
+
+    return get_inventory(event).stats_version
+
+
+def bump_stats_version(**event_filters):
+    """
+    Invalidate the cached statistics of all events matching the given filters.
+    """
+    from .models import EventInventory
+
+    EventInventory.objects.filter(**{f"event__{key}": value for key, value in event_filters.items()}).update(
+        stats_version=models.F('stats_version') + 1
+    )
+
+
+def cached(key, build):
+    """
+    Return the cached value for ``key``, building and storing it with ``build()`` on a miss.
+    """
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, cache_timeout())
+    else:
+        logger.debug(f"Statistics cache hit for {key}")
+    return value
+
+
+def event_statistics(event):
+    """
+    Return ``(total_stats, price_class_stats)`` of the event from the cache.
+    """
+    return cached(cache_key('stats', event.pk, stats_version(event)), event.calculate_statistics)
+
+
+def event_statistics_pdf(event):
+    """
+    Return the rendered statistics PDF of the event as bytes from the cache.
+    """
+    return cached(
+        cache_key('pdf', event.pk, stats_version(event)),
+        lambda: render_pdf(type(event).generate_statistics_pdf, event),
+    )
+
+
+def global_statistics_pdf(events, refunds, build):
+    """
+    Return the rendered global statistics PDF as bytes from the cache.
+
+    The key covers the versions of all ``events`` in the report and the ``refunds``
+    aggregate, ``build()`` returns the FPDF document rendered on a miss and must be
+    picklable (e.g. a ``functools.partial``) so it can run in the PDF rendering pool.
+    """
+    from .seating import get_inventory
+
+    digest = hashlib.sha256()
+    for event in events:
+        digest.update(f"{event.pk}:{get_inventory(event).stats_version};".encode())
+    digest.update(repr(sorted(refunds.items())).encode())
+    return cached(cache_key('global_pdf', digest.hexdigest()), lambda: render_pdf(build))
@@ -7,17 +7,33 @@ logger = logging.getLogger(__name__)
 
 """Celery tasks for the events app."""
 
+@shared_task
+def send_ticket_email_job_chunk_task(job_id, ticket_ids):
+    from .models import TicketEmailJob
+
+    try:
+        job = TicketEmailJob.objects.get(pk=job_id)
+    except TicketEmailJob.DoesNotExist:
+        logger.warning(f"Skipping ticket email job chunk: job {job_id} does not exist.")
+        return f"Ticket email job {job_id} does not exist."
+
+    sent, failed = job.send_chunk(ticket_ids)
+
+    return f"Ticket email job {job_id}: {sent} sent, {failed} failed."
+
 @shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_jitter=True, max_retries=5)
-def send_ticket_email_task(ticket_id):
+def render_ticket_artifact_task(ticket_id):
+    from .artifacts import get_ticket_artifact
+
     try:
-        ticket = Ticket.objects.get(pk=ticket_id)
+        ticket = Ticket.objects.select_related('event__location', 'price_class').get(pk=ticket_id)
     except Ticket.DoesNotExist:
-        logger.warning(f"Skipping ticket email task: ticket {ticket_id} does not exist.")
+        logger.warning(f"Skipping ticket artifact task: ticket {ticket_id} does not exist.")
         return f"Ticket {ticket_id} does not exist."
 
-    ticket.send_to_email()
+    artifact = get_ticket_artifact(ticket)
 
-    return f"Ticket email sent for ticket {ticket_id} to {ticket.email}."
+    return f"Ticket PDF stored for ticket {ticket_id} ({artifact.content_hash[:12]})."
 
 @shared_task
 def send_global_statistics_report_task():
@@ -1,23 +1,47 @@
 import csv
+import gzip
+import json
+import shutil
+import smtplib
+import tempfile
+import time
 from datetime import datetime
 from datetime import timedelta
-from io import StringIO
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
 from django.contrib import admin
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
 from django.urls import reverse
-from django.test import RequestFactory, TestCase
-from django.utils import timezone
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone, translation
 
 from payments import get_payment_model
+from PIL import Image as PILImage
 
 from accounting.models import get_order_create_defaults
+from cinema_tickets import mail as pooled_mail
+from cinema_tickets import pdf_rendering
 from branding.models import Branding
 from events.admin import EventAdmin
-from events.models import Event, Location, PriceClass, Ticket
+from events.artifacts import get_ticket_artifact, read_ticket_pdf
+from events.checkin import CHECKIN_ALREADY_USED, CHECKIN_INVALID, CHECKIN_NOT_FOUND, CHECKIN_NOT_SOLD, CHECKIN_STALE, CHECKIN_SUCCESS, check_in, event_manifest, sync_scans
+from events.models import Event, Location, PriceClass, SoldAsStatus, Ticket, TicketArtifact, TicketEmailJob, TicketStatsRollup, generate_pdf_tickets, new_ticket_pdf
+from events.qr import InvalidQRCode, decode_ticket_qr, encode_ticket_qr
+from events.seating import SoldOutError, allocate
+from events.stats_cache import event_statistics, event_statistics_pdf
+from events.ticket_template import clear_ticket_templates, draw_qr_code, get_ticket_template, ticket_pdf_bytes
+from events.views import get_all_event_statistics
 
 
 class EventAdminDownloadTemplateCsvTests(TestCase):
@@ -235,3 +259,925 @@ class UpdateTicketNameAuthorizationTests(TestCase):
         self.ticket.refresh_from_db()
         self.assertEqual(self.ticket.first_name, 'New')
         self.assertEqual(self.ticket.last_name, 'Customer')
+
+
+class SeatAllocationTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Seating Hall', total_seats=100)
+        self.event = Event.objects.create(
+            name='Seating Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+
+    def test_allocate_reserves_contiguous_block_after_existing_seats(self):
+        Ticket.objects.create(event=self.event, price_class=self.price_class, seat=7)
+
+        tickets = allocate(self.event, self.price_class, 3, email='buyer@example.com')
+
+        self.assertEqual([ticket.seat for ticket in tickets], [8, 9, 10])
+        self.assertEqual(Ticket.objects.filter(event=self.event, email='buyer@example.com').count(), 3)
+
+    def test_single_ticket_save_continues_after_allocated_block(self):
+        allocate(self.event, self.price_class, 2)
+
+        ticket = Ticket.objects.create(event=self.event, price_class=self.price_class)
+
+        self.assertEqual(ticket.seat, 3)
+        self.assertEqual([ticket.seat for ticket in allocate(self.event, self.price_class, 2)], [4, 5])
+
+    def test_allocate_query_count_does_not_grow_with_quantity(self):
+        allocate(self.event, self.price_class, 1)
+
+        with CaptureQueriesContext(connection) as small_order:
+            allocate(self.event, self.price_class, 2)
+        with CaptureQueriesContext(connection) as large_order:
+            allocate(self.event, self.price_class, 25)
+
+        self.assertEqual(len(small_order), len(large_order))
+
+
+class EventInventoryTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Inventory Hall', total_seats=5)
+        self.event = Event.objects.create(
+            name='Inventory Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+
+    def test_allocate_rejects_orders_beyond_capacity(self):
+        allocate(self.event, self.price_class, 4)
+
+        with self.assertRaises(SoldOutError):
+            allocate(self.event, self.price_class, 2)
+
+        self.assertEqual(Ticket.objects.filter(event=self.event).count(), 4)
+        self.assertEqual(self.event.remaining_seats, 1)
+
+    def test_single_ticket_save_rejects_tickets_beyond_capacity(self):
+        allocate(self.event, self.price_class, 5)
+
+        with self.assertRaises(SoldOutError):
+            Ticket.objects.create(event=self.event, price_class=self.price_class)
+
+        self.assertEqual(Ticket.objects.filter(event=self.event).count(), 5)
+
+    def test_counters_follow_payment_and_deletion(self):
+        tickets = allocate(self.event, self.price_class, 2, sold_as=SoldAsStatus.WAITING)
+        Ticket.objects.create(event=self.event, price_class=self.price_class, sold_as=SoldAsStatus.DOOR)
+
+        tickets[0].sold_as = SoldAsStatus.PRESALE_ONLINE
+        tickets[0].save()
+        Ticket.objects.get(pk=tickets[1].pk).delete()
+
+        self.event.refresh_from_db()
+        self.assertEqual((self.event.inventory.held, self.event.inventory.sold), (0, 2))
+        self.assertEqual(self.event.remaining_seats, 3)
+
+    def test_inventory_counts_existing_tickets_on_first_use(self):
+        Ticket.objects.create(event=self.event, price_class=self.price_class, seat=1, sold_as=SoldAsStatus.PRESALE_ONLINE)
+        Ticket.objects.create(event=self.event, price_class=self.price_class, seat=2, sold_as=SoldAsStatus.WAITING)
+
+        self.assertEqual(self.event.remaining_seats, 3)
+        with self.assertNumQueries(0):
+            self.assertFalse(self.event.is_sold_out)
+
+
+class EventStatisticsTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Statistics Hall', total_seats=100)
+        self.event = Event.objects.create(
+            name='Statistics Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.standard = PriceClass.objects.create(name='Standard', price='10.00')
+        self.reduced = PriceClass.objects.create(name='Reduced', price='6.50')
+        self.event.price_classes.add(self.standard, self.reduced)
+
+        allocate(self.event, self.standard, 2, sold_as=SoldAsStatus.PRESALE_ONLINE, activated=True)
+        allocate(self.event, self.standard, 1, sold_as=SoldAsStatus.WAITING)
+        allocate(self.event, self.reduced, 3, sold_as=SoldAsStatus.DOOR, activated=True)
+        allocate(self.event, self.reduced, 1, sold_as=SoldAsStatus.PRESALE_ONLINE_WAITING, activated=True)
+
+    def test_calculate_statistics_folds_counts_and_earnings(self):
+        total_stats, price_class_stats = self.event.calculate_statistics()
+
+        self.assertEqual(total_stats['total_count'], 7)
+        self.assertEqual(total_stats['total_sold'], 5)
+        self.assertEqual(total_stats['total_activated'], 6)
+        self.assertEqual(total_stats['activated_door'], 3)
+        self.assertEqual(total_stats['total_earned'], Decimal('39.50'))
+        self.assertEqual(price_class_stats[self.standard]['waiting'], 1)
+        self.assertEqual(price_class_stats[self.standard]['earned_presale_online'], Decimal('20.00'))
+        self.assertEqual(price_class_stats[self.reduced]['presale_online_waiting'], 1)
+        self.assertEqual(price_class_stats[self.reduced]['total_activated'], 3)
+        self.assertEqual(price_class_stats[self.reduced]['earned_door'], Decimal('19.50'))
+
+    def test_calculate_statistics_query_budget(self):
+        PriceClass.objects.bulk_create([PriceClass(name=f'Extra {index}', price='1.00') for index in range(5)])
+        self.event.price_classes.add(*PriceClass.objects.filter(name__startswith='Extra'))
+
+        with self.assertNumQueries(2):
+            self.event.calculate_statistics()
+
+
+class AllEventStatisticsTests(TestCase):
+
+    def setUp(self):
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        self.events = []
+        for index in range(2):
+            location = Location.objects.create(name=f'Hall {index}', total_seats=50)
+            event = Event.objects.create(
+                name=f'Screening {index}',
+                start_time=timezone.now() + timedelta(days=index),
+                duration=timedelta(hours=2),
+                location=location,
+            )
+            event.price_classes.add(self.price_class)
+            allocate(event, self.price_class, index + 1, sold_as=SoldAsStatus.PRESALE_ONLINE)
+            self.events.append(event)
+
+    def test_rollups_per_event_location_and_overall(self):
+        events_stats, per_location_stats, overall_total_stats, overall_refunded = get_all_event_statistics()
+
+        self.assertEqual([entry['event'] for entry in events_stats], self.events)
+        self.assertEqual([entry['total_stats']['total_sold'] for entry in events_stats], [1, 2])
+        self.assertEqual(events_stats[1]['price_class_stats'][self.price_class]['total_earned'], Decimal('20.00'))
+        self.assertEqual(sorted(entry['stats']['total_sold'] for entry in per_location_stats), [1, 2])
+        self.assertEqual(overall_total_stats['total_earned'], Decimal('30.00'))
+        self.assertEqual(overall_refunded, {'total_refunded': 0, 'total_amount_refunded': Decimal('0.0')})
+
+    def test_query_count_does_not_grow_with_events(self):
+        with CaptureQueriesContext(connection) as two_events:
+            get_all_event_statistics()
+
+        for index in range(2, 6):
+            location = Location.objects.create(name=f'Hall {index}', total_seats=50)
+            event = Event.objects.create(
+                name=f'Screening {index}',
+                start_time=timezone.now() + timedelta(days=index),
+                duration=timedelta(hours=2),
+                location=location,
+            )
+            event.price_classes.add(self.price_class)
+            allocate(event, self.price_class, 1, sold_as=SoldAsStatus.DOOR)
+
+        with CaptureQueriesContext(connection) as six_events:
+            get_all_event_statistics()
+
+        self.assertEqual(len(two_events), len(six_events))
+
+
+class TicketStatsRollupTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Rollup Hall', total_seats=100)
+        self.event = Event.objects.create(
+            name='Rollup Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='8.00')
+        self.event.price_classes.add(self.price_class)
+
+    def _rollups(self):
+        return {
+            (rollup.sold_as, rollup.activated): (rollup.count, rollup.revenue)
+            for rollup in TicketStatsRollup.objects.filter(event=self.event, count__gt=0)
+        }
+
+    def test_rollup_follows_ticket_changes(self):
+        tickets = allocate(self.event, self.price_class, 3, sold_as=SoldAsStatus.PRESALE_ONLINE)
+        tickets[0].activated = True
+        tickets[0].save()
+        Ticket.objects.get(pk=tickets[1].pk).delete()
+
+        self.assertEqual(self._rollups(), {
+            (SoldAsStatus.PRESALE_ONLINE, False): (1, Decimal('8.00')),
+            (SoldAsStatus.PRESALE_ONLINE, True): (1, Decimal('8.00')),
+        })
+
+        self.price_class.price = Decimal('9.50')
+        self.price_class.save()
+        total_stats, _ = self.event.calculate_statistics()
+        self.assertEqual(total_stats['total_earned'], Decimal('19.00'))
+
+    def test_rebuild_stats_recounts_from_tickets(self):
+        allocate(self.event, self.price_class, 2, sold_as=SoldAsStatus.DOOR, activated=True)
+        expected = self._rollups()
+        TicketStatsRollup.objects.all().delete()
+
+        call_command('rebuild_stats', stdout=StringIO())
+
+        self.assertEqual(self._rollups(), expected)
+
+
+class StatisticsCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.location = Location.objects.create(name='Cache Hall', total_seats=100)
+        self.event = Event.objects.create(
+            name='Cache Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        self.event.price_classes.add(self.price_class)
+        allocate(self.event, self.price_class, 2, sold_as=SoldAsStatus.DOOR)
+
+    def test_event_statistics_pdf_is_cached_until_tickets_change(self):
+        first = event_statistics_pdf(self.event)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(event_statistics_pdf(self.event), first)
+
+        allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.DOOR)
+        self.event.refresh_from_db()
+        total_stats, _ = event_statistics(self.event)
+        self.assertEqual(total_stats['door'], 3)
+
+    def test_all_event_statistics_recompute_only_changed_events(self):
+        other_event = Event.objects.create(
+            name='Other Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        get_all_event_statistics()
+
+        allocate(other_event, self.price_class, 1, sold_as=SoldAsStatus.DOOR)
+        with CaptureQueriesContext(connection) as queries:
+            events_stats, _, overall_total_stats, _ = get_all_event_statistics()
+
+        rollup_queries = [query['sql'] for query in queries if 'events_ticketstatsrollup' in query['sql']]
+        self.assertEqual(len(rollup_queries), 1)
+        self.assertNotIn(str(self.event.pk).replace('-', ''), rollup_queries[0])
+        self.assertEqual(overall_total_stats['door'], 3)
+
+    def test_rebuild_stats_invalidates_cached_statistics(self):
+        # drifted counts, changed without going through apply_ticket_delta
+        TicketStatsRollup.objects.filter(event=self.event).update(count=5)
+        total_stats, _ = event_statistics(Event.objects.get(pk=self.event.pk))
+        self.assertEqual(total_stats['door'], 5)
+
+        call_command('rebuild_stats', stdout=StringIO())
+
+        total_stats, _ = event_statistics(Event.objects.get(pk=self.event.pk))
+        self.assertEqual(total_stats['door'], 2)
+
+    def test_event_statistics_page_renders(self):
+        admin_user = get_user_model().objects.create_superuser(username='stats', email='stats@example.com', password='password')
+        self.client.force_login(admin_user)
+
+        response = self.client.get(reverse('event_statistics', args=[self.event.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_stats']['door'], 2)
+
+
+class TicketTemplateTests(TestCase):
+
+    def setUp(self):
+        clear_ticket_templates()
+        self.location = Location.objects.create(name='Template Hall', total_seats=50)
+        self.event = Event.objects.create(
+            name='Template Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+
+    def test_template_is_compiled_once_per_event_version(self):
+        first = get_ticket_template(self.event)
+        self.assertIs(get_ticket_template(Event.objects.get(pk=self.event.pk)), first)
+
+        self.event.name = 'Renamed Event'
+        self.event.save()
+
+        renamed = get_ticket_template(self.event)
+        self.assertIsNot(renamed, first)
+        self.assertEqual(renamed.event_name, 'Renamed Event')
+
+    def test_template_key_is_not_queried_again_and_follows_branding_changes(self):
+        branding = Branding.objects.create(name='Template Branding', is_active=True)
+        event = Event.objects.select_related('location').get(pk=self.event.pk)
+        first = get_ticket_template(event)
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_ticket_template(event), first)
+
+        branding.display_seat_number = not branding.display_seat_number
+        branding.save()
+        self.assertIsNot(get_ticket_template(event), first)
+
+    def test_background_is_decoded_once_per_template(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        background = BytesIO()
+        PILImage.new('RGB', (210, 85), 'navy').save(background, format='PNG')
+
+        with override_settings(MEDIA_ROOT=media_root):
+            self.event.custom_ticket_background = SimpleUploadedFile('background.png', background.getvalue(), content_type='image/png')
+            self.event.save()
+            tickets = allocate(self.event, self.price_class, 2)
+
+            with mock.patch('fpdf.image_parsing.get_img_info') as fpdf_get_img_info:
+                outputs = [ticket.generate_pdf_ticket().output() for ticket in tickets]
+                outputs.append(generate_pdf_tickets(tickets).output())
+
+        fpdf_get_img_info.assert_not_called()
+        # one embedded background per PDF, shared by its pages
+        self.assertEqual([output.count(b'/Subtype /Image') for output in outputs], [1, 1, 1])
+
+    def test_generate_pdf_tickets_renders_a_page_per_ticket(self):
+        tickets = allocate(self.event, self.price_class, 3)
+
+        self.assertEqual(generate_pdf_tickets(tickets).pages_count, 3)
+        self.assertEqual(tickets[0].generate_pdf_ticket().pages_count, 1)
+
+    def test_ticket_pdf_bytes_reuses_rendering_until_ticket_changes(self):
+        ticket = allocate(self.event, self.price_class, 1)[0]
+        first = ticket_pdf_bytes(ticket)
+
+        with self.assertNumQueries(0):
+            self.assertIs(ticket_pdf_bytes(ticket), first)
+
+        ticket.first_name = 'Changed'
+        self.assertIsNot(ticket_pdf_bytes(ticket), first)
+
+    def test_qr_code_is_drawn_without_temp_files(self):
+        pdf = new_ticket_pdf()
+        pdf.add_page()
+
+        with mock.patch('tempfile.NamedTemporaryFile') as named_temporary_file:
+            draw_qr_code(pdf, 'ticket-id', x=15.5, y=0.0, size=5)
+            allocate(self.event, self.price_class, 1)[0].generate_pdf_ticket()
+
+        named_temporary_file.assert_not_called()
+
+
+class TicketArtifactTests(TestCase):
+
+    def setUp(self):
+        clear_ticket_templates()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.location = Location.objects.create(name='Artifact Hall', total_seats=50)
+        self.event = Event.objects.create(
+            name='Artifact Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        self.ticket = allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.PRESALE_ONLINE)[0]
+
+    def test_artifact_is_stored_once_until_printed_fields_change(self):
+        artifact = get_ticket_artifact(self.ticket)
+        self.assertTrue(artifact.pdf.name.startswith('ticket_artifacts/'))
+
+        with mock.patch('events.artifacts.ticket_pdf_bytes') as ticket_pdf_bytes_mock:
+            self.assertEqual(get_ticket_artifact(Ticket.objects.get(pk=self.ticket.pk)).pk, artifact.pk)
+            self.ticket.activated = True
+            self.ticket.save()
+            get_ticket_artifact(self.ticket)
+        ticket_pdf_bytes_mock.assert_not_called()
+
+        old_name = artifact.pdf.name
+        self.ticket.first_name = 'Changed'
+        self.ticket.save()
+        renamed = get_ticket_artifact(self.ticket)
+        self.assertNotEqual(renamed.fingerprint, artifact.fingerprint)
+        self.assertFalse(renamed.pdf.storage.exists(old_name))
+        self.assertEqual(TicketArtifact.objects.count(), 1)
+
+        self.event.name = 'Renamed Event'
+        self.event.save()
+        self.assertNotEqual(get_ticket_artifact(self.ticket).fingerprint, renamed.fingerprint)
+
+    def test_artifact_is_not_rendered_again_for_another_language(self):
+        with translation.override('de'):
+            artifact = get_ticket_artifact(self.ticket)
+
+        with translation.override('en'), mock.patch('events.artifacts.ticket_pdf_bytes') as ticket_pdf_bytes_mock:
+            self.assertEqual(get_ticket_artifact(self.ticket).fingerprint, artifact.fingerprint)
+        ticket_pdf_bytes_mock.assert_not_called()
+
+    def test_pending_tickets_are_not_stored(self):
+        ticket = allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.WAITING)[0]
+
+        ticket_pdf = read_ticket_pdf(ticket)
+
+        self.assertTrue(ticket_pdf.content.startswith(b'%PDF'))
+        self.assertIsNone(ticket_pdf.last_modified)
+        self.assertFalse(TicketArtifact.objects.filter(ticket=ticket).exists())
+
+    def test_ticket_becoming_final_queues_rendering(self):
+        ticket = allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.PRESALE_ONLINE_WAITING)[0]
+
+        with override_settings(EMAILS_ASYNC=True), mock.patch('events.tasks.render_ticket_artifact_task.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                ticket.save()
+            delay.assert_not_called()
+
+            with self.captureOnCommitCallbacks(execute=True):
+                ticket.sold_as = SoldAsStatus.PRESALE_ONLINE
+                ticket.save()
+        delay.assert_called_once_with(str(ticket.pk))
+
+    def test_download_serves_stored_pdf_with_validators(self):
+        url = reverse('show_generated_ticket_pdf', args=[self.ticket.pk])
+
+        response = self.client.get(url)
+        content = b''.join(response.streaming_content)
+        artifact = TicketArtifact.objects.get(ticket=self.ticket)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{artifact.content_hash}"')
+        self.assertIn('Last-Modified', response)
+        with artifact.pdf.open('rb') as stored:
+            self.assertEqual(content, stored.read())
+
+        not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_deleting_ticket_removes_stored_pdf(self):
+        artifact = get_ticket_artifact(self.ticket)
+        storage, name = artifact.pdf.storage, artifact.pdf.name
+
+        self.ticket.delete()
+
+        self.assertFalse(storage.exists(name))
+
+
+def _slow_pdf():
+    time.sleep(2)
+    return new_ticket_pdf()
+
+
+class PDFRenderingTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(pdf_rendering.shutdown)
+
+    def test_renders_inline_without_workers(self):
+        with override_settings(PDF_RENDER_WORKERS=0), mock.patch.object(pdf_rendering, 'ProcessPoolExecutor') as executor:
+            pdf_bytes = pdf_rendering.render_pdf(generate_pdf_tickets, [])
+
+        executor.assert_not_called()
+        self.assertTrue(pdf_bytes.startswith(b'%PDF'))
+
+    def test_renders_in_worker_process(self):
+        with override_settings(PDF_RENDER_WORKERS=1):
+            pdf_bytes = pdf_rendering.render_pdf(generate_pdf_tickets, [])
+
+        self.assertTrue(pdf_bytes.startswith(b'%PDF'))
+        self.assertIsNotNone(pdf_rendering._executor)
+
+    def test_slow_job_times_out_and_stops_its_worker(self):
+        with override_settings(PDF_RENDER_WORKERS=1):
+            # start the worker first, so only the slow job runs into the short timeout
+            pdf_rendering.render_pdf(generate_pdf_tickets, [])
+            processes = list(pdf_rendering._executor._processes.values())
+
+            with override_settings(PDF_RENDER_TIMEOUT=0.5), self.assertRaises(pdf_rendering.PDFRenderTimeout):
+                pdf_rendering.render_pdf(_slow_pdf)
+
+            for process in processes:
+                process.join(timeout=5)
+            self.assertFalse(any(process.is_alive() for process in processes))
+            self.assertIsNone(pdf_rendering._executor)
+            self.assertTrue(pdf_rendering.render_pdf(generate_pdf_tickets, []).startswith(b'%PDF'))
+
+    def test_full_queue_is_rejected_instead_of_rendered_inline(self):
+        build = mock.Mock()
+        with override_settings(PDF_RENDER_WORKERS=1, PDF_RENDER_MAX_PENDING=1):
+            _executor, pending = pdf_rendering._get_executor()
+            pending.acquire()
+            self.addCleanup(pending.release)
+
+            with self.assertRaises(pdf_rendering.PDFRenderBusy):
+                pdf_rendering.render_pdf(build)
+
+        build.assert_not_called()
+        response = pdf_rendering.PDFRenderingUnavailableMiddleware(None).process_exception(None, pdf_rendering.PDFRenderBusy())
+        self.assertEqual(response.status_code, 503)
+
+
+class FlakyEmailBackend(LocmemEmailBackend):
+    """Locmem backend whose first connection drops after the first message."""
+    opened = 0
+
+    def open(self):
+        FlakyEmailBackend.opened += 1
+        self.first_connection = FlakyEmailBackend.opened == 1
+        return super().open()
+
+    def send_messages(self, messages):
+        if self.first_connection and len(mail.outbox) == 1:
+            raise smtplib.SMTPServerDisconnected("connection dropped")
+        return super().send_messages(messages)
+
+
+class RefusingEmailBackend(LocmemEmailBackend):
+    """Locmem backend that refuses messages to refused@example.com."""
+
+    def send_messages(self, messages):
+        for message in messages:
+            if 'refused@example.com' in message.to:
+                raise smtplib.SMTPRecipientsRefused({'refused@example.com': (550, b'unknown user')})
+        return super().send_messages(messages)
+
+
+class PooledMailTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        pooled_mail.close_connection()
+        self.addCleanup(pooled_mail.close_connection)
+        self.location = Location.objects.create(name='Mail Hall', total_seats=50)
+        self.event = Event.objects.create(
+            name='Mail Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+
+    def test_batched_ticket_emails_share_one_connection(self):
+        tickets = allocate(self.event, self.price_class, 3, email='door@example.com', sold_as=SoldAsStatus.DOOR)
+        tickets += allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.DOOR)
+
+        with override_settings(EMAILS_ASYNC=False), mock.patch(
+            'cinema_tickets.mail.mail.get_connection', wraps=mail.get_connection
+        ) as get_connection:
+            Ticket.queue_send_emails(tickets)
+            Ticket.objects.get(pk=tickets[0].pk).send_to_email()
+
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_batch_is_not_sent_when_block_fails(self):
+        with self.assertRaises(ValueError):
+            with pooled_mail.batch():
+                pooled_mail.send_email(mail.EmailMessage('Subject', 'Body', to=['a@example.com']))
+                raise ValueError('failed')
+
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_reconnects_and_sends_remaining_messages(self):
+        FlakyEmailBackend.opened = 0
+        messages = [mail.EmailMessage('Subject', 'Body', to=[f'{index}@example.com']) for index in range(3)]
+
+        with override_settings(EMAIL_BACKEND='events.tests.FlakyEmailBackend'):
+            self.assertEqual(pooled_mail.send_messages(messages), 3)
+
+        self.assertEqual(FlakyEmailBackend.opened, 2)
+        self.assertEqual([message.to[0] for message in mail.outbox], ['0@example.com', '1@example.com', '2@example.com'])
+
+    @override_settings(EMAIL_BACKEND='events.tests.RefusingEmailBackend', MAIL_BATCH_SIZE=2)
+    def test_failure_after_sent_messages_reports_the_sent_count(self):
+        addresses = ['a@example.com', 'b@example.com', 'c@example.com', 'refused@example.com', 'd@example.com']
+
+        with self.assertRaises(pooled_mail.PartialSendError) as raised:
+            with pooled_mail.batch():
+                for address in addresses:
+                    pooled_mail.send_email(mail.EmailMessage('Subject', 'Body', to=[address]))
+
+        self.assertEqual(raised.exception.sent, 3)
+        self.assertIsInstance(raised.exception.__cause__, smtplib.SMTPRecipientsRefused)
+        self.assertEqual([message.to[0] for message in mail.outbox], addresses[:3])
+
+    @override_settings(EMAIL_BACKEND='events.tests.RefusingEmailBackend')
+    def test_failure_before_any_message_is_sent_is_raised_as_is(self):
+        messages = [mail.EmailMessage('Subject', 'Body', to=[address]) for address in ['refused@example.com', 'a@example.com']]
+
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            pooled_mail.send_messages(messages)
+
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class TicketEmailJobTests(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.location = Location.objects.create(name='Resend Hall', total_seats=50)
+        self.event = Event.objects.create(
+            name='Resend Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='10.00')
+        allocate(self.event, self.price_class, 5, email='guest@example.com', sold_as=SoldAsStatus.PRESALE_ONLINE)
+        allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.PRESALE_ONLINE)
+
+    def test_job_is_sent_in_chunks_of_a_celery_group(self):
+        with override_settings(EMAILS_ASYNC=True), mock.patch('celery.group') as group:
+            with self.captureOnCommitCallbacks(execute=True):
+                job = TicketEmailJob.start(Ticket.objects.filter(event=self.event), chunk_size=2)
+
+        chunk_signatures = list(group.call_args.args[0])
+        group.return_value.apply_async.assert_called_once()
+        self.assertEqual(len(chunk_signatures), 3)
+        self.assertEqual((job.total, job.status), (5, TicketEmailJob.STATUS_RUNNING))
+        self.assertEqual(len(mail.outbox), 0)
+
+        for signature in chunk_signatures:
+            signature.apply()
+
+        job.refresh_from_db()
+        self.assertEqual((job.sent, job.failed, job.progress), (5, 0, 100))
+        self.assertEqual(job.status, TicketEmailJob.STATUS_DONE)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_admin_action_starts_job(self):
+        admin_user = get_user_model().objects.create_superuser(username='resend', email='resend@example.com', password='password')
+        self.client.force_login(admin_user)
+        tickets = Ticket.objects.filter(event=self.event)
+
+        with override_settings(EMAILS_ASYNC=False):
+            response = self.client.post(
+                reverse('admin:events_ticket_changelist'),
+                {'action': 'send_ticket_email_selected', '_selected_action': [str(pk) for pk in tickets.values_list('pk', flat=True)]},
+                follow=True,
+            )
+
+        job = TicketEmailJob.objects.get()
+        self.assertEqual((job.total, job.sent, job.status), (5, 5, TicketEmailJob.STATUS_DONE))
+        self.assertContains(response, reverse('admin:events_ticketemailjob_change', args=[job.pk]))
+        self.assertContains(self.client.get(reverse('admin:events_ticketemailjob_changelist')), '<progress value="100"')
+
+
+class CheckInTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='Gate Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='Gate Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='8.00')
+        self.ticket = allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.PRESALE_ONLINE, first_name='Ada')[0]
+
+    def test_ticket_is_checked_in_once(self):
+        # the first check-in of the event creates the rollup row of activated tickets
+        earlier = allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.PRESALE_ONLINE)[0]
+        self.assertEqual(check_in(self.event.pk, earlier.pk).status, CHECKIN_SUCCESS)
+        self.event.inventory.refresh_from_db()
+        version = self.event.inventory.stats_version
+
+        with CaptureQueriesContext(connection) as queries:
+            result = check_in(self.event.pk, self.ticket.pk)
+
+        self.assertEqual(result.status, CHECKIN_SUCCESS)
+        self.assertEqual((result.ticket['first_name'], result.ticket['price_class__name']), ('Ada', 'Standard'))
+        statements = [query['sql'] for query in queries if not query['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+        # conditional update, detail read, change sequence and statistics version, change number of the ticket, rollups
+        self.assertEqual(len(statements), 5, statements)
+        self.assertTrue(statements[0].startswith('UPDATE "events_ticket"'))
+
+        self.assertEqual(check_in(self.event.pk, self.ticket.pk).status, CHECKIN_ALREADY_USED)
+        self.assertEqual(
+            set(TicketStatsRollup.objects.filter(event=self.event, count__gt=0).values_list('activated', 'count')),
+            {(True, 2)},
+        )
+        self.event.inventory.refresh_from_db()
+        self.assertEqual(self.event.inventory.stats_version, version + 1)
+        self.ticket.refresh_from_db()
+        self.assertEqual(self.ticket.change_seq, self.event.inventory.change_seq)
+
+    def test_unpaid_unknown_and_foreign_tickets_are_rejected(self):
+        waiting = allocate(self.event, self.price_class, 1)[0]
+        other_event = Event.objects.create(
+            name='Other Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+
+        self.assertEqual(check_in(self.event.pk, waiting.pk).status, CHECKIN_NOT_SOLD)
+        self.assertEqual(check_in(other_event.pk, self.ticket.pk).status, CHECKIN_NOT_FOUND)
+        self.assertEqual(check_in(self.event.pk, 'not-a-ticket').status, CHECKIN_NOT_FOUND)
+        waiting.refresh_from_db()
+        self.assertFalse(waiting.activated)
+
+    def test_scan_endpoint_reports_ticket_holder(self):
+        checker = get_user_model().objects.create_superuser(username='gate', email='gate@example.com', password='password')
+        self.client.force_login(checker)
+        url = reverse('handle_qr_result', args=[self.event.pk])
+
+        response = self.client.post(url, {'qr_code': str(self.ticket.pk)})
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(response.json()['first_name'], 'Ada')
+
+        response = self.client.post(url, {'qr_code': str(self.ticket.pk)})
+        self.assertEqual(response.json()['status'], 'error')
+
+    def test_scan_endpoint_rejects_forged_codes_before_lookups(self):
+        checker = get_user_model().objects.create_superuser(username='gate', email='gate@example.com', password='password')
+        self.client.force_login(checker)
+        url = reverse('handle_qr_result', args=[self.event.pk])
+        code = encode_ticket_qr(self.ticket)
+        forged = code[:-2] + ('AA' if not code.endswith('AA') else 'BB')
+
+        with mock.patch('events.views.check_in') as check_in_mock, mock.patch('events.views.get_object_or_404') as event_lookup:
+            response = self.client.post(url, {'qr_code': forged})
+        self.assertEqual(response.json()['status'], 'error')
+        check_in_mock.assert_not_called()
+        event_lookup.assert_not_called()
+
+        response = self.client.post(url, {'qr_code': code})
+        self.assertEqual(response.json()['status'], 'success')
+
+
+    def test_manifest_lists_sold_tickets(self):
+        allocate(self.event, self.price_class, 1)
+        door = allocate(self.event, self.price_class, 10, sold_as=SoldAsStatus.DOOR, activated=True)[0]
+        checker = get_user_model().objects.create_superuser(username='gate', email='gate@example.com', password='password')
+        self.client.force_login(checker)
+
+        response = self.client.get(reverse('event_check_in_manifest', args=[self.event.pk]), HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        manifest = json.loads(gzip.decompress(response.content))
+        self.assertEqual(manifest['price_classes'], {str(self.price_class.pk): 'Standard'})
+        self.assertEqual(len(manifest['tickets']), 11)
+        self.assertEqual(manifest['tickets'][:2], [
+            [self.ticket.pk.hex[:12], self.ticket.seat, self.price_class.pk, 0],
+            [door.pk.hex[:12], door.seat, self.price_class.pk, 1],
+        ])
+        self.assertIsNotNone(door.activation_changed_at)
+
+    def test_offline_scans_are_synced_in_one_batch(self):
+        second, deactivated = allocate(self.event, self.price_class, 2, sold_as=SoldAsStatus.PRESALE_ONLINE)
+        scanned_at = timezone.now() - timedelta(minutes=5)
+        # deactivated by hand after the offline scan, the later change wins
+        deactivated.activated = True
+        deactivated.save()
+        deactivated.activated = False
+        deactivated.save()
+
+        results = sync_scans(self.event.pk, [
+            {'code': encode_ticket_qr(self.ticket), 'scanned_at': scanned_at.isoformat()},
+            {'code': str(second.pk), 'scanned_at': (scanned_at + timedelta(minutes=1)).isoformat()},
+            {'code': encode_ticket_qr(self.ticket), 'scanned_at': (scanned_at + timedelta(minutes=2)).isoformat()},
+            {'code': encode_ticket_qr(deactivated), 'scanned_at': scanned_at.isoformat()},
+            {'code': 'CT1:forged'},
+        ])
+
+        self.assertEqual(
+            [result.status for result in results],
+            [CHECKIN_SUCCESS, CHECKIN_SUCCESS, CHECKIN_ALREADY_USED, CHECKIN_STALE, CHECKIN_INVALID],
+        )
+        self.ticket.refresh_from_db()
+        self.assertTrue(self.ticket.activated)
+        self.assertEqual(self.ticket.activation_changed_at, scanned_at)
+        self.assertEqual(results[2].activation_changed_at, scanned_at)
+        self.assertEqual(
+            set(TicketStatsRollup.objects.filter(event=self.event, count__gt=0).values_list('activated', 'count')),
+            {(True, 2), (False, 1)},
+        )
+
+    def test_sync_endpoint_reports_conflicts(self):
+        checker = get_user_model().objects.create_superuser(username='gate', email='gate@example.com', password='password')
+        self.client.force_login(checker)
+        url = reverse('event_check_in_sync', args=[self.event.pk])
+        scans = {'scans': [{'code': str(self.ticket.pk)}, {'code': str(self.ticket.pk)}]}
+
+        response = self.client.post(url, json.dumps(scans), content_type='application/json')
+
+        self.assertEqual(response.json()['applied'], 1)
+        self.assertEqual(response.json()['conflicts'], 1)
+        self.assertEqual(self.client.post(url, 'not json', content_type='application/json').status_code, 400)
+
+    def test_change_feed_returns_tickets_changed_after_cursor(self):
+        checker = get_user_model().objects.create_superuser(username='gate', email='gate@example.com', password='password')
+        self.client.force_login(checker)
+        cursor = event_manifest(self.event)['cursor']
+        other, unscanned = allocate(self.event, self.price_class, 2, sold_as=SoldAsStatus.PRESALE_ONLINE)
+        url = reverse('event_check_in_changes', args=[self.event.pk])
+
+        check_in(self.event.pk, self.ticket.pk)
+        sync_scans(self.event.pk, [{'code': str(other.pk)}])
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        ticket.activated = False
+        ticket.save()
+
+        changes = self.client.get(url, {'since': cursor}).json()
+        self.assertEqual(
+            [(change[5], change[3]) for change in changes['changes']],
+            [(str(unscanned.pk), 0), (str(other.pk), 1), (str(self.ticket.pk), 0)],
+        )
+        self.assertFalse(changes['more'])
+
+        unchanged = self.client.get(url, {'since': changes['cursor']}).json()
+        self.assertEqual((unchanged['changes'], unchanged['cursor']), ([], changes['cursor']))
+        self.assertEqual(self.client.get(url, {'since': 'x'}).status_code, 400)
+
+    def test_ticket_list_is_paged_and_filtered(self):
+        reduced = PriceClass.objects.create(name='Reduced', price='5.00')
+        allocate(self.event, self.price_class, 4, sold_as=SoldAsStatus.PRESALE_ONLINE, email='group@example.com')
+        allocate(self.event, reduced, 1, sold_as=SoldAsStatus.DOOR, activated=True, last_name='Lovelace')
+        allocate(self.event, self.price_class, 1)
+        checker = get_user_model().objects.create_superuser(username='gate', email='gate@example.com', password='password')
+        self.client.force_login(checker)
+        url = reverse('event_check_in_tickets', args=[self.event.pk])
+
+        seats = []
+        after = None
+        while True:
+            with CaptureQueriesContext(connection) as queries:
+                page = self.client.get(url, {'limit': 2, **({'after': after} if after else {})}).json()
+            self.assertLessEqual(len([query for query in queries if 'events_ticket' in query['sql']]), 1)
+            seats += [ticket['seat'] for ticket in page['tickets']]
+            after = page['next']
+            if not after:
+                break
+        # the waiting ticket is not listed
+        self.assertEqual(seats, [1, 2, 3, 4, 5, 6])
+
+        def filtered(**params):
+            return [ticket['seat'] for ticket in self.client.get(url, params).json()['tickets']]
+
+        self.assertEqual(filtered(search='love'), [6])
+        self.assertEqual(filtered(email='group@'), [2, 3, 4, 5])
+        self.assertEqual(filtered(search='3'), [3])
+        self.assertEqual(filtered(price_class=reduced.pk), [6])
+        self.assertEqual(filtered(activated='true'), [6])
+        self.assertEqual(self.client.get(url, {'after': 'bogus'}).status_code, 400)
+
+class TicketQRCodeTests(TestCase):
+
+    def setUp(self):
+        self.location = Location.objects.create(name='QR Hall', total_seats=20)
+        self.event = Event.objects.create(
+            name='QR Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+        self.price_class = PriceClass.objects.create(name='Standard', price='8.00')
+        self.ticket = allocate(self.event, self.price_class, 1, sold_as=SoldAsStatus.PRESALE_ONLINE)[0]
+
+    def test_signed_code_round_trips(self):
+        code = encode_ticket_qr(self.ticket)
+
+        self.assertTrue(code.startswith('CT1:'))
+        self.assertLess(len(code), 70)
+        self.assertEqual(decode_ticket_qr(code, self.event.pk), self.ticket.pk)
+        # tickets issued before signed codes carry the bare ticket id
+        self.assertEqual(decode_ticket_qr(str(self.ticket.pk), self.event.pk), self.ticket.pk)
+
+    def test_invalid_codes_are_rejected(self):
+        code = encode_ticket_qr(self.ticket)
+        other_event = Event.objects.create(
+            name='Other QR Event',
+            start_time=timezone.now(),
+            duration=timedelta(hours=2),
+            location=self.location,
+        )
+
+        with self.assertRaises(InvalidQRCode):
+            decode_ticket_qr(code, other_event.pk)
+        with self.assertRaises(InvalidQRCode):
+            decode_ticket_qr(code[:-4], self.event.pk)
+        with self.assertRaises(InvalidQRCode):
+            decode_ticket_qr('CT1:***', self.event.pk)
+        with self.assertRaises(InvalidQRCode):
+            decode_ticket_qr('garbage', self.event.pk)
+        with override_settings(TICKET_QR_SECRET='rotated'):
+            with self.assertRaises(InvalidQRCode):
+                decode_ticket_qr(code, self.event.pk)
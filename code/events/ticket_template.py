@@ -0,0 +1,324 @@
+"""
+Compiled ticket templates.
+
+Everything on a ticket that only depends on the event (name, start time, duration,
+venue, seat display, background) is resolved once per event and kept in a small
+in-process cache. Rendering a ticket then only stamps the ticket specific fields
+(seat, price class, holder, id and QR code) onto a page.
+
+The background image is decoded once per template and handed to every PDF the
+template renders into, so it is neither read nor decoded again per ticket PDF.
+
+Templates are keyed by a fingerprint of the event, its location, the active
+branding and the active language, so any change to those compiles a new template.
+The branding part is computed once per loaded active branding, which is cached
+until a branding is saved.
+
+QR codes are drawn as vector rectangles straight into the page, and rendered
+single ticket PDFs are kept in a bounded LRU so re-downloads skip rendering.
+"""
+
+from collections import OrderedDict
+import copy
+import threading
+
+import qrcode
+from fpdf.image_parsing import get_img_info
+
+from django.conf import settings
+from django.utils import translation
+from django.utils.translation import gettext as _
+
+from branding.models import get_active_branding
+from cinema_tickets.pdf_rendering import render_pdf
+
+from .qr import encode_ticket_qr
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+TEMPLATE_CACHE_SIZE = 128
+TICKET_PDF_CACHE_SIZE = 256
+TICKET_PDF_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class BoundedLRU:
+    """
+    Thread-safe LRU mapping bounded by the number of entries and, optionally, the total size of its values.
+    """
+
+    def __init__(self, max_items, max_bytes=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = len(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None and self.max_bytes is not None:
+                self._bytes -= len(previous)
+            self._items[key] = value
+            self._bytes += size
+            while len(self._items) > self.max_items or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                _key, evicted = self._items.popitem(last=False)
+                if self.max_bytes is not None:
+                    self._bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+_templates = BoundedLRU(TEMPLATE_CACHE_SIZE)
+_ticket_pdfs = BoundedLRU(TICKET_PDF_CACHE_SIZE, TICKET_PDF_CACHE_BYTES)
+
+FONT = "Helvetica"  # Default font
+BORDERS = 0
+
+
+class TicketTemplate:
+    """
+    The static part of the tickets of one event.
+    """
+
+    def __init__(self, event):
+        start_time = event.start_time_in_timezone
+        self.event_name = f"{event.name}"
+        self.start_text = f"{start_time.strftime('%H:%M %Z %d.%m.%Y')}"
+        self.duration_text = f"{event.duration_minutes} min"
+        self.check_side_start_text = f"{start_time.strftime('%H:%M %d.%m.%Y %Z')} {event.duration_minutes} min"
+        self.address = f"{event.location.get_address()}"
+        self.display_seat_number = event.display_seat_number
+        self.background_path = event.ticket_background_path
+        self.background_info = None
+        if self.background_path:
+            try:
+                self.background_info = get_img_info(self.background_path)
+            except Exception as e:
+                logger.error(f"Error loading template image: {e}")
+                self.background_path = None
+
+        # translated labels
+        self.start_label = _("Start:")
+        self.duration_label = _("Duration:")
+        self.venue_label = _("Venue:")
+        self.seat_label = _("Seat Number:")
+        self.free_seating_label = _("Free Seating")
+        self.price_class_label = _("Price Class:")
+        self.price_label = _("Price:")
+
+    def render(self, pdf, ticket):
+        """
+        Add a page for the given ticket to the ticket PDF.
+        """
+        # If a template is provided, use it as the canvas; pages of other events in the same PDF get their own
+        if self.background_path:
+            self._add_background(pdf)
+        pdf.set_page_background(self.background_path)
+
+        pdf.add_page()
+
+        # Add Event Title
+        pdf.set_font(FONT, size=18, style='B')
+        pdf.cell(14, 0.65, text=self.event_name, border=BORDERS, align='L')
+
+        # Add Ticket Details in a Layout
+        pdf.set_font(FONT, size=15)
+        pdf.ln(1.25)  # Move to the next line
+
+        pdf.cell(4.0, 0.6, text=self.start_label, border=BORDERS, align='L')
+        pdf.cell(5.0, 0.6, text=self.start_text, border=BORDERS, align='L')
+
+        pdf.cell(3.0, 0.6, text=self.duration_label, border=BORDERS, align='R')
+        pdf.cell(2.5, 0.6, text=self.duration_text, border=BORDERS, align='L')
+
+        pdf.ln(0.75)  # Move to the next line
+        pdf.cell(4.0, 0.6, text=self.venue_label, border=BORDERS, align='L')
+        pdf.cell(10.0, 0.6, text=self.address, border=BORDERS, align='L')
+
+        pdf.ln(0.75)  # Move to the next line
+        if self.display_seat_number:
+            pdf.cell(4.0, 0.6, text=self.seat_label, border=BORDERS, align='L')
+            pdf.cell(2.0, 0.6, text=f"{ticket.seat}", border=BORDERS, align='L')
+        else:
+            pdf.cell(4.0, 0.6, text=self.free_seating_label, border=BORDERS, align='L')
+
+        pdf.ln(1.25)  # Move to the next line
+        pdf.cell(4.0, 0.6, text=self.price_class_label, border=BORDERS, align='L')
+        pdf.cell(4.0, 0.6, text=f"{ticket.price_class.name}", border=BORDERS, align='L')
+        if ticket.price_class.notification_message:
+            pdf.ln(0.55)
+            pdf.set_font(FONT, size=10)
+            pdf.cell(4.0, 0.35, text="", border=BORDERS, align='L')
+            pdf.multi_cell(10.0, 0.35, text=f"{ticket.price_class.notification_message}", border=BORDERS, align='L')
+            pdf.set_font(FONT, size=15)
+            pdf.ln(0.1)
+        else:
+            pdf.ln(0.75)  # Move to the next line
+        pdf.cell(4.0, 0.6, text=self.price_label, border=BORDERS, align='L')
+        pdf.cell(4.0, 0.6, text=f"{ticket.price_class.price} {settings.DEFAULT_CURRENCY}", border=BORDERS, align='L')
+
+        # render ticket footer
+        pdf.set_font(FONT, size=10)
+        pdf.set_y(-0.75)  # Set position 2.5 cm from the bottom
+        pdf.cell(7, 0.4, text=f"{ticket.id}", border=BORDERS, align='L')
+        pdf.ln(-0.5)
+        pdf.cell(7.0, 0.4, text=f"{ticket.first_name} {ticket.last_name}", border=BORDERS, align='L')
+        pdf.cell(7.0, 0.4, text=f"{ticket.email}", border=BORDERS, align='L')
+
+        ## Ticket Check Side
+        # vertical line to divide ticket into two parts
+        pdf.line(14.75, 0.1, 14.75, 8.4)
+
+        # Add QR Code to the Bottom Right
+        draw_qr_code(pdf, encode_ticket_qr(ticket), x=15.5, y=0.0, size=5)  # Adjust size and position of the QR code
+
+        pdf.set_font(FONT, size=8)
+        pdf.set_y(5.2)  # Set x position for ticket check side
+        pdf.set_x(15.2)  # Set x position for ticket check side
+        pdf.cell(5.5, 0.5, text=self.event_name, border=BORDERS, align='C', new_y="NEXT", new_x="LEFT")
+        pdf.cell(5.5, 0.5, text=self.check_side_start_text, border=BORDERS, align='C', new_y="NEXT", new_x="LEFT")
+        if self.display_seat_number:
+            pdf.cell(5.5, 0.5, text=f"{ticket.seat}", border=BORDERS, align='C', new_y="NEXT", new_x="LEFT")
+        else:
+            pdf.cell(5.5, 0.5, text=self.free_seating_label, border=BORDERS, align='C', new_y="NEXT", new_x="LEFT")
+        pdf.cell(5.5, 0.5, text=self.address, border=BORDERS, align='C', new_y="NEXT", new_x="LEFT")
+
+
+    def _add_background(self, pdf):
+        """
+        Put the decoded background into the image cache of the PDF, once per PDF.
+        ``pdf.image()`` finds it there by its path and does not load the file again.
+        The image cache is internal to fpdf2, which is pinned in requirements.txt for that reason.
+        """
+        images = pdf.image_cache.images
+        if self.background_path in images:
+            return
+        info = copy.copy(self.background_info)
+        info["i"] = len(images) + 1
+        info["usages"] = 0
+        info["iccp_i"] = None
+        if info.get("iccp") is not None:
+            icc_profiles = pdf.image_cache.icc_profiles
+            info["iccp_i"] = icc_profiles.setdefault(info["iccp"], len(icc_profiles))
+            info["iccp"] = None
+        images[self.background_path] = info
+
+
+def _fields(instance):
+    if instance is None:
+        return None
+    return tuple(str(getattr(instance, field.attname)) for field in instance._meta.concrete_fields)
+
+
+def _branding_key():
+    """
+    Fingerprint of the active branding. It is kept on the cached branding instance,
+    which is replaced when a branding is saved.
+    """
+    branding = get_active_branding()
+    if branding is None:
+        return None
+    key = getattr(branding, '_ticket_template_key', None)
+    if key is None:
+        key = branding._ticket_template_key = _fields(branding)
+    return key
+
+
+def _template_key(event):
+    """
+    Fingerprint of everything a compiled template of the event depends on.
+    """
+    return (event.pk, _fields(event), _fields(event.location), _branding_key(), translation.get_language())
+
+
+def get_ticket_template(event):
+    """
+    Return the compiled ticket template of the event, compiling it on first use.
+    """
+    key = _template_key(event)
+    template = _templates.get(key)
+    if template is None:
+        template = TicketTemplate(event)
+        _templates.set(key, template)
+        logger.debug(f"Compiled ticket template for event {event.pk}")
+    return template
+
+
+def clear_ticket_templates():
+    _templates.clear()
+    _ticket_pdfs.clear()
+
+
+def draw_qr_code(pdf, data, x, y, size):
+    """
+    Draw a QR code for ``data`` as filled rectangles on the current page.
+    Dark modules of a row are merged into one rectangle per run; the quiet zone is painted white.
+    """
+    qr = qrcode.QRCode(version=1, border=4)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()  # includes the border
+    module = size / len(matrix)
+
+    pdf.set_fill_color(255, 255, 255)
+    pdf.rect(x, y, size, size, style='F')
+    pdf.set_fill_color(0, 0, 0)
+    for row_index, row in enumerate(matrix):
+        column = 0
+        while column < len(row):
+            if not row[column]:
+                column += 1
+                continue
+            run_start = column
+            while column < len(row) and row[column]:
+                column += 1
+            pdf.rect(x + run_start * module, y + row_index * module, (column - run_start) * module, module, style='F')
+
+
+def ticket_render_key(ticket):
+    """
+    Return a key that changes whenever anything printed on the ticket PDF changes.
+    """
+    price_class = ticket.price_class
+    return (
+        _template_key(ticket.event),
+        str(ticket.pk),
+        ticket.seat,
+        ticket.first_name,
+        ticket.last_name,
+        ticket.email,
+        price_class.pk,
+        price_class.name,
+        str(price_class.price),
+        price_class.notification_message,
+        # changes with the QR signing key
+        encode_ticket_qr(ticket),
+    )
+
+
+def ticket_pdf_bytes(ticket):
+    """
+    Return the single ticket PDF of ``ticket`` as bytes, reusing a previous rendering if nothing on it changed.
+    """
+    key = ticket_render_key(ticket)
+    pdf_bytes = _ticket_pdfs.get(key)
+    if pdf_bytes is None:
+        pdf_bytes = render_pdf(type(ticket).generate_pdf_ticket, ticket)
+        _ticket_pdfs.set(key, pdf_bytes)
+    return pdf_bytes
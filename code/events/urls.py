@@ -4,6 +4,10 @@ from .views import (
     event_detail,
     event_check_in,
     handle_qr_result,
+    event_check_in_manifest,
+    event_check_in_tickets,
+    event_check_in_changes,
+    event_check_in_sync,
     toggle_ticket_activation,
     delete_ticket,
     update_ticket_email,
@@ -23,6 +27,10 @@ urlpatterns = [
     path('<uuid:event_id>/check-in', event_check_in, name="event_check_in"),
     path('<uuid:event_id>/door-selling', event_door_selling, name="event_door_selling"),
     path('<uuid:event_id>/qr-result/', handle_qr_result, name="handle_qr_result"),
+    path('<uuid:event_id>/check-in/manifest', event_check_in_manifest, name="event_check_in_manifest"),
+    path('<uuid:event_id>/check-in/sync', event_check_in_sync, name="event_check_in_sync"),
+    path('<uuid:event_id>/check-in/changes', event_check_in_changes, name="event_check_in_changes"),
+    path('<uuid:event_id>/check-in/tickets', event_check_in_tickets, name="event_check_in_tickets"),
     path('toggle-ticket-activation/<uuid:ticket_id>/', toggle_ticket_activation, name='toggle_ticket_activation'),
     path('delete-ticket/<uuid:ticket_id>/', delete_ticket, name='delete_ticket'),  # Delete ticket URL
     path('update-ticket-email/<uuid:ticket_id>/', update_ticket_email, name='update_ticket_email'),  # Update ticket email URL
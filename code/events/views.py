@@ -2,14 +2,21 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.http import FileResponse, JsonResponse
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Sum
 from django.utils import timezone as django_timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.gzip import gzip_page
 
 from django.utils.translation import gettext as _
 
 import io
+import json
 import logging
 from datetime import datetime, timezone
 from decimal import Decimal
+from functools import partial
 from fpdf import FPDF
 
 logger = logging.getLogger(__name__)
@@ -23,6 +30,13 @@ from .models import Event, Ticket, SoldAsStatus, Location
 from .models import get_user_active_locations, is_admin_user, is_ticket_checker_user, is_ticket_manager_user, is_user_in_ticket_managers_group_or_admin, is_user_in_ticket_managers_or_checkers_group_or_admin
 from branding.models import get_active_branding
 from .forms import TicketSelectionForm
+from .seating import SoldOutError, allocate
+from .statistics import add_stats, collect_event_statistics, empty_stats
+from .stats_cache import event_statistics as cached_event_statistics, event_statistics_pdf, global_statistics_pdf
+from .artifacts import read_ticket_pdf
+from .checkin import CHECKIN_ALREADY_USED, CHECKIN_CONFLICTS, CHECKIN_NOT_SOLD, CHECKIN_SOLD_AS, CHECKIN_SUCCESS, MAX_SYNC_SCANS, MAX_TICKET_PAGE_SIZE, TICKET_PAGE_SIZE
+from .checkin import check_in, event_changes, event_manifest, filter_tickets, sync_scans, ticket_page
+from .qr import InvalidQRCode, decode_ticket_qr
 
 def event_list(request):
     # Retrieve all events, you can filter if they are active
@@ -101,20 +115,23 @@ def event_detail(request, event_id):
         form = TicketSelectionForm(request.POST, price_classes=price_classes)
         if form.is_valid():
             selected_tickets = []
-            for price_class in price_classes:
-                quantity = form.cleaned_data.get(f'quantity_{price_class.id}', 0)
-                if quantity > 0:
-                    for _ in range(quantity):
-                        new_ticket = Ticket(
-                            event=event,
-                            price_class=price_class,
-                            activated=False,
-                            sold_as=SoldAsStatus.WAITING
-                        )
-                        new_ticket.save()
-                        selected_tickets.append(new_ticket)
-                        
-            order, _  = get_payment_model().objects.get_or_create(
+            try:
+                # all price classes of the selection are reserved together or not at all
+                with transaction.atomic():
+                    for price_class in price_classes:
+                        quantity = form.cleaned_data.get(f'quantity_{price_class.id}', 0)
+                        if quantity > 0:
+                            selected_tickets += allocate(
+                                event,
+                                price_class,
+                                quantity,
+                                activated=False,
+                                sold_as=SoldAsStatus.WAITING
+                            )
+            except SoldOutError:
+                return JsonResponse({"status": "error", "message": _("Not enough seats left for this event.")})
+
+            order, created = get_payment_model().objects.get_or_create(
                 session_id=request.session.session_key,
                 defaults=get_order_create_defaults(),
             )
@@ -208,21 +225,27 @@ def delete_ticket(request, ticket_id):
     # Return JSON response with updated order data
     return JsonResponse({
         "status": "success",
-        "new_total": f"{order.total} {settings.DEFAULT_CURRENCY}",
-        "ticket_count": order.tickets.count()
+        "new_total": f"{order.subtotal} {settings.DEFAULT_CURRENCY}",
+        "ticket_count": order.ticket_count
     })
 
 def show_generated_ticket_pdf(request, ticket_id):
     # Fetch the ticket by ID
-    ticket = Ticket.objects.get(pk=ticket_id)
+    ticket = Ticket.objects.select_related('event__location', 'price_class').get(pk=ticket_id)
     
-    # Generate PDF for the selected ticket
-    pdf = ticket.generate_pdf_ticket()
-    # Create a BytesIO stream to hold the PDF data
-    file_stream = io.BytesIO(pdf.output())
-
-    # Create a FileResponse to send the PDF file
-    response = FileResponse(file_stream, content_type='application/pdf', filename=f"ticket_{ticket.id}.pdf")
+    # Stored PDF of sold tickets, tickets waiting for a payment are rendered on the fly
+    ticket_pdf = read_ticket_pdf(ticket)
+    etag = quote_etag(ticket_pdf.content_hash)
+    last_modified = int(ticket_pdf.last_modified.timestamp()) if ticket_pdf.last_modified else None
+
+    # Answer with 304 Not Modified if the browser already has this PDF
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        # Create a FileResponse to send the PDF file
+        response = FileResponse(io.BytesIO(ticket_pdf.content), content_type='application/pdf', filename=f"ticket_{ticket.id}.pdf")
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
     
     return response
 
@@ -246,8 +269,7 @@ def event_check_in(request, event_id):
     if active_locations is not None and event.location not in active_locations:
         return redirect('event_list')
 
-    # filter out waiting tickets = not sold yet, SoldAsStatus.PRESALE_ONLINE_WAITING and SoldAsStatus.WAITING
-    tickets = Ticket.objects.filter(event=event).exclude(sold_as__in=[SoldAsStatus.PRESALE_ONLINE_WAITING, SoldAsStatus.WAITING])
+    # the ticket table is loaded page by page from event_check_in_tickets
     branding = get_active_branding()
     is_ticket_manager = is_ticket_manager_user(request.user) or is_admin_user(request.user)
     is_ticket_checker = is_ticket_checker_user(request.user) and not is_ticket_manager
@@ -255,7 +277,7 @@ def event_check_in(request, event_id):
     return render(request, 'event_check_in.html', {
         'event': event,
         'event_active': event.check_active(),
-        'tickets': tickets,
+        'price_classes': event.price_classes.all(),
         'branding': branding,
         'is_ticket_manager': is_ticket_manager,
         'is_ticket_checker': is_ticket_checker,
@@ -264,31 +286,159 @@ def event_check_in(request, event_id):
 
 @login_required
 @user_passes_test(is_user_in_ticket_managers_or_checkers_group_or_admin)
-def handle_qr_result(request, event_id):
+def event_check_in_tickets(request, event_id):
     event = get_object_or_404(Event, id=event_id)
     active_locations = get_user_active_locations(request.user)
     if active_locations is not None and event.location not in active_locations:
         return JsonResponse({"status": "error", "message": _("Not authorized to access this event.")}, status=403)
 
+    # only sold tickets, waiting tickets are not paid yet
+    tickets = Ticket.objects.filter(event=event, sold_as__in=CHECKIN_SOLD_AS)
+    try:
+        seat = request.GET.get('seat')
+        price_class = request.GET.get('price_class')
+        activated = request.GET.get('activated')
+        tickets = filter_tickets(
+            tickets,
+            search=request.GET.get('search', '').strip(),
+            name=request.GET.get('name', '').strip(),
+            email=request.GET.get('email', '').strip(),
+            seat=int(seat) if seat else None,
+            price_class=int(price_class) if price_class else None,
+            activated={'true': True, 'false': False}[activated.lower()] if activated else None,
+        )
+        limit = min(int(request.GET.get('limit', TICKET_PAGE_SIZE)), MAX_TICKET_PAGE_SIZE)
+        page, next_cursor = ticket_page(tickets, request.GET.get('after'), max(limit, 1))
+    except (ValueError, KeyError):
+        return JsonResponse({"status": "error", "message": _("Invalid request.")}, status=400)
+
+    return JsonResponse({
+        "status": "success",
+        "next": next_cursor,
+        "tickets": [
+            {
+                "id": str(ticket.id),
+                "seat": ticket.seat,
+                "email": ticket.email,
+                "first_name": ticket.first_name,
+                "last_name": ticket.last_name,
+                "price_class": ticket.price_class.name,
+                "activated": ticket.activated,
+                "sold_as": ticket.get_sold_as_display(),
+            }
+            for ticket in page
+        ],
+    })
+
+@login_required
+@user_passes_test(is_user_in_ticket_managers_or_checkers_group_or_admin)
+def handle_qr_result(request, event_id):
     if request.method == "POST":
+        # reject forged, malformed and foreign-event codes before any database query
         qr_code_data = request.POST.get('qr_code')
         try:
-            ticket = Ticket.objects.get(id=qr_code_data, event_id=event_id)
-            if ticket.activated:
-                return JsonResponse({
-                    "status": "error",
-                    "message": _("Ticket %(ticket_id)s is already activated.") % {"ticket_id": ticket.id}
-                })
-            ticket.activated = True
-            ticket.save()
-            return JsonResponse({"status": "success", "activated": ticket.activated, "ticket_id": str(ticket.id)})
-        except Ticket.DoesNotExist:
+            ticket_id = decode_ticket_qr(qr_code_data, event_id)
+        except InvalidQRCode:
+            return JsonResponse({"status": "error", "message": _("This QR code is not a valid ticket for this event.")})
+
+    event = get_object_or_404(Event, id=event_id)
+    active_locations = get_user_active_locations(request.user)
+    if active_locations is not None and event.location not in active_locations:
+        return JsonResponse({"status": "error", "message": _("Not authorized to access this event.")}, status=403)
+
+    if request.method == "POST":
+        result = check_in(event.id, ticket_id)
+        if result.status == CHECKIN_SUCCESS:
+            ticket = result.ticket
+            return JsonResponse({
+                "status": "success",
+                "activated": True,
+                "ticket_id": str(ticket['id']),
+                "first_name": ticket['first_name'],
+                "last_name": ticket['last_name'],
+                "seat": ticket['seat'],
+                "price_class": ticket['price_class__name'],
+            })
+        if result.status == CHECKIN_ALREADY_USED:
             return JsonResponse({
                 "status": "error",
-                "message": _("Ticket %(ticket_id)s was not found.") % {"ticket_id": qr_code_data}
+                "message": _("Ticket %(ticket_id)s is already activated.") % {"ticket_id": result.ticket['id']}
             })
+        if result.status == CHECKIN_NOT_SOLD:
+            return JsonResponse({
+                "status": "error",
+                "message": _("Ticket %(ticket_id)s is not paid for.") % {"ticket_id": result.ticket['id']}
+            })
+        return JsonResponse({
+            "status": "error",
+            "message": _("Ticket %(ticket_id)s was not found.") % {"ticket_id": ticket_id}
+        })
     return JsonResponse({"status": "error", "message": _("Invalid request.")})
 
+@login_required
+@user_passes_test(is_user_in_ticket_managers_or_checkers_group_or_admin)
+@gzip_page
+def event_check_in_manifest(request, event_id):
+    event = get_object_or_404(Event, id=event_id)
+    active_locations = get_user_active_locations(request.user)
+    if active_locations is not None and event.location not in active_locations:
+        return JsonResponse({"status": "error", "message": _("Not authorized to access this event.")}, status=403)
+
+    return JsonResponse(event_manifest(event))
+
+@login_required
+@user_passes_test(is_user_in_ticket_managers_or_checkers_group_or_admin)
+def event_check_in_changes(request, event_id):
+    event = get_object_or_404(Event, id=event_id)
+    active_locations = get_user_active_locations(request.user)
+    if active_locations is not None and event.location not in active_locations:
+        return JsonResponse({"status": "error", "message": _("Not authorized to access this event.")}, status=403)
+
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return JsonResponse({"status": "error", "message": _("Invalid request.")}, status=400)
+
+    return JsonResponse(event_changes(event.id, since))
+
+@login_required
+@user_passes_test(is_user_in_ticket_managers_or_checkers_group_or_admin)
+def event_check_in_sync(request, event_id):
+    event = get_object_or_404(Event, id=event_id)
+    active_locations = get_user_active_locations(request.user)
+    if active_locations is not None and event.location not in active_locations:
+        return JsonResponse({"status": "error", "message": _("Not authorized to access this event.")}, status=403)
+
+    if request.method != "POST":
+        return JsonResponse({"status": "error", "message": _("Invalid request.")})
+    try:
+        scans = json.loads(request.body)['scans']
+        if not isinstance(scans, list) or not all(isinstance(scan, dict) for scan in scans):
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"status": "error", "message": _("Invalid request.")}, status=400)
+    if len(scans) > MAX_SYNC_SCANS:
+        return JsonResponse({
+            "status": "error",
+            "message": _("At most %(count)s scans can be synced at once.") % {"count": MAX_SYNC_SCANS}
+        }, status=400)
+
+    results = sync_scans(event.id, scans)
+    return JsonResponse({
+        "status": "success",
+        "applied": sum(result.status == CHECKIN_SUCCESS for result in results),
+        "conflicts": sum(result.status in CHECKIN_CONFLICTS for result in results),
+        "results": [
+            {
+                "code": result.code,
+                "result": result.status,
+                "ticket_id": str(result.ticket_id) if result.ticket_id else None,
+                "activation_changed_at": result.activation_changed_at.isoformat() if result.activation_changed_at else None,
+            }
+            for result in results
+        ],
+    })
+
 @login_required
 @user_passes_test(is_user_in_ticket_managers_or_checkers_group_or_admin)
 def toggle_ticket_activation(request, ticket_id):
@@ -310,46 +460,41 @@ def event_door_selling(request, event_id):
         if form.is_valid():
             if event.check_active():
                 # event is active: all good.
-                for price_class in price_classes:
-                    quantity = form.cleaned_data.get(f'quantity_{price_class.id}', 0)
-                    if quantity > 0:
-                        for _ in range(quantity):
-                            if presale_end_time < datetime.now(timezone.utc):
-                                # Presale has ended
-                                
-                                if event.allow_door_selling:
-                                    # sell tickets as DOOR
-                                    new_ticket = Ticket(
-                                        event=event,
-                                        price_class=price_class,
-                                        activated=True,
-                                        sold_as=SoldAsStatus.DOOR,
-                                        email=form.cleaned_data.get('email'),
-                                        first_name=form.cleaned_data.get('first_name'),
-                                        last_name=form.cleaned_data.get('last_name')
-                                    )
-                                else:
-                                    # Door selling is not allowed
-                                    return JsonResponse({"status": "error", "message": _("Door selling is not allowed for this event.")})
-                            else:
-                                # Sell tickets as PRESALE
-                                new_ticket = Ticket(
-                                    event=event,
-                                    price_class=price_class,
-                                    activated=False,
-                                    sold_as=SoldAsStatus.PRESALE_DOOR,
+                if presale_end_time < datetime.now(timezone.utc):
+                    # Presale has ended
+                    if not event.allow_door_selling:
+                        # Door selling is not allowed
+                        return JsonResponse({"status": "error", "message": _("Door selling is not allowed for this event.")})
+                    # sell tickets as DOOR
+                    ticket_fields = {'activated': True, 'sold_as': SoldAsStatus.DOOR}
+                else:
+                    # Sell tickets as PRESALE
+                    ticket_fields = {'activated': False, 'sold_as': SoldAsStatus.PRESALE_DOOR}
+
+                new_tickets = []
+                try:
+                    # all price classes of the sale are reserved together or not at all
+                    with transaction.atomic():
+                        for price_class in price_classes:
+                            quantity = form.cleaned_data.get(f'quantity_{price_class.id}', 0)
+                            if quantity > 0:
+                                new_tickets += allocate(
+                                    event,
+                                    price_class,
+                                    quantity,
                                     email=form.cleaned_data.get('email'),
                                     first_name=form.cleaned_data.get('first_name'),
-                                    last_name=form.cleaned_data.get('last_name')
+                                    last_name=form.cleaned_data.get('last_name'),
+                                    **ticket_fields
                                 )
-                            new_ticket.save()
-
-                            # if email is provided, send the ticket email
-                            if new_ticket.email:
-                                try:
-                                    new_ticket.queue_send_to_email()
-                                except Exception as e:
-                                    logger.exception("Failed to queue ticket email for ticket_id=%s: %s", new_ticket.id, e)
+                except SoldOutError:
+                    return JsonResponse({"status": "error", "message": _("Not enough seats left for this event.")})
+
+                # if email is provided, send the ticket emails in one batch
+                try:
+                    Ticket.queue_send_emails(new_tickets)
+                except Exception as e:
+                    logger.exception("Failed to queue ticket emails for event_id=%s: %s", event.id, e)
             else:
                 # event is not active
                 return JsonResponse({"status": "error", "message": _("Event is not active.")})
@@ -375,7 +520,7 @@ def event_door_selling(request, event_id):
 @user_passes_test(is_user_in_ticket_managers_group_or_admin)
 def event_statistics(request, event_id):
     event = get_object_or_404(Event, id=event_id)
-    total_stats, price_class_stats = event.calculate_statistics()
+    total_stats, price_class_stats = cached_event_statistics(event)
     return render(request, 'event_statistics.html', {
         'price_class_stats': price_class_stats,
         'total_stats': total_stats,
@@ -389,10 +534,8 @@ def show_generated_statistics_pdf(request, event_id):
     # Fetch the event by ID
     event = Event.objects.get(pk=event_id)
     
-    # Generate PDF for the selected ticket
-    pdf = event.generate_statistics_pdf()
-    # Create a BytesIO stream to hold the PDF data
-    file_stream = io.BytesIO(pdf.output())
+    # Generate PDF for the selected event, repeated downloads are served from the cache
+    file_stream = io.BytesIO(event_statistics_pdf(event))
 
     # Create a FileResponse to send the PDF file
     now = datetime.now().strftime("%Y-%m-%d")
@@ -400,55 +543,43 @@ def show_generated_statistics_pdf(request, event_id):
     
     return response
 
-def get_all_event_statistics(locations=None):
+def _get_statistics_events(locations=None):
     events = Event.objects.all().order_by('start_time')
 
     # filter event by locations if provided
     if locations is not None:
         events = events.filter(location__in=locations)
+    return events
+
+def _get_refund_statistics():
+    # refunded orders are summed up in the database; their tickets are removed by the refund/cancel logic
+    refunds = get_payment_model().objects.filter(status=PaymentStatus.REFUNDED).aggregate(
+        total_refunded=Count('pk'),
+        total_amount_refunded=Sum('total'),
+    )
+    return {
+        'total_refunded': refunds['total_refunded'],
+        'total_amount_refunded': refunds['total_amount_refunded'] or Decimal('0.0')
+    }
 
-    events_stats = []
-
-    stat_keys = [
-        'waiting',
-        'presale_online_waiting',
-        'presale_online',
-        'presale_door',
-        'door',
-        'total_sold',
-        'total_count',
-        'activated_presale_online',
-        'activated_presale_door',
-        'activated_door',
-        'total_activated',
-        'earned_presale_online',
-        'earned_presale_door',
-        'earned_door',
-        'total_earned',
-    ]
+def get_all_event_statistics(locations=None):
+    events = _get_statistics_events(locations)
 
-    def _empty_stats():
-        return {key: 0 for key in stat_keys}
+    events_stats = []
 
     location_scope = locations if locations is not None else Location.objects.filter(event__isnull=False).distinct()
     per_location_stats_map = {
         location.id: {
             'location': location,
-            'stats': _empty_stats(),
+            'stats': empty_stats(),
         }
         for location in location_scope
     }
 
-    overall_refunded = {
-        'total_refunded': 0,
-        'total_amount_refunded': Decimal('0.0')
-    }
-
-    overall_total_stats = _empty_stats()
+    overall_total_stats = empty_stats()
 
-    # compute each event statistics once and accumulate per-location + overall totals in one pass
-    for event in events:
-        total_stats, price_class_stats = event.calculate_statistics()
+    # statistics of all events come from one grouped query; accumulate per-location + overall totals in one pass
+    for event, total_stats, price_class_stats in collect_event_statistics(events):
         events_stats.append({
             'event': event,
             'price_class_stats': price_class_stats,
@@ -458,20 +589,16 @@ def get_all_event_statistics(locations=None):
         if event.location_id not in per_location_stats_map:
             per_location_stats_map[event.location_id] = {
                 'location': event.location,
-                'stats': _empty_stats(),
+                'stats': empty_stats(),
             }
 
-        for key in stat_keys:
-            value = total_stats.get(key, 0)
-            overall_total_stats[key] += value
-            per_location_stats_map[event.location_id]['stats'][key] += value
+        add_stats(overall_total_stats, total_stats)
+        add_stats(per_location_stats_map[event.location_id]['stats'], total_stats)
 
     per_location_stats = list(per_location_stats_map.values())
 
-    # get refunded statistics for all orders that have been refunded; their tickets are removed by the refund/cancel logic,
-    for order in get_payment_model().objects.filter(status=PaymentStatus.REFUNDED):
-        overall_refunded['total_refunded'] += 1
-        overall_refunded['total_amount_refunded'] += order.total
+    # get refunded statistics for all orders that have been refunded
+    overall_refunded = _get_refund_statistics()
 
     return events_stats, per_location_stats, overall_total_stats, overall_refunded
 
@@ -696,16 +823,22 @@ def generate_global_statistics_pdf(locations=None):
         
     return pdf
 
+def get_global_statistics_pdf_bytes(locations=None):
+    # the cached PDF is reused as long as no event in the report and no refund changed
+    return global_statistics_pdf(
+        _get_statistics_events(locations).select_related('inventory'),
+        _get_refund_statistics(),
+        partial(generate_global_statistics_pdf, locations=locations),
+    )
+
 @login_required
 @user_passes_test(is_user_in_ticket_managers_group_or_admin)
 def show_generated_global_statistics_pdf(request):
     selected_location_id = request.GET.get('location')
     locations, _ = _get_statistics_location_scope(request.user, selected_location_id)
 
-    # Generate PDF for the selected ticket
-    pdf = generate_global_statistics_pdf(locations=locations)
-    # Create a BytesIO stream to hold
-    file_stream = io.BytesIO(pdf.output())
+    # Generate PDF for the selected locations, repeated downloads are served from the cache
+    file_stream = io.BytesIO(get_global_statistics_pdf_bytes(locations=locations))
     # Create a FileResponse to send the PDF file
     now = datetime.now().strftime("%Y-%m-%d")
     response = FileResponse(file_stream, content_type='application/pdf', filename=f"all_events_{now}.pdf")